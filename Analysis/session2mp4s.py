@@ -7,23 +7,40 @@ This utility creates converts movies captured by the assocLearnRig system
 to viewable .mp4. CS and US epochs are indicated by a white then black
 square embedded in the movie's upper right corner.
 
+With --remux the stored JPEGs are copied into .mkv files instead, without
+decoding or re-encoding: frames keep their recorded times (variable frame
+rate) and the CS/US epochs are a subtitle track. Runs at disk speed.
+    python session2mp4s.py [dataDir] [--remux]
+
 @author: gerardjb
 """
 
 from tkinter import Tk, filedialog
+import argparse
 import glob
-import imageio
-import pickle
 import numpy as np
-import cv2
 import os
 import csv
+import sys
+
+#frame readers are shared with the rig code in the repository root
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from framestore import open_frames
+from framedecode import iter_frames, prefetch
+from framemux import remux_trial
+
+parser = argparse.ArgumentParser(description='Make viewable movies of assocLearnRig trial files')
+parser.add_argument('path', nargs='?', help='data directory, asked for if left out')
+parser.add_argument('--remux', action='store_true', help='copy the JPEGs into .mkv files instead of encoding .mp4')
+args = parser.parse_args()
 
 #Path and files to make movies for
-root = Tk()
-root.withdraw()
-root.attributes('-topmost', True)
-path = filedialog.askdirectory()
+path = args.path
+if not path:
+    root = Tk()
+    root.withdraw()
+    root.attributes('-topmost', True)
+    path = filedialog.askdirectory()
 files = sorted([(d,f) for d,_,fs in os.walk(path) for f in fs if f.endswith('.data')])
 im_files = [os.path.join(*i) for i in files]
 files = sorted([(d,f) for d,_,fs in os.walk(path) for f in fs if f.endswith('.txt')])
@@ -35,51 +52,6 @@ print('Available datasets:')
 for idx,n in enumerate(names):
     print(f'\t{idx}\t{n}')
 
-#%% function to convert mjpg to np array
-def mjpg2array(filename):   
-    #Open and unpickle the bytes file
-    filehand = open(filename,'rb')
-    stream = []
-    while 1:
-        try:
-            stream.append(pickle.load(filehand))
-        except EOFError:
-            break
-    filehand.close()
-    #Flatten stream and separate out timestamps
-    stream = [x for l in stream for x in l]
-    lists = [list(t) for t in zip(*stream)]
-    ts = np.array(lists[0])*1000
-    stream = lists[1]
-    nIm = len(stream)
-    
-    #Reading through the binary file to parse image data
-    idx = 0 #for buidling the np image array
-    for img in stream:
-        #grab frame start and end on hex stream
-        a = img.find(b'\xff\xd8')
-        b = img.find(b'\xff\xd9')
-        if a != -1 and b != -1:
-            jpg = img[a:b+2]
-            #stream = stream[b+2:]
-            data = cv2.imdecode(np.frombuffer(jpg, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
-            
-            if idx==0:
-                #For plot of line scan
-                sizeWH = data.shape
-                #Full output array
-                mov = np.empty([int(sizeWH[0]),int(sizeWH[1]),nIm],dtype=np.uint8)
-                mov[:,:,0] = data
-            else:
-                mov[:,:,idx] = data
-            idx += 1
-        elif a==-1 or b==-1:
-            pass
-    
-    # permute the data to put time element first
-    imArray = np.transpose(mov,(2,0,1))
-    return imArray,ts
-
 #%% selecting and opening files to make into movies
 #Grab first row headers from txt_files, parse to dictionary
 with open(txt_files[0]) as txtfilehand:
@@ -88,15 +60,34 @@ with open(txt_files[0]) as txtfilehand:
 headers = dict(x.split('=') for x in headers[0].split(';') if '=' in x)
 txtfilehand.close()
 
+#Passthrough: no pixels are touched, the epochs become subtitles
+if args.remux:
+    csTime = float(headers['preCSdur'])
+    csusInt = float(headers['CS_USinterval'])
+    usDur = float(headers['USdur'])
+    epochs = [(csTime, csTime + csusInt + usDur, 'CS'),
+              (csTime + csusInt, csTime + csusInt + usDur, 'US')]
+    out_dir = os.path.join(path, 'sampleMovs')
+    os.makedirs(out_dir, exist_ok=True)
+    for file,name in zip(im_files,names):
+        with open_frames(file) as frames:
+            n = remux_trial(frames, os.path.join(out_dir, name + '.mkv'), epochs, name)
+        print(f"[{name}] frames={n}  remuxed")
+    sys.exit()
+
+import imageio
+
 #Loop over and write movies
+#Frames stream from the file through a decode thread into the encoder, so
+#memory stays at a few frames whatever the trial length
 for file,name in zip(im_files,names):
-    #parse bytes to np array
-    imArray,time = mjpg2array(file)
+    frames = open_frames(file)
+    time = frames.ts
     
     dt = np.diff(time)
     dt = dt[(dt > 0) & (dt < np.percentile(dt, 99.5))]
     fps = 1000.0 / np.median(dt) if dt.size else 30.0
-    print(f"[{name}] frames={len(imArray)}  fps≈{fps:.3f}  res={imArray.shape[2]}x{imArray.shape[1]}")
+    print(f"[{name}] frames={len(frames)}  fps≈{fps:.3f}")
     
     # Apply CS/US stamps WITHOUT trimming any frames (all files have trials + ITIs)
     csTime = float(headers['preCSdur'])        # ms
@@ -111,10 +102,6 @@ for file,name in zip(im_files,names):
     # boolean masks over the time vector (ms)
     cs_mask = (time >= cs_start) & (time <= cs_end)
     us_mask = (time >= us_start) & (time <= us_end)
-    
-    # vectorized stamps: white for CS, black for US (US overrides in overlap)
-    imArray[cs_mask, 0:10, 0:10] = 255  # white CS square
-    imArray[us_mask, 0:10, 0:10] = 0    # black US square
 
     #write to mp4
     out_dir = os.path.join(path, 'sampleMovs')
@@ -130,7 +117,16 @@ for file,name in zip(im_files,names):
         ffmpeg_params=['-x265-params', 'lossless=1', '-preset', 'ultrafast']
     )
     try:
-        for fr in imArray:          # write ALL frames as grayscale
+        # decoding runs ahead in its own thread while the encoder takes frames
+        for idx, (ts, fr) in enumerate(prefetch(iter_frames(frames))):
+            if fr is None:
+                continue            # no JPEG markers, mjpg2array dropped these too
+            # stamps: white for CS, black for US (US overrides in overlap)
+            if cs_mask[idx]:
+                fr[0:10, 0:10] = 255
+            if us_mask[idx]:
+                fr[0:10, 0:10] = 0
             writer.append_data(fr)  # 2D uint8; ffmpeg converts to YUV internally
     finally:
         writer.close()
+        frames.close()
@@ -11,128 +11,86 @@ Data will be output to a summary subdirectory in both the data directory
 as well as a master summary in the head directory. In the data subdirectory
 plots of the data will be generated.
 
+Run without arguments for the directory dialog. Given a directory it runs
+as a batch, one session per process, without stopping for ROIs:
+    python summarizeSessions.py /path/to/cohort -j 8
+Sessions that have no roi.npy yet are skipped and listed; --pick-rois draws
+them in the main process once the batch is done and then processes them.
+
 @author: gerardjb
 """
 
 #%% import libraries
 from tkinter import Tk, filedialog
 import numpy as np
-import pickle
 import cv2
 import matplotlib.pyplot as pl
-from matplotlib import cm
 import pandas as pd
 import os
 import csv
 import re
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+#frame readers are shared with the rig code in the repository root
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from framedecode import DecodeEngine, mean_frame
+from tracecache import TraceCache
+from sessiontraces import SessionTraces
+from rigevents import rotary_trials
+from trialalign import align_trials, flatten, summarize, save_mat
+from sessionreport import ReportPool
 
-#%% Select directory with animal data
-root = Tk()
-root.withdraw()
-root.attributes('-topmost', True)
-pathMaster = filedialog.askdirectory()
+#number of threads decoding each trial's frames, 1 decodes serially
+nWorkers = os.cpu_count()
+#1, 2, 4 or 8: decode frames at 1/decodeScale size, run framedecode.py on a
+#trial to see the speedup and deviation from full resolution for a study
+decodeScale = 1
+#extracted traces are cached per cohort in Summary/traceCache, so re-running
+#with other plotting parameters skips decoding; cacheMB bounds its size, 0 turns it off
+cacheMB = 2048
+#processes drawing the summary figures next to the analysis, 0 skips the figures
+reportWorkers = 2
+
+def traceCache(pathMaster,sizeMB=cacheMB):
+    if not sizeMB:
+        return None
+    return TraceCache(os.path.join(pathMaster,'Summary','traceCache'),maxBytes=sizeMB<<20)
 
 #%% Mask out the ROI to analyze, plot
 # select eye ROI
-def pickROI(imArray):
-    pl.imshow(imArray.mean(axis=0), cmap=pl.cm.Greys_r)
+def pickROI(meanIm):
+    pl.imshow(meanIm, cmap=pl.cm.Greys_r)
     pts = pl.ginput(timeout=-1, n=-1)
     pl.close()
     
     # convert points to mask
     pts = np.asarray(pts, dtype=np.int32)
-    roi = np.zeros(imArray[0].shape, dtype=np.int32)
+    roi = np.zeros(meanIm.shape, dtype=np.int32)
     roi = cv2.fillConvexPoly(roi, pts, (1,1,1), lineType=cv2.LINE_AA)
     roi = roi.astype(float)
     return roi   
 
-#%% initializing the image stack and parsing the image stack
-#unpickling the bytes stream from mjpg and converting to np array shape [nIm,wid,height]
-def mjpg2array(filename):   
-    #Open and unpickle the bytes file
-    filehand = open(filename,'rb')
-    stream = []
-    while 1:
-        try:
-            stream.append(pickle.load(filehand))
-        except EOFError:
-            break
-    filehand.close()
-    #Removing the extra list packaging, getting nImages points
-    stream = [x for l in stream for x in l]
-    lists = [list(t) for t in zip(*stream)]
-    ts = np.array(lists[0])*1000#convert to millis
-    stream = lists[1]
-    nIm = len(stream)
-    
-    #Reading through the binary file to parse image data
-    idx = 0 #for buidling the np image array
-    for img in stream:
-        #grab frame start and end on hex stream
-        a = img.find(b'\xff\xd8')
-        b = img.find(b'\xff\xd9')
-        if a != -1 and b != -1:
-            jpg = img[a:b+2]
-            #stream = stream[b+2:]
-            data = cv2.imdecode(np.frombuffer(jpg, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
-            
-            if idx==0:
-                #For plot of line scan
-                sizeWH = data.shape
-                #Full output array
-                mov = np.empty([int(sizeWH[0]),int(sizeWH[1]),nIm],dtype=np.uint8)
-                mov[:,:,0] = data
-            else:
-                mov[:,:,idx] = data
-            idx += 1
-            #cv2.imshow('i', data)
-            #if cv2.waitKey(1)==27:
-                #exit(0)
-        elif a==-1 or b==-1:
-            pass
-    
-    # permute the data to put time element first
-    imArray = np.transpose(mov,(2,0,1))
-    return imArray,ts
-
-#%Takes arduino data frame and trial idx as inputs	
-def parseRotary(df,idx):
-	#Wheel information for converting pulse/time to cm/s
-	circ = 15.24*np.pi#Dimensions of Aeromat roller
-	counts = 2000*4
-	count2cm = circ/counts
-	
-	#Get timing of trials and rate arduino polls rotary encoder
-	startIdxs = np.append(np.where(df.event=='startTrial')[0],df.index[-1])
-	subDf = df[(df.index>startIdxs[idx]) & (df.index<startIdxs[idx+1]) & (df.event=='rotary')]
-	time = (subDf.millis.astype('int') - int(df.millis[startIdxs[idx]]))#in ms
-	pollrate = np.mean(np.diff(time))
-	
-	#Convert counts to cm/s
-	wheelVel = subDf.value*count2cm/(pollrate/1000)
-	wheelVel[wheelVel>1000] = np.nan
-	
-	return wheelVel,time
-
+def roiFile(pathMaster,subDir):
+    #saved eye ROI of a session, sessionInfo joined back is the directory name
+    return os.path.join(pathMaster,subDir,'Summary',subDir+'roi.npy')
 
-#%% Choose a directory
-#All camera and timestamp files
-subDirs = next(os.walk(pathMaster))[1]
-print('Available datasets:')
-for idx,n in enumerate(subDirs):
-    print('\t{}\t{}'.format(idx,n))
+def sessionDirs(pathMaster):
+    #subdirectories of pathMaster holding camera data, i.e. sessions to analyze
+    subDirs = next(os.walk(pathMaster))[1]
+    return [d for d in sorted(subDirs)
+            if any(f.endswith('.data') for _,_,fs in os.walk(os.path.join(pathMaster,d)) for f in fs)]
 
-#%%
-#grabbing the files and metadata from the chosen directory for analysis
-subDirIdx = range(len(subDirs))#
-
-#Loop over all directories in pathMaster directory
-for thisSubDir in subDirIdx:
-    path = os.path.join(pathMaster,subDirs[thisSubDir])
+#%% Analysis of one session directory
+#Returns False without doing anything if the session has no ROI and interactive is off,
+#True if there was nothing to analyze, otherwise the arguments for ReportPool.submit
+def summarizeSession(pathMaster,subDir,engine,interactive=True):
+    path = os.path.join(pathMaster,subDir)
     files = [(d,f) for d,_,fs in os.walk(path) for f in fs if f.endswith('.data')]
 	#pass if no data files
     if not files:
-        continue
+        return True
     #for sorting
     convert = lambda text: int(text) if text.isdigit() else text.lower()
     alphanum_key = lambda key: [convert(c) for c in re.split('([0-9]+)', key)]
@@ -159,44 +117,33 @@ for thisSubDir in subDirIdx:
     trialTypes = dataR['event'][dataR['event'].isin(trialTypes)].values
     #ISI inter-start intervals
     ISI = np.diff(dataR['millis'][dataR['event']=='startTrial'].apply(pd.to_numeric))
-    ISI = np.insert(ISI,0,0) #ISI for first trial is 0       
+    ISI = np.insert(ISI,0,0) #ISI for first trial is 0
+    #Wheel speed of every trial, converting and splitting the event table once
+    rotTrials = rotary_trials(pd.to_numeric(dataR['millis'],errors='coerce'),dataR['event'],
+                              pd.to_numeric(dataR['value'],errors='coerce'))       
     
     #Extracting subject, date, session from directory header
-    sessionInfo = subDirs[thisSubDir].split('_')
+    sessionInfo = subDir.split('_')
     animalID = sessionInfo[0]
     date = sessionInfo[1]
     
     #%% pick roi
-    imPickArray,time = mjpg2array(im_files[0])
     #If ROI already selected, use saved version
-    if os.path.exists(os.path.join(localDir,'_'.join(sessionInfo)+'roi.npy')):
-        roi = np.load(os.path.join(localDir,'_'.join(sessionInfo)+'roi.npy'))
+    if os.path.exists(roiFile(pathMaster,subDir)):
+        roi = np.load(roiFile(pathMaster,subDir))
+    elif not interactive:
+        return False
     else:
         pl.close('all')
-        roi = pickROI(imPickArray)
+        roi = pickROI(mean_frame(im_files[0]))
         
     #%% getting data for each analyzed trial
-    data = pd.DataFrame()
+    #traces go into arrays sized for the session, the data frame is built once for saving
+    traces = SessionTraces(len(files),animalID=animalID,date=date)
     for idx in range(len(files)):
-        #Initialize data frame to hold this trial's data
-        newData = pd.DataFrame()
-        
-        #Read image data, process
-        imArray,time = mjpg2array(im_files[idx])
-        tr = imArray.reshape([len(imArray), -1]) @ roi.reshape(np.product(roi.shape))
-        
-       
-        #add eyetrace to the new dataframe and append to full dataframe
-        newData['time'] = time
-        newData['eyetrace'] = tr
-        newData['trial'] = idx
-        #add session and trial info to the dataframe
-        newData.insert(0,'date',date)
-        newData.insert(0,'animalID',animalID)
-        newData['trialType'] = trialTypes[idx]
-        #Concatenate
-        frames = [data,newData]
-        data = pd.concat(frames)
+        #Read image data, reducing each frame against the roi as it is decoded
+        tr,time = engine.eyelid_trace(im_files[idx],roi,scale=decodeScale)
+        traces.append(idx,time,tr,trialTypes[idx])
         print('_'.join(sessionInfo)+' '+str(idx))
     
     
@@ -208,141 +155,29 @@ for thisSubDir in subDirIdx:
     timeBins = np.arange(-pad[0]+csTime,pad[1]+csTime+csusInt,1)
     #Need parser for CS v. US trials
     
-    #%% making some summary plots
-    #Initializing directory to save figures
+    #%% aligning and aggregating for the report and the saved summaries
     localDir = os.path.join(path,'Summary')
     if not os.path.exists(localDir):
             os.makedirs(localDir)
             
     #this is a single trial with its time series data
-    uniTrials = data.trial.unique()
-    colors = cm.jet(np.linspace(0,1,len(uniTrials)))
+    uniTrials = np.array(traces.trials)
     
-    #for holding clips of the eyetrace and rotary data
-    slices = np.zeros((len(uniTrials),len(timeBins)))
-    slicesR = np.zeros((len(uniTrials),len(timeBins)))
-	
-    #loop and plot individual trials
-    pl.figure(1)
-    pl.figure(2)
-    for idx in range(len(uniTrials)):
-        thisT = np.array(data['time'][data['trial']==uniTrials[idx]],dtype=float)
-        thisEye = np.array(data['eyetrace'][data['trial']==uniTrials[idx]],dtype=float)
-        thisRot, thisT_rot = parseRotary(dataR,idx)
-    	
-        if any(thisT>0):
-            interpEye = np.interp(timeBins,thisT[thisT>0],thisEye[thisT>0])
-            interpR = np.interp(timeBins,thisT_rot[thisT_rot>0],thisRot[thisT_rot>0])
-        else:
-            interpEye = np.empty((len(timeBins)))
-            interpEye[:] = np.nan
-            interpR = np.interp(timeBins,thisT_rot[thisT_rot>0],thisRot[thisT_rot>0])
-            print(idx)
-        pl.figure(1)
-        pl.plot(timeBins-csTime,interpEye,linewidth=0.3,color=colors[idx])
-        slices[idx] = interpEye
-		
-        pl.figure(2)
-        pl.plot(timeBins-csTime,interpR,linewidth=0.3,color=colors[idx])
-        slicesR[idx] = interpR
-
-    pl.figure(1)
-    n,x = pl.ylim()
-    pl.vlines(csusInt, n, x, linestyle='--', color='black')
-    pl.vlines(0, n, x, linestyle='--', color='black')
-    pl.xlabel('time from CS onset (ms)')
-    pl.ylabel('Eyelid (a.u.)')
-    pl.title('_'.join(sessionInfo))
-    pl.tight_layout()
-    pl.savefig(os.path.join(localDir,'_'.join(sessionInfo)+'traces.jpg'))
-	
-    pl.figure(2)
-    n,x = pl.ylim()
-    pl.vlines(csusInt, n, x, linestyle='--', color='black')
-    pl.vlines(0, n, x, linestyle='--', color='black')
-    pl.xlabel('time from CS onset (ms)')
-    pl.ylabel('Wheel speed (cm/s)')
-    pl.title('_'.join(sessionInfo))
-    pl.tight_layout()
-    pl.savefig(os.path.join(localDir,'_'.join(sessionInfo)+'rotarytraces.jpg'))
+    #clips of the eyetrace and rotary data on timeBins, every trial at once
+    slices = traces.align(timeBins)
+    slicesR = align_trials(*flatten(rotTrials[:len(uniTrials)]),timeBins)
+    for idx in np.flatnonzero(np.isnan(slices).all(axis=1)):
+        print(idx)
+    summary = summarize(timeBins,csTime,trialTypes[uniTrials],slices,slicesR)
     
-    pl.close('all')
-	
-    #Show an average of the trial type of choice with std bars
-    trialKinds = np.array(['CS_US','CS','US'])
-    colors = np.array(['blue','red','green'])
-    pl.figure(1)
-    pl.figure(2)
-    idx = 0
-    legStr = []
-    legHand = []
-    legStrR = []
-    legHandR = []
-    for kind in trialKinds:
-        if not sum(trialTypes==kind)==0:
-            subSlices = slices[trialTypes[uniTrials]==kind]
-            mean = np.nanmean(subSlices,axis=0)
-            err = np.nanstd(subSlices,axis=0)
-            subSlicesR = slicesR[trialTypes[uniTrials]==kind]
-            meanR = np.nanmean(subSlicesR,axis=0)
-            errR = np.nanstd(subSlicesR,axis=0)
-            pl.figure(1)
-            h, = pl.plot(timeBins-csTime,mean,color=colors[trialKinds==kind][0])
-            legHand.append(h)
-            pl.fill_between(timeBins-csTime, mean-err, mean+err, alpha=.1, color=colors[trialKinds==kind][0], lw=0)
-            legStr.append(kind)
-            pl.figure(2)
-            h, = pl.plot(timeBins-csTime,meanR,color=colors[trialKinds==kind][0])
-            legHandR.append(h)
-            pl.fill_between(timeBins-csTime, meanR-errR, meanR+errR, alpha=.1, color=colors[trialKinds==kind][0], lw=0)
-            legStrR.append(kind)
-            idx+=1
-    pl.figure(1)
-    n,x = pl.ylim()
-    pl.vlines(csusInt, n, x, linestyle='--', color='black')
-    pl.vlines(0, n, x, linestyle='--', color='black')
-    pl.xlabel('time from CS onset (ms)')
-    pl.ylabel('Average eyelid position (a.u.)')
-    pl.title('_'.join(sessionInfo))
-    pl.legend(legHand,legStr)
-    pl.tight_layout()
-    pl.savefig(os.path.join(localDir,'_'.join(sessionInfo)+'avgTraces.pdf'))
-	
-    pl.figure(2)
-    n,x = pl.ylim()
-    pl.vlines(csusInt, n, x, linestyle='--', color='black')
-    pl.vlines(0, n, x, linestyle='--', color='black')
-    pl.xlabel('time from CS onset (ms)')
-    pl.ylabel('Average speed (cm/s)')
-    pl.title('_'.join(sessionInfo))
-    pl.legend(legHandR,legStrR)
-    pl.tight_layout()
-    pl.savefig(os.path.join(localDir,'_'.join(sessionInfo)+'avgTracesRotary.pdf'))
-    
-    #Make a heatmap of the time slices
-    xAxis = [timeBins[0]-csTime,timeBins[-1]-csTime]
-    pl.figure()
-    imgHand = pl.imshow(slices,\
-                        cmap='Greys_r',extent=[xAxis[0],xAxis[1],len(uniTrials-1),0],aspect = 'auto')
-    pl.colorbar()
-    n,x = pl.ylim()
-    pl.vlines(csusInt, n, x, linestyle='--', color='red')
-    pl.vlines(0, n, x, linestyle='--', color='red')
-    pl.xlabel('time from CS onset (ms)')
-    pl.ylabel('trial number')
-    pl.title('_'.join(sessionInfo))
-    pl.tight_layout()
-    pl.savefig(os.path.join(localDir,'_'.join(sessionInfo)+'tracesImg.jpg'))
-    
-    #If analyzing multiple files, close these figures
-    #if len(subDirIdx)>1:
-        #pl.close('all')
-        
     #%% Save dataframes in this directory and in the head directory
     #Saving to local directory
+    data = traces.to_dataframe()
     data.to_hdf(os.path.join(localDir,'_'.join(sessionInfo)+'data.h5'),key = 'df') #camera dataframe
     dataR.to_hdf(os.path.join(localDir,'_'.join(sessionInfo)+'dataR.h5'),key = 'df') #metadata dataframe
     np.save(os.path.join(localDir,'_'.join(sessionInfo)+'roi'),roi)
+    #aligned traces and per trial type statistics for the MATLAB dbase (unpackRotaryData.m)
+    save_mat(summary,os.path.join(localDir,'_'.join(sessionInfo)+'traces.mat'))
     with open(os.path.join(localDir,'_'.join(sessionInfo)+'trialTypes.csv'),'w') as f:
         write = csv.writer(f)
         write.writerow(zip(trialTypes))
@@ -352,3 +187,100 @@ for thisSubDir in subDirIdx:
     data.to_hdf(os.path.join(headDir,'_'.join(sessionInfo)+'data.h5'),key = 'df') #camera dataframe
     dataR.to_hdf(os.path.join(headDir,'_'.join(sessionInfo)+'dataR.h5'),key = 'df') #metadata dataframe
     np.save(os.path.join(headDir,'_'.join(sessionInfo)+'traces.npy'),slices)
+    
+    #figures are drawn by a sessionreport.ReportPool from these, see reportJob()
+    return summary,'_'.join(sessionInfo),localDir,csusInt
+
+
+def batchSession(pathMaster,subDir,sizeMB=cacheMB):
+    #one process per session, decoding serially; figures are left to the report pool
+    engine = DecodeEngine(workers=1,cache=traceCache(pathMaster,sizeMB))
+    try:
+        return summarizeSession(pathMaster,subDir,engine,interactive=False)
+    finally:
+        engine.close()
+
+def pickROIs(pathMaster,subDirs):
+    #interactive pass for sessions the batch skipped, saves each roi.npy
+    for subDir in subDirs:
+        path = os.path.join(pathMaster,subDir)
+        im_files = sorted(os.path.join(d,f) for d,_,fs in os.walk(path) for f in fs if f.endswith('.data'))
+        os.makedirs(os.path.join(path,'Summary'),exist_ok=True)
+        pl.close('all')
+        print('Draw the eye ROI for '+subDir)
+        np.save(roiFile(pathMaster,subDir),pickROI(mean_frame(im_files[0])))
+
+def reportJob(reports,result,name):
+    #hand a finished session to the report pool, None if reports are off
+    if reports is None or not isinstance(result,tuple):
+        return None
+    job = reports.submit(*result)
+    job.add_done_callback(lambda j: print(('report FAILED '+name+': '+repr(j.exception())) if j.exception() else 'report done '+name))
+    return job
+
+def runBatch(pathMaster,workers,subDirs=None,sizeMB=cacheMB,reports=None):
+    #sessions with a saved ROI go to the pool, the rest are returned for pickROIs
+    subDirs = sessionDirs(pathMaster) if subDirs is None else subDirs
+    pending = [d for d in subDirs if not os.path.exists(roiFile(pathMaster,d))]
+    ready = [d for d in subDirs if d not in pending]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = {pool.submit(batchSession,pathMaster,d,sizeMB):d for d in ready}
+        for job in as_completed(jobs):
+            try:
+                reportJob(reports,job.result(),jobs[job])
+                print('done '+jobs[job])
+            except Exception as e:
+                print('FAILED '+jobs[job]+': '+repr(e))
+    if pending:
+        #keep the queue on disk too so the interactive pass can be run later
+        headDir = os.path.join(pathMaster,'Summary')
+        os.makedirs(headDir,exist_ok=True)
+        with open(os.path.join(headDir,'pendingROI.txt'),'w') as f:
+            f.write('\n'.join(pending)+'\n')
+        print('No ROI yet for: '+', '.join(pending))
+    return pending
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize eyeblink sessions')
+    parser.add_argument('root',nargs='?',help='directory of session directories, omit for a dialog')
+    parser.add_argument('-j','--workers',type=int,default=os.cpu_count(),help='sessions processed at once in batch mode')
+    parser.add_argument('--pick-rois',action='store_true',help='draw missing ROIs after the batch, then process those sessions')
+    parser.add_argument('--cache-mb',type=int,default=cacheMB,help='size bound of the trace cache, 0 decodes every trial')
+    parser.add_argument('--clear-cache',action='store_true',help='empty the trace cache before running')
+    parser.add_argument('--report-workers',type=int,default=reportWorkers,help='processes drawing figures, 0 for no figures')
+    args = parser.parse_args()
+    reports = ReportPool(args.report_workers) if args.report_workers > 0 else None
+
+    if args.root:
+        if args.clear_cache:
+            traceCache(args.root).invalidate()
+        pending = runBatch(args.root,args.workers,sizeMB=args.cache_mb,reports=reports)
+        if pending and args.pick_rois:
+            pickROIs(args.root,pending)
+            runBatch(args.root,args.workers,pending,args.cache_mb,reports)
+        elif pending:
+            print('Run again with --pick-rois to draw them')
+    else:
+        #%% Select directory with animal data
+        root = Tk()
+        root.withdraw()
+        root.attributes('-topmost', True)
+        pathMaster = filedialog.askdirectory()
+
+        #%% Choose a directory
+        subDirs = sessionDirs(pathMaster)
+        print('Available datasets:')
+        for idx,n in enumerate(subDirs):
+            print('\t{}\t{}'.format(idx,n))
+
+        #Loop over all session directories in pathMaster, decoding with a thread pool
+        if args.clear_cache:
+            traceCache(pathMaster).invalidate()
+        engine = DecodeEngine(workers=nWorkers,cache=traceCache(pathMaster,args.cache_mb))
+        for subDir in subDirs:
+            reportJob(reports,summarizeSession(pathMaster,subDir,engine),subDir)
+        engine.close()
+
+    if reports is not None:
+        reports.close()#waits for the figures still being drawn
@@ -6,6 +6,9 @@ from threading import Thread
 import threading
 import sys
 from data_handler import data_handler
+from rigevents import SerialParser
+from rigbinary import BinaryDecoder, records_to_text
+from rigstore import EventWriter
 
      
 #
@@ -41,17 +44,21 @@ trial['percentCS'] = 10 #percent of trials with CS only presentation
 
 trial['useMotor'] = 'motorOn' #{motorOn, motorLocked, motorFree}
 trial['motorSpeed'] = 500 #steps/sec
+trial['rotaryInterval'] = 20 #ms between rotary prints, lower it in binary mode
 
 trial['sessionDur'] = trial['numTrial'] * trial['trialDur']
 trial['CS_USinterval'] = trial['CSdur'] - trial['USdur']
 
       
 class arduinoRig():
-    def __init__(self):
+    def __init__(self, port=None):
         self.data_handler = data_handler()#for reporting real-time results for plotting                                                                           
         self.animalID = 'noname'
         self.trial = trial
         self.fnameReady = False
+        self.fnameEvent = threading.Event()#set with fnameReady, to wait on it without polling
+        if port:
+            options['serial']['port'] = port#e.g. the pty of rigsim.DueEmulator
                 
         try:
             self.ser = serial.Serial(options['serial']['port'], options['serial']['baud'], timeout=0.25)
@@ -72,15 +79,20 @@ class arduinoRig():
         self.flushing = False
         self.sessionRunning = False
         self.trialRunning = False
-        self.dat = []#Will hold data for realtime plotting
-        thread = Thread(target=self.background_thread, args=())
-        thread.daemon  = True; #as a daemon the thread will stop when *this stops
-        thread.start()
+        self.parser = SerialParser()#frames serial lines and keeps the trial's rotary samples for realtime plotting
+        self.binary = False#packed records instead of ASCII lines, see setBinary()
+        self.decoder = BinaryDecoder()
+        #one command/reply exchange on the port at a time, the GUI sends them from worker threads
+        self.serLock = threading.RLock()
         self.exit_event = threading.Event()
+        self.thread = Thread(target=self.background_thread, args=())
+        self.thread.daemon  = True; #as a daemon the thread will stop when *this stops
+        self.thread.start()
             
         #save all serial data to file, set in setsavepath
         self.savepath = '/home/rpi4EBC/DataEBC/'
         self.filePtr = None
+        self.eventLog = None#typed copy of the serial events next to rig.txt, see rigstore.py
         
         self.arduinoStateList = None #grab from arduino at start of trial, write into each epoch file
         
@@ -89,20 +101,27 @@ class arduinoRig():
         while True:
             if self.sessionRunning or self.flushing:
                 string = self.ser.read(self.ser.in_waiting)
-                if len(string)>0:
+                if len(string)>0 and self.binary:
+                    self.NewSerialBinary(string)
+                elif len(string)>0:
                     string = string.decode('utf-8')
                     print(string,end='')
                     sys.stdout.write('')
                     self.NewSerialData(string)
-                elif self.flushing and self.filePtr:
+                elif self.flushing:
+                    #this thread owns rig.txt and rig.evt, it closes them once the stream has gone quiet
                     time.sleep(0.1)
                     self.ser.flush()
                     self.sessionRunning = False
+                    if self.filePtr:
+                        self.filePtr.close()
+                        self.filePtr = None
+                    if self.eventLog:
+                        self.eventLog.close()
+                        self.eventLog = None
                     self.flushing = False
-                    self.filePtr.close()
-                    self.filePtr = None
-                if self.exit_event.is_set():
-                    break
+            if self.exit_event.is_set() and not self.flushing:
+                break
             time.sleep(0.1)
 
     def NewSerialData(self, string):
@@ -111,45 +130,53 @@ class arduinoRig():
             #save to file
             if self.filePtr:
                 self.filePtr.write(string)
-            #Look for keywords in last two chunks
-            try:
-                cat_string = oldstring + string
-            except:
-                cat_string = string
+            #Only complete lines are parsed, a line split across chunks waits in the parser
+            self.handleEvents(self.parser.feed(string))
+            
+    def NewSerialBinary(self, chunk):
+        #Handling packed records from microcontroller in binary mode
+        rec = self.decoder.feed(chunk)
+        if len(rec)==0:
+            return
+        #rig.txt keeps the ASCII format so analysis code reads both modes
+        if self.filePtr:
+            self.filePtr.write(records_to_text(rec))
+        events = self.parser.feed_records(rec)
+        for millis,event,value in events:
+            print(str(millis)+','+event+','+str(value))
+        self.handleEvents(events)
+            
+    def handleEvents(self, events):
+        for millis,event,value in events:
             #detect session stopping
-            if 'stopSession' in cat_string:
+            if event == 'stopSession':
                 self.flushing = True
                 print('arduinoRig.NewSerialData() detected session stopping')
-            if 'startTrial' in cat_string and not self.trialRunning:
+            elif event == 'startTrial' and not self.trialRunning:
                 self.trial['trialNumber'] += 1
-                self.dat = cat_string
                 self.trialRunning = True
-                
-            if self.trialRunning:
-                self.dat = self.dat + string
-                
-            if 'stopTrial' in cat_string:
-                self.data_handler.parse_rotary(self.dat)
+            elif event == 'stopTrial' and self.trialRunning:
+                #rotary samples were collected as they arrived
+                self.data_handler.set_rotary(*self.parser.trial_rotary())
                 self.data_handler.rotary_ready = True
                 self.trialRunning = False
-                self.dat = []
-                
-
-            #save current string as oldstring
-            oldstring = string
             
     def startSession(self):
         if self.sessionRunning:
             print('Warning: session is already running')
             return 0
             
-        self.trial['sessionNumber'] += 1
-        self.trial['trialNumber'] = 0
-        
-        self.newtrialfile(0)
-        
-        self.sessionRunning = True
-        self.ser.write('<startSession>'.encode())#
+        with self.serLock:
+            self.trial['sessionNumber'] += 1
+            self.trial['trialNumber'] = 0
+            
+            self.newtrialfile(0)
+            
+            self.parser = SerialParser()
+            self.parser.log = self.eventLog
+            self.decoder = BinaryDecoder()
+            self.sessionRunning = True
+            self.ser.write('<startSession>'.encode())#
         print('arduinoRig.startSession()')
         
         return 1
@@ -157,12 +184,14 @@ class arduinoRig():
         
     def stopSession(self):
         # Send stop command to microcontroller, print report
-        self.ser.write('<stopSession>'.encode())
+        with self.serLock:
+            self.ser.write('<stopSession>'.encode())
         print('arduinoRig.stopSession()')
         
         self.flushing = True
         self.kill_flag = False
         self.fnameReady = False
+        self.fnameEvent.clear()
         
     def newtrialfile(self, trialNumber):
         # open a file for this trial
@@ -195,6 +224,7 @@ class arduinoRig():
         if trialNumber==0:
             self.arduinoStateList = self.GetArduinoState()
             self.fnameReady = True
+            self.fnameEvent.set()
 
         self.filePtr = open(sessionFilePath, 'w')
 
@@ -211,6 +241,10 @@ class arduinoRig():
         #
         #header line 2 is column names
         self.filePtr.write('millis,event,value\n')
+        
+        #same header as typed metadata for the event log
+        meta = {'session':self.trial['sessionNumber'], 'trial':self.trial['trialNumber'], 'date':dateStr, 'time':timeStr}
+        self.eventLog = EventWriter(thisSavePath + sessionFileStub + 'rig.evt', meta, self.arduinoStateList)
 
         #
         #each call to self.NewSerialData() will write serial data to this file
@@ -230,8 +264,9 @@ class arduinoRig():
             print("=== dtsc.settrial() key:'" + key + "' val:'" + val + "'")
             self.trial[key] = val
             serialCommand = '<settrial,' + key + ',' + val +'>'
-            self.ser.write(serialCommand.encode())
-            self.emptySerial()
+            with self.serLock:
+                self.ser.write(serialCommand.encode())
+                self.emptySerial()
         else:
             print('\tERROR: arduinoRig:settrial() did not find', key, 'in trial dict')
         
@@ -240,10 +275,11 @@ class arduinoRig():
             print('Warning: trial is already running')
             return 0
 
-        self.ser.write('<getState>'.encode())
-        print("===Arduino Settings===")
-        stateList = self.emptySerial()
-        print("=========Done=========")
+        with self.serLock:
+            self.ser.write('<getState>'.encode())
+            print("===Arduino Settings===")
+            stateList = self.emptySerial()
+            print("=========Done=========")
         
         return stateList
         
@@ -298,8 +334,21 @@ class arduinoRig():
             print('Warning: trial is already running')
             return 0
 
-        self.ser.write('<version>'.encode())
-        self.emptySerial()
+        with self.serLock:
+            self.ser.write('<version>'.encode())
+            self.emptySerial()
+        
+    def setBinary(self, on):
+        '''Switch the Arduino between ASCII lines and packed binary records'''
+        if self.sessionRunning:
+            print('Warning: trial is already running')
+            return 0
+
+        with self.serLock:
+            self.ser.write(('<binary,enable,' + str(int(on)) + '>').encode())
+            self.emptySerial()
+            self.binary = bool(on)
+        return 1
         
     def setsavepath(self, string):
         self.savepath = string
@@ -311,5 +360,7 @@ class arduinoRig():
         self.kill_flag = True
         self.stopSession()
         self.exit_event.set()
-        if "self.fileptr" in locals():
-            self.fileptr.close()
+        #the reader thread flushes the stopSession reply and closes the files before it exits
+        self.thread.join(5)
+        if self.thread.is_alive():
+            print('arduinoRig.end() serial thread is still flushing')
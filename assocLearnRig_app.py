@@ -10,6 +10,8 @@ import time
 import sys
 import signal
 from arduinoRig import arduinoRig
+from liveplot import LivePlot, TrialHeatmap
+import guiloop
 
 #For realtime visualizations
 from matplotlib import cm
@@ -35,46 +37,14 @@ def draw_figure(canvas, figure, loc=(0, 0)):
     figure_canvas_agg.get_tk_widget().pack(side='top', fill='both', expand=1)
     return figure_canvas_agg
     
-def update_plot(ax,vls=np.nan,rot_time=np.nan,rot=np.nan,eb_time=np.nan,eb=np.nan,h=np.nan,vh=np.nan):#Adding whichever elements are available to the plot    
-    #Handling vertical line stimulus plots
-    ymin,ymax = ax.get_ylim()
-    if not vh:
-        vh = [ax.vlines(vls[0],ymin,ymax,linestyle='--',color='black')]
-        vh.append(ax.vlines(vls[0]+vls[1]-vls[2],ymin,ymax,linestyle='--',color='black'))
-        vh.append(ax.vlines(vls[0]+vls[1],ymin,ymax,linestyle='--',color='black'))
-        
-    if isinstance(rot, np.ndarray) and rot.size > 0:
-        rmax, rmin = rot.max(), rot.min()
-        if rmax > ymax or rmin < ymin:
-            [v.remove() for v in vh]
-            ymax, ymin = max(rmax, ymax), min(rmin, ymin)
-            vh = [ax.vlines(vls[0], ymin, ymax, linestyle='--', color='black')]
-            vh.append(ax.vlines(vls[0] + vls[1] - vls[2], ymin, ymax, linestyle='--', color='black'))
-            vh.append(ax.vlines(vls[0] + vls[1], ymin, ymax, linestyle='--', color='black'))
-     
-    #Handling the rotary plots    
-    if not h and not np.isnan(rot).all():
-        h = [ax.plot(rot_time,rot)]
-    elif not np.isnan(rot).all():
-        h.append(ax.plot(rot_time,rot))
-    
-    if len(h)>n2show:
-        h[0][0].remove()
-        h.remove(h[0])
-        [z[0][0].set(color=z[1]) for z in zip(h,cmap_r)]
-    else:
-        [z[0][0].set(color=z[1]) for z in zip(h,cmap_r)]
-        
-    return h,vh
-    
-def clear_plot(ax):
-    #Clear plot and axis handles
-    ax.cla()
-    ax.grid()
-    h=[];vh=[]
-    return h,vh
-    
-
+def preview_image(frame,size=(300,240)):
+    #Half-scale DCT decode of the JPEG, handed to Tk as a binary PGM so there is no PNG encode
+    img = cv2.imdecode(np.frombuffer(frame, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_2)
+    if img is None:
+        return None
+    if (img.shape[1],img.shape[0]) != size:
+        img = cv2.resize(img,size,interpolation=cv2.INTER_NEAREST)
+    return b'P5 %d %d 255\n' % size + img.tobytes()
     
 ####Build the GUI####
 sg.theme("DarkAmber")#BluePurple also has a nice asthetic
@@ -86,6 +56,8 @@ camera_layout = [
     [sg.Image(filename="", key="-IMAGE-",size=(300,240))],
     [sg.Button("Stream",size=(9,1)),sg.Button("End Stream",size=(9,1)),
     sg.Button("Save Stream",size=(9,1)),sg.Button("End Recording",size=(9,1))],
+    [sg.Text("Eye ROI"),sg.Input(size=(22,1),key="ROI"),
+    sg.FileBrowse(key="ROIbrowse",file_types=(("ROI mask","*.npy"),))],
 ]
 trial_layout = [
     ##Arduino, file name, and session controls
@@ -124,7 +96,9 @@ trial_layout = [
 
 graph_layout = [
     [sg.Canvas(size=(300, 200),
-        key='graph')]
+        key='graph'),
+    sg.Canvas(size=(300, 200),
+        key='heat')]
 ]
 
 exit_layout = [
@@ -157,17 +131,30 @@ ax = fig.add_subplot(111)
 ax.set_xlabel("time")
 ax.set_ylabel("some stuff (A.U.)")
 ax.grid()
+ax2 = ax.twinx()#eyelid traces when a ROI is loaded
 fig_agg = draw_figure(graph, fig)
-colors = cm.jet(np.linspace(0,1,5))#We will ultimately show up to five traces at once
+#traces are redrawn by blitting a fixed set of artists, see liveplot.py
+live = LivePlot(fig,fig_agg,ax,ax2,n2show,rotColors=cmap_r,eyeColors=cmap_e)
 vls = [float(values['preCSdur']),float(values['CSdur']),float(values['USdur'])]
-rot=np.nan;rot_time=np.nan;eb=np.nan;eb_time=np.nan;h=[];vh=[];
+live.set_markers(vls)
+#whole-session trials x time panels, one row per trial
+fig_h = Figure(figsize=[4,3])
+axh = fig_h.subplots(2,1,sharex=True)
+axh[1].set_xlabel("time (ms)")
+heat_agg = draw_figure(window['heat'].TKCanvas, fig_h)
+def heat_shape():
+    #rows and time grid of the session the Arduino runs, i.e. the values last sent to it
+    try:
+        return int(float(rig.trial['numTrial'])),np.arange(0,float(rig.trial['trialDur']),10.)
+    except (ValueError,TypeError):
+        print('numTrial/trialDur are not numbers, heatmap falls back to 110 trials of 1000 ms')
+        return 110,np.arange(0,1000,10.)
+heat = TrialHeatmap(fig_h,heat_agg,axh,['wheel speed','eyelid'],*heat_shape())
 
 ####Handling the GUI, rig, and piCamera####
 #Loop booleans and variables
 streaming = False#state of camera output
-frame = None#current frame for output to GUI video
-dispNow = True#to display current fame on GUI video
-lastpicTime = 0#timing when next frame should be output to GUI video
+previewPeriod = 0.05#s between frames output to GUI video
 #What to do if keyboard interrupt called
 def signal_handler(sig, frame):
     if vs is not None:
@@ -178,39 +165,112 @@ def signal_handler(sig, frame):
     sys.exit(0)
 signal.signal(signal.SIGINT,signal_handler)
 
-####GUI read loop
-while True:
-
-    #Update the trial counter where necessary
+####Workers, they post their results to the loop as window events (guiloop.py)
+def poll_rig():
+    #trial counter and finished-trial traces from the rig thread and the eyelid tracker
+    global current_trial
+    events = []
     if current_trial != rig.trial['trialNumber']:
         current_trial = rig.trial['trialNumber']
-        window['trialNum'].update("Trial Number = "+str(current_trial))
-
-    #Get whatever input the user applied to GUI
-    event, values = window.read(timeout=0)
-    
-    #If the camera is on, check if we need to update GUI frame
-    if streaming:
-        now = time.perf_counter()
-        dispTime = now - lastpicTime
-        if dispTime>0.05:
-            frame = vs.read()
-            lastpicTime = time.perf_counter()
-            
-    #Here tell the GUI to look for a flag to update the current plot
+        events.append(('-TRIAL-',current_trial))
     if rig.data_handler.rotary_ready:
         rot,rot_time = rig.data_handler.get_rotary()
         rig.data_handler.rotary_ready = False
-        h,vh = update_plot(ax,vls,rot=rot,rot_time=rot_time,h=h,vh=vh)
-        fig_agg.draw()
+        events.append(('-ROTARY-',(rot_time,rot)))
+    if vs is not None:
+        newEye = vs.getEyelid()
+        if newEye is not None:
+            rig.data_handler.set_cam(newEye[1],newEye[2])
+    if rig.data_handler.cam_ready:
+        eb,eb_time = rig.data_handler.get_cam()
+        rig.data_handler.cam_ready = False
+        events.append(('-EYELID-',(eb_time,eb)))
+    return events
+
+def poll_preview():
+    #JPEG decode of the newest frame happens here, the loop only hands the bytes to Tk
+    if not streaming or vs is None:
+        return None
+    frame = vs.read()#None if no new frame since the last read
+    if frame is None or len(frame)==0:
+        return None
+    imgbytes = preview_image(frame)
+    return [('-PREVIEW-',imgbytes)] if imgbytes is not None else None
+
+def start_session():
+    #returns once the session's file stub exists, instead of spinning on rig.fnameReady
+    rig.startSession()
+    if not rig.fnameEvent.wait(10):
+        print('Session file name not ready after 10 s')
+        return None
+    return rig.getFstub()
+
+def upload(values):
+    #all keys in one go, a session start or state request waits for the whole upload
+    with rig.serLock:
+        if values['DTSC']:
+            rig.settrial('isDTSC',1)
+        elif values['DEC']:
+            rig.settrial('isDTSC',0)
+        for item in values.items():
+            if item[0] not in ['Animal','DTSC','DEC','graph','heat','ROI','ROIbrowse']:
+                rig.settrial(item[0],item[1])
+                time.sleep(0.001)
+
+RIG_BUTTONS = ("Start Session","Upload to Microcontroller","Current Microcontroller settings")
+def rig_busy(busy):
+    #no second rig job until the worker's result is back
+    for key in RIG_BUTTONS:
+        window[key].update(disabled=busy)
+
+rigPoller = guiloop.Poller(window,poll_rig,0.01)
+previewPoller = guiloop.Poller(window,poll_preview,previewPeriod)
+rigPoller.start()
+previewPoller.start()
+loopLatency = guiloop.LatencyLog()#handling time of one event
+queueLatency = guiloop.LatencyLog()#worker post to loop pickup
+
+####GUI read loop
+while True:
+
+    #Blocks until the user or a worker posts something
+    event, values = window.read(timeout=200)
+    start = time.perf_counter()
+    if event in ('-TRIAL-','-ROTARY-','-EYELID-','-PREVIEW-','-FSTUB-','-UPLOADED-','-STATE-'):
+        posted,result = values[event]
+        queueLatency.add(start-posted)
+    
+    ##Worker results
+    if event == '-TRIAL-':
+        window['trialNum'].update("Trial Number = "+str(result))
+    elif event == '-ROTARY-':
+        rot_time,rot = result
+        live.add_rotary(rot_time,rot)
+        heat.add('wheel speed',rot_time,rot)
+    elif event == '-EYELID-':
+        eb_time,eb = result
+        live.add_eyelid(eb_time,eb)
+        heat.add('eyelid',eb_time,eb)
+    elif event == '-PREVIEW-':
+        if streaming:
+            window["-IMAGE-"].update(data=result)
+    elif event == '-FSTUB-':
+        rig_busy(False)
+        if result is not None and vs is not None:
+            vs.passFstub(result)
+    elif event == '-UPLOADED-':
+        rig_busy(False)
+        print('Uploaded to microcontroller')
+    elif event == '-STATE-':
+        rig_busy(False)#GetArduinoState prints the state itself
     
     ##Button options, left panel
-    if event == "End Program" or event == sg.WIN_CLOSED:
+    elif event == "End Program" or event == sg.WIN_CLOSED:
         break
     elif event == "Stream":
         if not streaming:
             if vs is None:
-                vs = pvid.piCamHandler()
+                vs = pvid.piCamHandler(roi=values['ROI'] or None)
             try:
                 n = int(values['numTrial'])
             except:
@@ -227,45 +287,35 @@ while True:
         if vs is not None:
             vs.endStream()
         streaming = False
-        frame = None
         print("End Stream")
     elif event == "Save Stream":
-        if streaming and not vs.saving.value:
+        if streaming and not vs.isSaving():
             vs.guiStartRecording()
             print("Save Stream")
     elif event == "End Recording":
-        if streaming and vs.saving.value:
+        if streaming and vs.isSaving():
             vs.guiStopRecording()
             print("End Recording")
     ##Button options right panel
     elif event == "Start Session":
-        rig.startSession()
-        h,vh = clear_plot(ax)
-        h,vh = update_plot(ax,vls,h=h,vh=vh)
-        fig_agg.draw()
-        while not rig.fnameReady:
-            pass
-        fStub = rig.getFstub()
-        if vs is not None:
-            vs.passFstub(fStub)
+        live.clear()
+        live.set_markers(vls)
+        heat.reset(*heat_shape())
+        rig_busy(True)
+        guiloop.run_async(window,'-FSTUB-',start_session)
     elif event == "Stop Session":
         rig.stopSession()
     elif event == "Set":
         rig.animalID = values['Animal']
         print("Set animalID: ",values['Animal'])
     elif event == "Upload to Microcontroller":
-        if values['DTSC']:
-            rig.settrial('isDTSC',1)
-        elif values['DEC']:
-            rig.settrial('isDTSC',0)
-        for item in values.items():
-            if item[0] not in ['Animal','DTSC','DEC','graph']:
-                rig.settrial(item[0],item[1])
-                time.sleep(0.001)
-                
+        rig_busy(True)
+        guiloop.run_async(window,'-UPLOADED-',upload,dict(values))
         vls = [float(values['preCSdur']),float(values['CSdur']),float(values['USdur'])]
+        live.set_markers(vls)
     elif event == "Current Microcontroller settings":
-        rig.GetArduinoState()
+        rig_busy(True)
+        guiloop.run_async(window,'-STATE-',rig.GetArduinoState)
     
     # LED controls
     elif event == "Set LED":
@@ -279,18 +329,17 @@ while True:
     elif event == "LED Off":
         led_pwm.ChangeDutyCycle(0)
         print("LED turned off")
-
-    ##Process and display the current frame capture in GUI if streaming
-    if streaming and frame is not None:
-        if len(frame)>0:
-            data = cv2.resize(cv2.imdecode(np.frombuffer(frame, dtype=np.uint8), cv2.IMREAD_GRAYSCALE),(300,240))
-            imgbytes = cv2.imencode('.png',data)[1].tobytes()
-            window["-IMAGE-"].update(data=imgbytes)
-        frame = None
     
-    time.sleep(0.005)
+    if event != sg.TIMEOUT_EVENT:
+        loopLatency.add(time.perf_counter()-start)
     
 ##Do this when the program is ended
+rigPoller.stop()
+previewPoller.stop()
+print('Loop latency per event (ms):',loopLatency)
+print('Worker to loop latency (ms):',queueLatency)
+print('Plot update latency (ms):',live.latency())
+print('Heatmap update latency (ms):',heat.latency())
 window.close()
 if vs is not None:
     vs.end()
@@ -0,0 +1,203 @@
+#Timing of the data path on synthetic sessions (rigfixtures.py)
+#
+#   python benchmarks.py [--frames 1000] [--width 640 --height 480] [--fps 100]
+#                        [--trials 110] [--legacy] [--out bench.json] [--baseline old.json]
+#
+#Each benchmark runs on fixtures written to a temporary directory: one trial's
+#camera file and a session's serial stream. The time is the best of --repeat
+#runs, peak memory is the tracemalloc peak of one more run (numpy and OpenCV
+#buffers included). Results are saved as JSON, and with --baseline every
+#throughput is compared to an earlier run. parse_rotary_pandas is the parser
+#data_handler used before, checked against parse_rotary before it is timed.
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import cv2
+import rigfixtures
+from framedecode import mjpg2array
+from data_handler import data_handler
+from rigevents import rotary_trials
+from sessiontraces import SessionTraces
+from trialalign import align_trials, flatten, summarize
+
+
+def measure(func, items, unit, repeat=3):
+    '''Best time of repeat calls of func(), throughput in unit/s and the peak traced memory'''
+    func()#warm up, first-call imports and caches don't count
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds':best, 'items':items, 'unit':unit, 'throughput':items/best, 'peakMB':peak/2**20}
+
+
+def bench_mjpg2array(fx, args):
+    return measure(lambda: mjpg2array(fx['camFile']), fx['nFrames'], 'frames', args.repeat)
+
+
+def bench_process_cam(fx, args):
+    dh = data_handler()
+    return measure(lambda: dh.process_cam(fx['camFile'], fx['roi']), fx['nFrames'], 'frames', args.repeat)
+
+
+def bench_parse_rotary(fx, args):
+    dh = data_handler()
+    trials = fx['trialTexts']
+    lines = sum(t.count('\n') for t in trials)
+    return measure(lambda: [dh.parse_rotary(t) for t in trials], lines, 'lines', args.repeat)
+
+
+def split_trials(text):
+    '''Serial text of each trial in a rig.txt, from a startTrial line to its stopTrial line'''
+    trials = []
+    for chunk in text.split('startTrial')[1:]:
+        stop = chunk.find('stopTrial')
+        if stop >= 0:
+            trials.append('0,startTrial' + chunk[:chunk.find('\n', stop) + 1])
+    return trials
+
+
+def parse_rotary_pandas(dh, text):
+    '''The pandas parser data_handler.parse_rotary replaced, returns (time, wheelVel)'''
+    import io
+    import pandas as pd
+    df = pd.read_csv(io.StringIO(text), on_bad_lines='skip', names=['millis', 'event', 'value'])
+    startIdx = np.where(df.event == 'startTrial')[0] + 1
+    stopIdx = np.where(df.event == 'stopTrial')[0] + 1
+    subDf = df[(df.index > startIdx[-1]) & (df.index < stopIdx[0]) & (df.event == 'rotary')]
+    millis = pd.to_numeric(subDf.millis).to_numpy().astype('float64')#str column if a garbled line got in
+    time = millis - millis[0]
+    pollrate = np.mean(np.diff(time))
+    wheelVel = pd.to_numeric(subDf.value).to_numpy().astype('float64') * dh.count2cm / (pollrate / 1000)
+    wheelVel[wheelVel > 1000] = np.nan
+    return time, wheelVel
+
+
+def bench_parse_rotary_pandas(fx, args):
+    dh = data_handler()
+    trials = fx['trialTexts']
+    for text in trials:
+        rot = dh.parse_rotary(text)
+        if rot.nBad:
+            continue#the two skip garbled lines differently
+        time, vel = parse_rotary_pandas(dh, text)
+        #the pandas version skipped the first line after startTrial, a wheel sample if no event came first
+        skip = len(rot.millis) - len(time)
+        assert skip in (0, 1) and np.array_equal(rot.millis[skip:] - rot.millis[skip], time)
+    lines = sum(t.count('\n') for t in trials)
+    return measure(lambda: [parse_rotary_pandas(dh, t) for t in trials], lines, 'lines', args.repeat)
+
+
+def bench_NewSerialData(fx, args):
+    #the rig's reader thread hands over whatever arrived, about 256 bytes at 115200 baud and 20 ms
+    from arduinoRig import arduinoRig
+    from rigevents import SerialParser
+    rig = arduinoRig()
+    #without stopSession, which would set the reader thread flushing a serial port there isn't
+    text = ''.join(l for l in fx['serialText'].splitlines(True) if ',stopSession,' not in l)
+    chunks = [text[i:i+256] for i in range(0, len(text), 256)]
+    out = os.path.join(fx['dir'], 'NewSerialData.txt')
+    def run():
+        rig.parser = SerialParser()
+        rig.trialRunning = False
+        rig.filePtr = open(out, 'w')
+        for chunk in chunks:
+            rig.NewSerialData(chunk)
+        rig.filePtr.close()
+        rig.filePtr = None
+    return measure(run, text.count('\n'), 'lines', args.repeat)
+
+
+def bench_aggregation(fx, args):
+    #what summarizeSessions does once the traces are extracted: split the wheel into trials,
+    #collect the eyelid traces, align both on timeBins, per trial type statistics, data frame
+    millis, events, values = fx['eventTable']
+    eyes = fx['eyeTraces']
+    kinds = np.array(fx['kinds'])
+    p = fx['params']
+    timeBins = np.arange(0, p['preCSdur'] + p['CS_USinterval'] + 500, 1)
+    def run():
+        rotTrials = rotary_trials(millis, events, values)
+        traces = SessionTraces(len(eyes))
+        for idx, (t, eb) in enumerate(eyes):
+            traces.append(idx, t, eb, kinds[idx])
+        eye = traces.align(timeBins)
+        rot = align_trials(*flatten(rotTrials[:len(eyes)]), timeBins)
+        summarize(timeBins, p['preCSdur'], kinds[:len(eye)], eye, rot)
+        traces.to_dataframe()
+    return measure(run, len(eyes), 'trials', args.repeat)
+
+
+BENCHMARKS = {'mjpg2array':bench_mjpg2array, 'process_cam':bench_process_cam, 'parse_rotary':bench_parse_rotary,
+              'parse_rotary_pandas':bench_parse_rotary_pandas, 'NewSerialData':bench_NewSerialData,
+              'aggregation':bench_aggregation}
+
+
+def fixtures(path, args):
+    p = rigfixtures.session_params(numTrial=args.trials, trialDur=int(args.frames/args.fps*1000))
+    events = list(rigfixtures.session_events(p))
+    jpegs = rigfixtures.eye_images((args.width, args.height))
+    frames = rigfixtures.trial_frames(p, args.fps, jpegs)
+    camFile = os.path.join(path, 'cam_trial1.data')
+    rigfixtures.write_frames(camFile, frames, 1, args.legacy)
+    roi = np.zeros((args.height, args.width))
+    roi[args.height*2//5:args.height*3//5, args.width//3:args.width*2//3] = 1
+    serialText = rigfixtures.serial_text(events, garbled=0.001)
+    kinds = [name for _, name, _ in events if name in ('CS', 'US', 'CS_US')]
+    #eyelid traces as process_cam returns them, at the camera rate over each trial
+    t = np.arange(len(frames))*1000/args.fps - 20
+    eyeTraces = [(t, np.cos(t/100 + i)) for i in range(len(kinds))]
+    return {'dir':path, 'params':p, 'camFile':camFile, 'nFrames':len(frames), 'roi':roi,
+            'serialText':serialText, 'trialTexts':split_trials(serialText),
+            'eventTable':(np.array([e[0] for e in events], dtype=float), np.array([e[1] for e in events], dtype=object),
+                          np.array([e[2] for e in events], dtype=float)),
+            'kinds':kinds, 'eyeTraces':eyeTraces}
+
+
+def compare(results, baseline):
+    for name, r in results.items():
+        old = baseline.get('results', {}).get(name)
+        if old:
+            print('%-19s %8.3gx throughput  %8.3gx peak memory' % (name, r['throughput']/old['throughput'],
+                                                                  r['peakMB']/max(old['peakMB'], 1e-9)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the rig data path on synthetic sessions')
+    parser.add_argument('--frames', type=int, default=1000, help='frames in the camera trial')
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--fps', type=float, default=100)
+    parser.add_argument('--trials', type=int, default=110, help='trials in the serial session')
+    parser.add_argument('--legacy', action='store_true', help='camera file in the old pickled format')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='run just these')
+    parser.add_argument('--out', default='bench_%s.json' % time.strftime('%Y%m%d_%H%M%S'))
+    parser.add_argument('--baseline', help='results file of an earlier run to compare with')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as path:
+        fx = fixtures(path, args)
+        for name in args.only or BENCHMARKS:
+            r = results[name] = BENCHMARKS[name](fx, args)
+            print('%-19s %9.4f s  %10.1f %s/s  peak %7.1f MB' % (name, r['seconds'], r['throughput'], r['unit'], r['peakMB']))
+    run = {'time':time.strftime('%Y-%m-%d %H:%M:%S'), 'args':vars(args), 'results':results,
+           'platform':{'machine':platform.machine(), 'python':platform.python_version(), 'numpy':np.__version__,
+                       'opencv':cv2.__version__, 'cpus':os.cpu_count()}}
+    with open(args.out, 'w') as fo:
+        json.dump(run, fo, indent=1)
+    print('saved ' + args.out)
+    if args.baseline:
+        with open(args.baseline) as fi:
+            compare(results, json.load(fi))
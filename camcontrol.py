@@ -0,0 +1,140 @@
+#Shared control block and trial state machine for the camera processes
+#
+#All camera state lives in one ctypes structure in shared memory guarded by a
+#single multiprocessing Condition. Writers change it under the lock and
+#notify, so MovieSaver and PiVideoStream sleep on the condition instead of
+#polling flags, and the GPIO callback never talks to a Manager process.
+#
+#   IDLE -> ARMED      trigger edge (or GUI), new file name and trial number
+#   ARMED -> RECORDING PiVideoStream has taken the trigger, frames are saved
+#   RECORDING -> FLUSHING trigger falls, saver drains what is left
+#   FLUSHING -> DONE   file closed; DONE behaves as IDLE for the next trigger
+import ctypes
+import multiprocessing as mp
+
+IDLE, ARMED, RECORDING, FLUSHING, DONE = range(5)
+STATE_NAMES = ('idle', 'armed', 'recording', 'flushing', 'done')
+
+
+class _Block(ctypes.Structure):
+    _fields_ = [('state', ctypes.c_int),
+                ('trial', ctypes.c_int),
+                ('stream', ctypes.c_bool),
+                ('kill', ctypes.c_bool),
+                ('triggerTime', ctypes.c_double),#frame clock zero, may be shifted by PiVideoStream
+                ('edgeTime', ctypes.c_double),#perf_counter at the trigger edge itself
+                ('latency', ctypes.c_double),#trigger edge to first saved frame, s
+                ('latencyMax', ctypes.c_double),
+                ('latencySum', ctypes.c_double),
+                ('latencyN', ctypes.c_int),
+                ('fname', ctypes.c_char*512),
+                ('fStub', ctypes.c_char*512)]
+
+
+class CamControl():
+    def __init__(self, fname='noname.data', fStub='noStub'):
+        self.block = mp.RawValue(_Block)
+        self.cond = mp.Condition()
+        self.block.state = IDLE
+        self.block.stream = True
+        self.block.fname = fname.encode()
+        self.block.fStub = fStub.encode()
+
+    #Lock-free reads: single fields are written atomically under the lock
+    @property
+    def state(self):
+        return self.block.state
+
+    @property
+    def kill(self):
+        return self.block.kill
+
+    @property
+    def stream(self):
+        return self.block.stream
+
+    @property
+    def triggerTime(self):
+        return self.block.triggerTime
+
+    @property
+    def edgeTime(self):
+        return self.block.edgeTime
+
+    @property
+    def trial(self):
+        return self.block.trial
+
+    @property
+    def fname(self):
+        return self.block.fname.decode()
+
+    @property
+    def fStub(self):
+        return self.block.fStub.decode()
+
+    def set(self, **fields):
+        '''Change any fields of the block and wake everyone waiting on it'''
+        with self.cond:
+            for key, val in fields.items():
+                if isinstance(val, str):
+                    val = val.encode()
+                setattr(self.block, key, val)
+            self.cond.notify_all()
+
+    def arm(self, fname, trial, triggerTime, wait=0):
+        '''Trigger edge: arms a new trial from idle/done
+
+        If the saver is still flushing the last trial this waits up to `wait`
+        seconds for it to finish, by default not at all. Returns False if a
+        trial is still in progress.
+        '''
+        with self.cond:
+            self.cond.wait_for(lambda: self.block.state != FLUSHING, wait)
+            if self.block.state not in (IDLE, DONE):
+                return False
+            self.block.fname = fname.encode()
+            self.block.trial = trial
+            self.block.triggerTime = triggerTime
+            self.block.edgeTime = triggerTime
+            self.block.state = ARMED
+            self.cond.notify_all()
+        return True
+
+    def stop(self):
+        '''Trigger falls: armed/recording -> flushing, False if nothing was recording'''
+        with self.cond:
+            if self.block.state not in (ARMED, RECORDING):
+                return False
+            self.block.state = FLUSHING
+            self.cond.notify_all()
+        return True
+
+    def transition(self, old, new):
+        '''Move old -> new atomically, False if the block was not in old'''
+        with self.cond:
+            if self.block.state != old:
+                return False
+            self.block.state = new
+            self.cond.notify_all()
+        return True
+
+    def wait_for(self, states, timeout=None):
+        '''Sleep until the state is one of states or kill is set, returns the state'''
+        with self.cond:
+            self.cond.wait_for(lambda: self.block.kill or self.block.state in states, timeout)
+            return self.block.state
+
+    def add_latency(self, latency):
+        with self.cond:
+            b = self.block
+            b.latency = latency
+            b.latencyMax = max(b.latencyMax, latency)
+            b.latencySum += latency
+            b.latencyN += 1
+
+    def latency_stats(self):
+        '''Trigger edge to first saved frame in ms: last, mean and max over the session'''
+        b = self.block
+        n = max(b.latencyN, 1)
+        return {'last':b.latency*1000, 'mean':b.latencySum/n*1000, 'max':b.latencyMax*1000, 'n':b.latencyN}
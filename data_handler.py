@@ -1,107 +1,83 @@
 # Data visualization utility
+import re
+from collections import namedtuple
 import numpy as np
-import pickle
-import cv2
-import pandas as pd
-import io
+from framedecode import DecodeEngine
+from rigevents import COUNT2CM, wheel_velocity
+
+# Rotary lines of the serial text, and lines that are not millis,event,value at all
+# ('Motor free', half-sent or merged lines)
+ROTARY_RE = re.compile(r'^(\d+),rotary,(-?\d+)\r?$', re.M)
+GARBLED_RE = re.compile(r'^(?!\d+,\w+,-?\d+\r?$)[^\r\n]*\S', re.M)
+
+# One trial of wheel data: millis from the first sample, cm/s, mean ms between samples,
+# lines skipped as garbled, polls missed (gaps over 1.5x the median interval), and whether
+# both startTrial and stopTrial were in the text
+RotaryTrial = namedtuple('RotaryTrial', ['millis', 'velocity', 'pollrate', 'nBad', 'nDropped', 'complete'])
 
 
 # Note that we may to need to run this as a thread or multi-process so as not to interfere with the recording of the data
 class data_handler():
-    def __init__(self):
+    def __init__(self, decode_workers=1):
         self.rotary_ready = False
         self.cam_ready = False
         self.rot = []
         self.rot_time = []
         self.counter = 0
 
-        # Wheel information for converting pulse/time to cm/s
-        circ = 15.24 * np.pi  # Dimensions of Aeromat roller
-        counts = 2000 * 4  # Value for a 2000 PPR rotary encoder
-        self.count2cm = circ / counts
-
-    def parse_rotary(self, df):
-
-        try:
-            # Get timing of trials and rate arduino polls rotary encoder
-            s2 = df
-            s = io.StringIO(df)
-            df = pd.read_csv(s, on_bad_lines='skip', names=['millis', 'event', 'value'])
-            startIdx = np.where(df.event == 'startTrial')[0] + 1
-            stopIdx = np.where(df.event == 'stopTrial')[0] + 1
-            subDf = df[(df.index > startIdx[-1]) & (df.index < stopIdx[0]) & (df.event == 'rotary')]
-            subDf.loc[:, 'millis'] = subDf['millis'].astype('float64')
-            subDf.loc[:, 'value'] = subDf['value'].astype('float64')
-            # subDf.to_csv("sample"+str(self.counter)+".csv")
-            time = subDf.millis.to_numpy() - subDf.millis.to_numpy()[0]  # in ms
-            pollrate = np.mean(np.diff(time))
-
-            # Convert counts to cm/s
-            wheelVel = subDf['value'].to_numpy() * self.count2cm / (pollrate / 1000)
-            wheelVel[wheelVel > 1000] = np.nan
-
-            self.rot = wheelVel
-            self.rot_time = time
-            self.counter += 1
-        except Exception as e:
-            # df.to_csv("badsample"+str(self.counter)+".csv")
-            # text_file = open("badsample"+str(self.counter)+".txt", "w")
-            # n = text_file.writelines(s2)
-            # text_file.close()
-            # self.counter += 1
-            # print('Missed file<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<')
-            print(e)
+        # Wheel information for converting pulse/time to cm/s, shared with the analysis (rigevents)
+        self.count2cm = COUNT2CM
+
+        # JPEG decoding for eyelid traces, one worker keeps it inline on the Pi
+        self.engine = DecodeEngine(workers=decode_workers)
+
+    def parse_rotary(self, text):
+        # Wheel data of the last trial in a chunk of serial text, returns a RotaryTrial (None if too short)
+        # Samples run from the last startTrial to the stopTrial after it; a trial missing either
+        # end uses the start/end of the text and comes back with complete=False
+        # Cut the trial out with string searches, only its lines go through the regexes
+        start = text.rfind(',startTrial,')
+        begin = 0 if start < 0 else text.find('\n', start) + 1 or len(text)
+        stop = text.find(',stopTrial,', begin)
+        end = len(text) if stop < 0 else text.rfind('\n', 0, stop) + 1
+        trial = text[begin:end]
+
+        samples = np.array(ROTARY_RE.findall(trial), dtype=np.int64).reshape(-1, 2)
+        rot = self.set_rotary(samples[:, 0], samples[:, 1])
+        if rot is None:
+            return None
+        return rot._replace(nBad=len(GARBLED_RE.findall(trial)), complete=start >= 0 and stop >= 0)
+
+    def set_rotary(self, millis, counts):
+        # Rotary samples already split out of the serial stream (rigevents.SerialParser)
+        if len(millis) < 2:
+            print('data_handler.set_rotary() got %d rotary samples, skipping trial' % len(millis))
+            return None
+        time = (millis - millis[0]).astype('float64')  # in ms
+        dt = np.diff(time)
+        nDropped = int(np.sum(dt > 1.5 * np.median(dt)))
+
+        # Convert counts to cm/s, same conversion as rigevents.rotary_trials in the analysis
+        wheelVel, pollrate = wheel_velocity(time, counts)
+
+        self.rot = wheelVel
+        self.rot_time = time
+        self.counter += 1
+        return RotaryTrial(time, wheelVel, pollrate, 0, nDropped, True)
 
     def get_rotary(self):
         return self.rot, self.rot_time
 
     def process_cam(self, filename, roi):
-        # Open and unpickle the bytes file
-        filehand = open(filename, 'rb')
-        stream = []
-        while 1:
-            try:
-                stream.append(pickle.load(filehand))
-            except EOFError:
-                break
-        filehand.close()
-        # Removing the extra list packaging, getting nImages points
-        stream = [x for l in stream for x in l]
-        lists = [list(t) for t in zip(*stream)]
-        self.eb_time = np.array(lists[0]) * 1000  # convert to millis
-        stream = lists[1]
-        nIm = len(stream)
-
-        # Reading through the binary file to parse image data
-        idx = 0  # for buidling the np image array
-        for img in stream:
-            # grab frame start and end on hex stream
-            a = img.find(b'\xff\xd8')
-            b = img.find(b'\xff\xd9')
-            if a != -1 and b != -1:
-                jpg = img[a:b + 2]
-                # stream = stream[b+2:]
-                data = cv2.imdecode(np.frombuffer(jpg, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
-
-                if idx == 0:
-                    # For plot of line scan
-                    sizeWH = data.shape
-                    # Full output array
-                    mov = np.empty([int(sizeWH[0]), int(sizeWH[1]), nIm], dtype=np.uint8)
-                    mov[:, :, 0] = data
-                else:
-                    mov[:, :, idx] = data
-                idx += 1
-
-            elif a == -1 or b == -1:
-                pass
-
-        # permute the data to put time element first
-        imArray = np.transpose(mov, (2, 0, 1))
-        self.eb = imArray.reshape([len(imArray), -1]) @ roi.reshape(np.product(roi.shape))
+        # Decode and reduce frames against the ROI without building the movie
+        self.eb, self.eb_time = self.engine.eyelid_trace(filename, roi)  # eb_time in millis
+
+    def set_cam(self, eb, eb_time):
+        # Trace computed during capture (pivideostream.EyelidTracker), no file re-read
+        self.eb = eb
+        self.eb_time = eb_time
+        self.cam_ready = True
 
     def get_cam(self):
         return self.eb, self.eb_time
 
-
-
@@ -151,6 +151,17 @@ long int val = 0;
 char cmd[16];
 char cmd2[16];
 
+//Binary output mode, switched on with <binary,enable,1> and off with <binary,enable,0>
+//Each serialOut record is 12 bytes: 0xA5 0x5A, event code (uint8), millis (uint32),
+//value (int32), CRC-8 (poly 0x07) over code/millis/value. Little endian.
+//Codes index eventNames, keep in sync with EVENT_NAMES in rigbinary.py
+boolean binaryOut = false;
+const char* eventNames[] = {"unknown","rotary","startTrial","stopTrial","startSession",
+  "stopSession","CS_US","CS","US","ledCSon","ledCSoff","USoff","CRcountOn","CRcount",
+  "bigUSon","medUSon","smallUSon","NotStill","Still","startITI","ITIDuration","2Pon",
+  "2Poff","newFile","sessionDur","numTrial","trialDur","motionDetectOn","Moved"};
+const byte numEventNames = sizeof(eventNames)/sizeof(eventNames[0]);
+
 /////////////////////////////////////////////////////////////
 /*Setup, mostly declaring default structure values*/
 void setup()
@@ -365,7 +376,42 @@ void wireOut(int state2change,int newStateVal){
 
 //Outputting info over the serial port
 void serialOut(unsigned long now, String str, signed long val) {
-  Serial.println(String(now) + "," + str + "," + String(val));
+  if (binaryOut) {
+    binaryRecord(now, eventCode(str), val);
+  } else {
+    Serial.println(String(now) + "," + str + "," + String(val));
+  }
+}
+
+byte eventCode(const String &str) {
+  for (byte i = 1; i < numEventNames; i++) {
+    if (str == eventNames[i]) {
+      return i;
+    }
+  }
+  return 0;
+}
+
+byte crc8(const byte *data, byte len) {
+  byte crc = 0;
+  for (byte i = 0; i < len; i++) {
+    crc ^= data[i];
+    for (byte b = 0; b < 8; b++) {
+      crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : (crc << 1);
+    }
+  }
+  return crc;
+}
+
+void binaryRecord(unsigned long now, byte code, signed long val) {
+  byte rec[12];
+  rec[0] = 0xA5;
+  rec[1] = 0x5A;
+  rec[2] = code;
+  memcpy(rec + 3, &now, 4);
+  memcpy(rec + 7, &val, 4);
+  rec[11] = crc8(rec + 2, 9);
+  Serial.write(rec, 12);
 }
 
 //Respond to incoming commands over serial
@@ -395,6 +441,11 @@ void SerialIn(unsigned long now) {//,String str
     GetState();
   } else if (strcmp(cmd,"settrial") == 0) {
     SetTrial();
+  } else if (strcmp(cmd,"binary") == 0) {
+    //acknowledge in ASCII before switching so the host can read it either way
+    Serial.println("binaryOut=" + String(val));
+    Serial.flush();
+    binaryOut = val;
   }
   else {
     Serial.println("SerialIn() did not handle: '" + String(cmd) + "'");
@@ -424,6 +475,8 @@ void GetState() {
   Serial.println("useMotor=" + String(trial.useMotor));
   Serial.println("motorSpeed=" + String(trial.motorSpeed));
   
+  Serial.println("rotaryInterval=" + String(rotaryencoder.printInterval));
+  Serial.println("binaryOut=" + String(binaryOut));
   Serial.println("versionStr=" + String(versionStr));
 
 }
@@ -483,6 +536,9 @@ void SetTrial( ){//String nameStr, String strValue
     Serial.println("trial.motorSpeed=" + String(trial.motorSpeed));
     ////I2C-directed////
     wireOut(1,trial.motorSpeed);
+  } else if (strcmp(cmd2,"rotaryInterval") == 0) {
+    rotaryencoder.printInterval = val;
+    Serial.println("rotaryencoder.printInterval=" + String(rotaryencoder.printInterval));
   }else {
     Serial.println("SetTrial() did not handle '" + String(cmd2) + "'");
   }
@@ -0,0 +1,313 @@
+#Decoding of stored camera frames and reduction to eyelid traces
+#
+#Frames are decoded one at a time (or in small batches) straight from the
+#frame store and reduced against the ROI as they come, so extracting a trace
+#costs about one frame of memory instead of the whole [nIm,H,W] movie.
+import os
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import cv2
+from framestore import open_frames, jpeg_slice
+
+#bump when a change to decoding or reduction changes the traces, cached traces are keyed on it
+EXTRACTOR_VERSION = 1
+
+
+def iter_frames(frames, flags=cv2.IMREAD_GRAYSCALE):
+    '''Yield (ts, image) for each frame of an open reader, image is None for frames without SOI/EOI'''
+    ts = frames.ts
+    for idx in range(len(frames)):
+        jpg = jpeg_slice(frames.frame(idx))
+        img = cv2.imdecode(jpg, flags) if jpg is not None else None
+        yield ts[idx], img
+
+
+def iter_batches(frames, batch=16, flags=cv2.IMREAD_GRAYSCALE):
+    '''Yield (ts, valid, stack) with up to `batch` decoded frames per step'''
+    ts = frames.ts
+    stack = None
+    for start in range(0, len(frames), batch):
+        stop = min(start+batch, len(frames))
+        valid = np.zeros(stop-start, dtype=bool)
+        for i, (_, img) in enumerate(iter_frames(_Slice(frames, start, stop), flags)):
+            if img is None:
+                continue
+            if stack is None:
+                stack = np.empty((batch,)+img.shape, dtype=np.uint8)
+            stack[i] = img
+            valid[i] = True
+        yield ts[start:stop], valid, (stack[:stop-start] if stack is not None else None)
+
+
+class _Slice():
+    #frames [start, stop) of a reader, enough of the reader interface for iter_frames
+    def __init__(self, frames, start, stop):
+        self.frames = frames
+        self.start = start
+        self.stop = stop
+
+    @property
+    def ts(self):
+        return self.frames.ts[self.start:self.stop]
+
+    def frame(self, idx):
+        return self.frames.frame(self.start+idx)
+
+    def __len__(self):
+        return self.stop-self.start
+
+
+#libjpeg DCT scaling, decoding at 1/scale of the sensor resolution
+REDUCED_FLAGS = {1:cv2.IMREAD_GRAYSCALE, 2:cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                 4:cv2.IMREAD_REDUCED_GRAYSCALE_4, 8:cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+
+class RoiReducer():
+    '''Reduces decoded frames to frame @ roi over the ROI bounding box only
+
+    Pixels outside the box are zero in the mask, so the full-scale result is
+    the same as the dot product over the whole frame. With scale>1 frames
+    are decoded at reduced size and the mask is area-resampled to match,
+    times scale**2 so the trace keeps the full-resolution units.
+    '''
+    def __init__(self, roi, scale=1):
+        if scale not in REDUCED_FLAGS:
+            raise ValueError('scale must be one of ' + str(sorted(REDUCED_FLAGS)))
+        self.roi = np.asarray(roi, dtype=float)
+        self.scale = scale
+        self.flags = REDUCED_FLAGS[scale]
+        self.shape = None
+        self.box = None
+        self.mask = None
+
+    def _build(self, shape):
+        roi = self.roi
+        if self.scale > 1:
+            roi = cv2.resize(roi, (shape[1], shape[0]), interpolation=cv2.INTER_AREA) * self.scale**2
+        rows = np.flatnonzero(roi.any(axis=1))
+        cols = np.flatnonzero(roi.any(axis=0))
+        if len(rows):
+            self.box = (slice(rows[0], rows[-1]+1), slice(cols[0], cols[-1]+1))
+        else:
+            self.box = (slice(0, 0), slice(0, 0))
+        self.mask = np.ascontiguousarray(roi[self.box]).reshape(-1)
+        self.shape = shape
+
+    def __call__(self, img):
+        if img.shape != self.shape:
+            self._build(img.shape)
+        return img[self.box].reshape(-1) @ self.mask
+
+    def reduce_stack(self, stack):
+        if stack.shape[1:] != self.shape:
+            self._build(stack.shape[1:])
+        crop = stack[(slice(None),)+self.box]
+        return crop.reshape([len(stack), -1]) @ self.mask
+
+
+def eyelid_trace(filename, roi, batch=1, scale=1):
+    '''Trace of frame @ roi for one trial file, returns (trace, ts in ms)
+
+    Matches imArray.reshape([nIm,-1]) @ roi.reshape(-1) from the old readers
+    but only ever holds `batch` frames. Frames without JPEG markers give nan
+    so the trace stays aligned with ts. scale=2,4,8 decodes at reduced size,
+    see compare_scales() for what that costs in accuracy.
+    '''
+    reducer = RoiReducer(roi, scale)
+    frames = open_frames(filename)
+    ts = frames.ts
+    if batch <= 1:
+        trace = _trace_range(frames, 0, len(frames), reducer)
+    else:
+        trace = np.full(len(frames), np.nan)
+        start = 0
+        for bts, valid, stack in iter_batches(frames, batch, reducer.flags):
+            if stack is not None:
+                vals = reducer.reduce_stack(stack)
+                trace[start:start+len(bts)][valid] = vals[valid]
+            start += len(bts)
+    frames.close()
+    return trace, ts
+
+
+def _trace_range(frames, start, stop, reducer):
+    #frames [start, stop) reduced by a RoiReducer; frames may be a file name
+    #so process pool workers open their own reader
+    opened = isinstance(frames, str)
+    if opened:
+        frames = open_frames(frames)
+    out = np.full(stop-start, np.nan)
+    for idx, (_, img) in enumerate(iter_frames(_Slice(frames, start, stop), reducer.flags)):
+        if img is not None:
+            out[idx] = reducer(img)
+    if opened:
+        frames.close()
+    return out
+
+class DecodeEngine():
+    '''Decodes and reduces a trial's frames in parallel chunks
+
+    workers=1 runs in the calling thread with no pool, which is what the Pi
+    should use. cv2.imdecode releases the GIL so threads scale on the
+    analysis machines; processes=True uses a process pool instead, each
+    worker opening the trial file itself (old pickled files are then
+    unpickled once per chunk, so prefer threads for those). With a
+    tracecache.TraceCache traces already extracted with the same ROI and
+    scale are loaded instead of decoded.
+    '''
+    def __init__(self, workers=None, chunk=64, processes=False, cache=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk = chunk
+        self.processes = processes
+        self.cache = cache
+        self.pool = None
+        if self.workers > 1:
+            pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+            self.pool = pool(max_workers=self.workers)
+
+    def eyelid_trace(self, filename, roi, scale=1):
+        '''Same result as framedecode.eyelid_trace, returns (trace, ts in ms)'''
+        if self.cache is not None:
+            params = (np.asarray(roi, dtype=float), scale, EXTRACTOR_VERSION)
+            return self.cache.cached(filename, 'eyelid', params, lambda: self._eyelid_trace(filename, roi, scale))
+        return self._eyelid_trace(filename, roi, scale)
+
+    def _eyelid_trace(self, filename, roi, scale):
+        reducer = RoiReducer(roi, scale)
+        frames = open_frames(filename)
+        ts = frames.ts
+        nIm = len(frames)
+        if self.pool is None or nIm <= self.chunk:
+            trace = _trace_range(frames, 0, nIm, reducer)
+        else:
+            src = filename if self.processes else frames
+            starts = range(0, nIm, self.chunk)
+            jobs = [self.pool.submit(_trace_range, src, s, min(s+self.chunk, nIm), reducer) for s in starts]
+            #results come back in submission order, i.e. frame order
+            trace = np.concatenate([job.result() for job in jobs])
+        frames.close()
+        return trace, ts
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def prefetch(items, depth=32):
+    '''Iterate items in a background thread, running up to `depth` items ahead
+
+    Used to decode frames while the consumer (e.g. a video encoder) works on
+    earlier ones; memory is bounded by depth. An exception in the producer is
+    raised in the consumer, and leaving the loop early stops the producer.
+    '''
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run():
+        try:
+            for item in items:
+                if not put((None, item)):
+                    return
+        except Exception as e:
+            put((e, None))
+        put((None, end))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            err, item = q.get()
+            if err is not None:
+                raise err
+            if item is end:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def mean_frame(filename):
+    '''Average image of a trial without loading the movie, used to draw ROIs'''
+    frames = open_frames(filename)
+    acc = None
+    n = 0
+    for _, img in iter_frames(frames):
+        if img is None:
+            continue
+        if acc is None:
+            acc = np.zeros(img.shape)
+        acc += img
+        n += 1
+    frames.close()
+    return acc/max(n, 1)
+
+
+def mjpg2array(filename):
+    '''Whole trial as a uint8 [nIm,H,W] array and its timestamps (ms)'''
+    frames = open_frames(filename)
+    ts = frames.ts
+    mov = None
+    idx = 0
+    for _, img in iter_frames(frames):
+        if img is None:
+            continue
+        if mov is None:
+            mov = np.empty((len(frames),)+img.shape, dtype=np.uint8)
+        mov[idx] = img
+        idx += 1
+    frames.close()
+    return mov[:idx], ts
+
+
+def compare_scales(filename, roi, scales=(1, 2, 4, 8), engine=None):
+    '''Time each decode scale on one trial and compare its trace to full resolution
+
+    Returns one dict per scale with the run time, speedup over scale 1, the
+    max and RMS deviation relative to the full-resolution trace range and
+    the correlation between the two traces.
+    '''
+    run = engine.eyelid_trace if engine is not None else eyelid_trace
+    report = []
+    for scale in sorted(set(scales) | {1}):
+        t0 = time.perf_counter()
+        trace, _ = run(filename, roi, scale=scale)
+        elapsed = time.perf_counter() - t0
+        if scale == 1:
+            ref, refTime = trace, elapsed
+        ok = ~np.isnan(ref) & ~np.isnan(trace)
+        span = np.ptp(ref[ok]) if ok.any() else 0
+        span = span if span > 0 else 1
+        diff = (trace[ok] - ref[ok]) / span
+        report.append({'scale':scale, 'seconds':elapsed, 'speedup':refTime/elapsed,
+                       'maxDev':np.abs(diff).max() if ok.any() else np.nan,
+                       'rmsDev':np.sqrt(np.mean(diff**2)) if ok.any() else np.nan,
+                       'corr':np.corrcoef(ref[ok], trace[ok])[0, 1] if ok.sum() > 1 else np.nan})
+    return [r for r in report if r['scale'] in scales]
+
+
+if __name__ == '__main__':
+    #python framedecode.py cam_trial1.data roi.npy
+    import sys
+    for r in compare_scales(sys.argv[1], np.load(sys.argv[2])):
+        print('scale 1/{scale}: {seconds:.3f} s  x{speedup:.1f}  max dev {maxDev:.2%}  rms dev {rmsDev:.2%}  r={corr:.5f}'.format(**r))
@@ -0,0 +1,187 @@
+#Matroska (MKV) muxing of stored JPEG frames without decoding them
+#
+#The frame store already holds one complete JPEG per frame, which is what a
+#V_MJPEG track carries, so a trial becomes a video file by copying bytes:
+#each frame is a SimpleBlock stamped with its own recorded time (variable
+#frame rate), and the CS/US epochs go into a UTF-8 subtitle track instead
+#of being drawn into the pixels. Only the element headers are built here.
+#
+#Clusters and the segment are written with 8-byte size fields that are filled
+#in when they are closed, so nothing but the current frame is held in memory.
+import struct
+
+TIMESCALE_NS = 100000#block times in units of 0.1 ms
+CLUSTER_SPAN = 30000#ticks per cluster, block offsets are int16
+UNKNOWN = b'\x01\xff\xff\xff\xff\xff\xff\xff'
+
+EBML = b'\x1a\x45\xdf\xa3'
+SEGMENT = b'\x18\x53\x80\x67'
+INFO = b'\x15\x49\xa9\x66'
+TRACKS = b'\x16\x54\xae\x6b'
+CLUSTER = b'\x1f\x43\xb6\x75'
+SIMPLE_BLOCK = b'\xa3'
+VIDEO_TRACK, SUB_TRACK = 1, 2
+
+
+def _size(n):
+    #EBML variable length size, shortest form
+    for length in range(1, 9):
+        if n < (1 << 7*length) - 1:
+            return (n | (1 << 7*length)).to_bytes(length, 'big')
+    raise ValueError('element too large')
+
+
+def _uint(n):
+    return n.to_bytes(max(1, (n.bit_length()+7)//8), 'big')
+
+
+def _el(eid, payload):
+    if isinstance(payload, int):
+        payload = _uint(payload)
+    elif isinstance(payload, float):
+        payload = struct.pack('>d', payload)
+    elif isinstance(payload, str):
+        payload = payload.encode()
+    return eid + _size(len(payload)) + payload
+
+
+def jpeg_size(frame):
+    '''(width, height) from a JPEG's SOF header, None if there is none'''
+    buf = bytes(frame[:65536])
+    pos = 2
+    while pos + 9 <= len(buf):
+        if buf[pos] != 0xFF:
+            pos += 1
+            continue
+        marker = buf[pos+1]
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7 or marker == 0xFF:
+            pos += 1 if marker == 0xFF else 2
+            continue
+        if marker in (0xC0, 0xC1, 0xC2):
+            height, width = struct.unpack('>HH', buf[pos+5:pos+9])
+            return width, height
+        pos += 2 + struct.unpack('>H', buf[pos+2:pos+4])[0]
+    return None
+
+
+class MkvWriter():
+    '''Writes JPEG frames and subtitle cues into an MKV file
+
+    write(ts, jpeg) takes frames in time order (ms); add_cue() may be called
+    any time before the frames it covers, cues are interleaved by start time.
+    Times before 0 are shifted with the offset argument so they stay positive.
+    '''
+    def __init__(self, filename, width, height, title='', offset=0.0):
+        self.fi = open(filename, 'wb')
+        self.offset = offset
+        self.cues = []
+        self.cluster = None
+        self.clusterTime = 0
+        self.last = 0
+        self.frames = 0
+        self.fi.write(_el(EBML, _el(b'\x42\x86', 1) + _el(b'\x42\xf7', 1) + _el(b'\x42\xf2', 4) +
+                          _el(b'\x42\xf3', 8) + _el(b'\x42\x82', 'matroska') +
+                          _el(b'\x42\x87', 4) + _el(b'\x42\x85', 2)))
+        self.fi.write(SEGMENT + UNKNOWN)
+        self.segment = self.fi.tell()
+        info = _el(b'\x2a\xd7\xb1', TIMESCALE_NS) + _el(b'\x4d\x80', 'EBCrig framemux') + \
+               _el(b'\x57\x41', 'EBCrig framemux') + _el(b'\x7b\xa9', title)
+        self.fi.write(INFO + _size(len(info) + 11) + info)
+        self.durationPos = self.fi.tell()
+        self.fi.write(_el(b'\x44\x89', 0.0))#Duration, filled in by close()
+        video = _el(b'\xd7', VIDEO_TRACK) + _el(b'\x73\xc5', VIDEO_TRACK) + _el(b'\x83', 1) + \
+                _el(b'\x86', 'V_MJPEG') + _el(b'\x9c', 0) + \
+                _el(b'\xe0', _el(b'\xb0', width) + _el(b'\xba', height))
+        subs = _el(b'\xd7', SUB_TRACK) + _el(b'\x73\xc5', SUB_TRACK) + _el(b'\x83', 0x11) + \
+               _el(b'\x86', 'S_TEXT/UTF8') + _el(b'\x9c', 0) + _el(b'\x53\x6e', 'trial epochs')
+        self.fi.write(_el(TRACKS, _el(b'\xae', video) + _el(b'\xae', subs)))
+
+    def _ticks(self, ms):
+        return int(round((ms - self.offset) * 1e6 / TIMESCALE_NS))
+
+    def _close_cluster(self):
+        if self.cluster is None:
+            return
+        end = self.fi.tell()
+        self.fi.seek(self.cluster - 8)
+        self.fi.write((end - self.cluster | 1 << 56).to_bytes(8, 'big'))
+        self.fi.seek(end)
+        self.cluster = None
+
+    def _block_at(self, ticks):
+        #relative block time, opening a new cluster when it would overflow int16
+        if self.cluster is None or not 0 <= ticks - self.clusterTime < CLUSTER_SPAN:
+            self._close_cluster()
+            self.fi.write(CLUSTER + UNKNOWN)
+            self.cluster = self.fi.tell()
+            self.clusterTime = max(ticks, 0)
+            self.fi.write(_el(b'\xe7', self.clusterTime))
+        return ticks - self.clusterTime
+
+    def add_cue(self, start, duration, text):
+        '''Subtitle `text` from start for duration (ms)'''
+        self.cues.append((start, duration, text))
+        self.cues.sort()
+
+    def _write_cues(self, upto):
+        while self.cues and self.cues[0][0] <= upto:
+            start, duration, text = self.cues.pop(0)
+            ticks = max(self._ticks(start), self.last)
+            rel = self._block_at(ticks)
+            block = _uint(0x80 | SUB_TRACK) + struct.pack('>hB', rel, 0) + text.encode()
+            length = max(1, self._ticks(start + duration) - ticks)
+            self.fi.write(_el(b'\xa0', _el(b'\xa1', block) + _el(b'\x9b', length)))#BlockGroup with BlockDuration
+
+    def write(self, ts, frame):
+        self._write_cues(ts)
+        ticks = max(self._ticks(ts), self.last)#never go back in time
+        rel = self._block_at(ticks)
+        head = _uint(0x80 | VIDEO_TRACK) + struct.pack('>hB', rel, 0x80)#keyframe
+        self.fi.write(SIMPLE_BLOCK + _size(len(head) + len(frame)) + head)
+        self.fi.write(frame)
+        self.last = ticks
+        self.frames += 1
+
+    def close(self):
+        if self.fi.closed:
+            return
+        self._write_cues(float('inf'))
+        self._close_cluster()
+        end = self.fi.tell()
+        self.fi.seek(self.durationPos)
+        self.fi.write(_el(b'\x44\x89', float(self.last)))
+        self.fi.seek(self.segment - 8)
+        self.fi.write((end - self.segment | 1 << 56).to_bytes(8, 'big'))
+        self.fi.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def remux_trial(frames, filename, epochs=(), title=''):
+    '''Copy an open frame store (framestore.open_frames) into an MKV, returns the frame count
+
+    epochs are (start ms, end ms, label) shown as subtitles, e.g. CS and US.
+    Frames without JPEG markers are left out, their neighbours keep their times.
+    '''
+    from framestore import jpeg_slice
+    ts = frames.ts
+    size = None
+    for idx in range(len(frames)):
+        jpg = jpeg_slice(frames.frame(idx))
+        size = jpeg_size(jpg) if jpg is not None else None
+        if size:
+            break
+    if size is None:
+        return 0
+    with MkvWriter(filename, size[0], size[1], title, offset=min(0.0, float(ts.min()))) as mkv:
+        for start, end, label in epochs:
+            mkv.add_cue(start, end - start, label)
+        for idx in range(len(frames)):
+            jpg = jpeg_slice(frames.frame(idx))
+            if jpg is not None:
+                mkv.write(ts[idx], jpg)
+        return mkv.frames
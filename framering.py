@@ -0,0 +1,182 @@
+#Shared-memory ring buffer carrying JPEG frames from ImgOutput to MovieSaver,
+#and the double-buffered latest-frame slot read by the GUI preview
+#
+#One producer (the picamera encoder callback) and one consumer (MovieSaver).
+#Frames are copied once into a fixed slot of a multiprocessing.shared_memory
+#block, nothing is pickled and the producer never blocks: when the ring is
+#full, or a frame does not fit in a slot, the frame is dropped and counted.
+#
+#Block layout: HEADER, then nslots x (SLOT header + slot_size payload bytes).
+#The producer owns write_seq/dropped/oversize/high_water, the consumer owns
+#read_seq, so the counters need no lock. Each slot carries the trial number it
+#was put for, so a consumer can tell a late frame of the last trial, or an
+#early one of the next, from its own.
+import struct
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+HEADER = struct.Struct('<QQQQQ')#write_seq, read_seq, dropped, oversize, high_water
+SLOT = struct.Struct('<QdIi')#sequence number, ts, payload length, trial
+
+
+class FrameRing():
+    def __init__(self, nslots=128, slot_size=256*1024):
+        self.nslots = nslots
+        self.slot_size = slot_size
+        self.stride = SLOT.size + slot_size
+        self.shm = shared_memory.SharedMemory(create=True, size=HEADER.size + nslots*self.stride)
+        self.buf = self.shm.buf
+        HEADER.pack_into(self.buf, 0, 0, 0, 0, 0, 0)
+        self.ready = mp.Event()#set by the producer after each frame
+
+    def __getstate__(self):
+        #memoryviews can't be pickled, reattach by name on the other side
+        state = self.__dict__.copy()
+        del state['buf']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.buf = self.shm.buf
+
+    def _header(self):
+        return HEADER.unpack_from(self.buf, 0)
+
+    def put(self, ts, frame, trial=0):
+        '''Copy a frame into the next free slot, returns False if it had to be dropped'''
+        write_seq, read_seq, dropped, oversize, high_water = self._header()
+        n = len(frame)
+        if n > self.slot_size:
+            #only ever write the producer's own fields, read_seq belongs to the consumer
+            struct.pack_into('<QQ', self.buf, 16, dropped+1, oversize+1)
+            return False
+        fill = write_seq - read_seq
+        if fill >= self.nslots:
+            struct.pack_into('<Q', self.buf, 16, dropped+1)
+            return False
+        pos = HEADER.size + (write_seq % self.nslots)*self.stride
+        self.buf[pos+SLOT.size:pos+SLOT.size+n] = frame
+        SLOT.pack_into(self.buf, pos, write_seq, ts, n, trial)
+        #publishing write_seq last hands the slot to the consumer
+        struct.pack_into('<Q', self.buf, 0, write_seq+1)
+        if fill+1 > high_water:
+            struct.pack_into('<Q', self.buf, 32, fill+1)
+        self.ready.set()
+        return True
+
+    def empty(self):
+        write_seq, read_seq = struct.unpack_from('<QQ', self.buf, 0)
+        return write_seq == read_seq
+
+    def __len__(self):
+        write_seq, read_seq = struct.unpack_from('<QQ', self.buf, 0)
+        return write_seq - read_seq
+
+    def drain(self, trial=None):
+        '''Yield (ts, payload) for every frame available now
+
+        The payload is a memoryview onto the slot, it is only valid until the
+        next item is requested, so write or copy it before moving on. With
+        trial, frames put for earlier trials are skipped and draining stops
+        at the first frame of a later one, which stays in the ring.
+        '''
+        write_seq, read_seq = struct.unpack_from('<QQ', self.buf, 0)
+        while read_seq < write_seq:
+            pos = HEADER.size + (read_seq % self.nslots)*self.stride
+            seq, ts, n, tag = SLOT.unpack_from(self.buf, pos)
+            if seq == read_seq and trial is not None and tag > trial:
+                return
+            if seq == read_seq and (trial is None or tag == trial):
+                yield ts, self.buf[pos+SLOT.size:pos+SLOT.size+n]
+            read_seq += 1
+            struct.pack_into('<Q', self.buf, 8, read_seq)
+
+    def wait(self, timeout=None):
+        '''Block until the producer has put a frame or timeout (s) passes, True if frames are waiting'''
+        self.ready.clear()
+        if not self.empty():
+            return True
+        self.ready.wait(timeout)
+        return not self.empty()
+
+    def stats(self):
+        write_seq, read_seq, dropped, oversize, high_water = self._header()
+        return {'frames':write_seq, 'pending':write_seq-read_seq, 'dropped':dropped,
+                'oversize':oversize, 'high_water':high_water, 'nslots':self.nslots}
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+PREVIEW = struct.Struct('<QII')#sequence lock, lengths of buffer 0 and 1
+
+
+class PreviewSlot():
+    '''Latest frame for the GUI, double buffered in shared memory
+
+    The header sequence number is a seqlock: put() makes it odd before
+    copying a frame in and even again once the frame and its length are
+    written, so frame k sits in buffer k % 2 when the number reads 2k.
+    put() is one copy and never waits on the GUI. get() only hands back a
+    frame when the sequence number moved, letting the GUI skip decoding when
+    nothing new arrived, and copies again if a write overlapped its copy.
+    '''
+    def __init__(self, size=256*1024):
+        self.size = size
+        self.shm = shared_memory.SharedMemory(create=True, size=PREVIEW.size + 2*size)
+        self.buf = self.shm.buf
+        PREVIEW.pack_into(self.buf, 0, 0, 0, 0)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['buf']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.buf = self.shm.buf
+
+    def put(self, frame):
+        n = len(frame)
+        if n > self.size:
+            return False
+        seq = struct.unpack_from('<Q', self.buf, 0)[0]
+        struct.pack_into('<Q', self.buf, 0, seq + 1)#odd: write in progress
+        idx = (seq//2 + 1) % 2
+        pos = PREVIEW.size + idx*self.size
+        self.buf[pos:pos+n] = frame
+        struct.pack_into('<I', self.buf, 8 + 4*idx, n)
+        struct.pack_into('<Q', self.buf, 0, seq + 2)
+        return True
+
+    @property
+    def seq(self):
+        return struct.unpack_from('<Q', self.buf, 0)[0]
+
+    def get(self, last_seq=0, retries=3):
+        '''Returns (seq, frame bytes), frame is None if nothing newer than last_seq'''
+        for _ in range(retries):
+            seq, n0, n1 = PREVIEW.unpack_from(self.buf, 0)
+            if seq == last_seq or seq == 0:
+                return last_seq, None
+            if seq % 2:
+                continue
+            idx = (seq//2) % 2
+            n = (n0, n1)[idx]
+            pos = PREVIEW.size + idx*self.size
+            frame = bytes(self.buf[pos:pos+n])
+            #a put() started or finished while copying, the buffer may be torn
+            if self.seq == seq:
+                return seq, frame
+        return last_seq, None
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
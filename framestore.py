@@ -0,0 +1,184 @@
+#Indexed storage of camera frames for a single trial
+#
+#File layout (all little endian):
+#   MAGIC                                   8 bytes
+#   per frame: ts (f8), length (u4), trial (u4), then `length` bytes of JPEG
+#   index: one INDEX_DTYPE record per frame  (written by close())
+#   tail: index offset (u8), frame count (u8), TAIL_MAGIC (8 bytes)
+#
+#Frames are appended as they arrive so a session killed mid-trial still leaves
+#a readable file; the reader rebuilds the index from the per-frame headers
+#when the tail is missing. Pickled .data files written by older versions of
+#MovieSaver are read through LegacyFrameReader, open_frames() picks for you.
+import mmap
+import os
+import pickle
+import re
+import struct
+import numpy as np
+
+MAGIC = b'EBCFRM01'
+TAIL_MAGIC = b'EBCIDX01'
+RECORD = struct.Struct('<dII')#ts in s, payload length, trial number
+TAIL = struct.Struct('<QQ8s')
+INDEX_DTYPE = np.dtype([('offset','<u8'),('length','<u4'),('trial','<u4'),('ts','<f8')])
+
+
+class FrameWriter():
+    '''Append-only writer used by MovieSaver, one file per trial'''
+    def __init__(self, filename, trial=0, buffering=1<<20):
+        self.filename = filename
+        self.trial = trial
+        self.fi = open(filename, 'wb', buffering=buffering)
+        self.fi.write(MAGIC)
+        self.pos = len(MAGIC)
+        self.index = []
+
+    def write(self, ts, frame):
+        n = len(frame)
+        self.fi.write(RECORD.pack(ts, n, self.trial))
+        self.fi.write(frame)
+        self.pos += RECORD.size
+        self.index.append((self.pos, n, self.trial, ts))
+        self.pos += n
+
+    def flush(self):
+        self.fi.flush()
+
+    def close(self):
+        if self.fi.closed:
+            return
+        index = np.array(self.index, dtype=INDEX_DTYPE)
+        self.fi.write(index.tobytes())
+        self.fi.write(TAIL.pack(self.pos, len(index), TAIL_MAGIC))
+        self.fi.close()
+
+    @property
+    def closed(self):
+        return self.fi.closed
+
+    def __len__(self):
+        return len(self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FrameReader():
+    '''Random access to the frames of one trial file written by FrameWriter'''
+    def __init__(self, filename):
+        self.filename = filename
+        self._fi = open(filename, 'rb')
+        self._mm = mmap.mmap(self._fi.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(filename + ' is not a frame store file')
+        self.index = self._read_index()
+
+    def _read_index(self):
+        size = len(self._mm)
+        if size >= len(MAGIC) + TAIL.size:
+            idxPos, count, tail = TAIL.unpack_from(self._mm, size - TAIL.size)
+            if tail == TAIL_MAGIC and idxPos + count*INDEX_DTYPE.itemsize == size - TAIL.size:
+                return np.frombuffer(self._mm, dtype=INDEX_DTYPE, count=count, offset=idxPos)
+        #No tail, the writer never closed: walk the per-frame headers instead
+        index = []
+        pos = len(MAGIC)
+        while pos + RECORD.size <= size:
+            ts, n, trial = RECORD.unpack_from(self._mm, pos)
+            pos += RECORD.size
+            if pos + n > size:
+                break#truncated last frame
+            index.append((pos, n, trial, ts))
+            pos += n
+        return np.array(index, dtype=INDEX_DTYPE)
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def ts(self):
+        #frame times in ms relative to the trial trigger, like mjpg2array returned
+        return self.index['ts']*1000
+
+    @property
+    def trial(self):
+        return int(self.index['trial'][0]) if len(self.index) else 0
+
+    def frame(self, idx):
+        '''JPEG bytes of frame idx as a uint8 view onto the mapped file'''
+        rec = self.index[idx]
+        return np.frombuffer(self._mm, dtype=np.uint8, count=int(rec['length']), offset=int(rec['offset']))
+
+    def frame_at(self, t):
+        '''Index of the first frame at or after t (ms)'''
+        return int(np.searchsorted(self.ts, t))
+
+    def __getitem__(self, idx):
+        return self.frame(idx)
+
+    def __iter__(self):
+        ts = self.ts
+        for idx in range(len(self)):
+            yield ts[idx], self.frame(idx)
+
+    def close(self):
+        self.index = None
+        try:
+            self._mm.close()
+        except BufferError:
+            pass#views of the map are still alive, the map is released with them
+        self._fi.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class LegacyFrameReader(FrameReader):
+    '''Same interface as FrameReader over a pickled list-of-(ts,bytes) .data file'''
+    def __init__(self, filename):
+        self.filename = filename
+        stream = []
+        with open(filename, 'rb') as filehand:
+            while 1:
+                try:
+                    stream.extend(pickle.load(filehand))
+                except EOFError:
+                    break
+        m = re.search(r'cam_trial(\d+)', os.path.basename(filename))
+        trial = int(m.group(1)) if m else 0
+        self._frames = [np.frombuffer(frame, dtype=np.uint8) for _, frame in stream]
+        self.index = np.array([(0, len(frame), trial, ts) for ts, frame in stream], dtype=INDEX_DTYPE)
+
+    def frame(self, idx):
+        return self._frames[idx]
+
+    def close(self):
+        self.index = None
+        self._frames = []
+
+
+def open_frames(filename):
+    '''Open a trial's frames with whichever reader matches the file on disk'''
+    with open(filename, 'rb') as fi:
+        head = fi.read(len(MAGIC))
+    if head == MAGIC:
+        return FrameReader(filename)
+    return LegacyFrameReader(filename)
+
+
+def jpeg_slice(frame):
+    '''Trim a frame to its SOI..EOI markers as the old readers did, None if either is missing'''
+    frame = np.frombuffer(frame, dtype=np.uint8) if not isinstance(frame, np.ndarray) else frame
+    buf = frame.tobytes()
+    a = buf.find(b'\xff\xd8')
+    b = buf.find(b'\xff\xd9')
+    if a == -1 or b == -1:
+        return None
+    return frame[a:b+2]
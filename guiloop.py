@@ -0,0 +1,70 @@
+#Worker threads and latency bookkeeping for the control GUI loop
+#
+#Anything that waits on the rig or the camera, or decodes, runs in a worker
+#thread and hands its result to the GUI with window.write_event_value, so the
+#loop itself only blocks in window.read and handles one event at a time.
+#Posted values are (post time, value) so the loop can tell how long a result
+#sat in the queue as well as how long it took to handle.
+import threading
+import time
+from collections import deque
+import numpy as np
+
+
+class LatencyLog():
+    '''Last maxlen durations (s) of one kind, reported as percentiles in ms'''
+    def __init__(self, maxlen=5000):
+        self.samples = deque(maxlen=maxlen)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def percentiles(self, q=(50, 95, 99)):
+        lat = np.array(self.samples)*1000
+        if not len(lat):
+            return {'n':0}
+        out = {'n':len(lat), 'max':lat.max()}
+        out.update(('p%d' % p, v) for p, v in zip(q, np.percentile(lat, q)))
+        return out
+
+    def __str__(self):
+        return ', '.join('%s=%.3g' % kv for kv in self.percentiles().items())
+
+
+def post(window, key, value):
+    window.write_event_value(key, (time.perf_counter(), value))
+
+
+class Poller(threading.Thread):
+    '''Calls poll() every interval s and posts each (key, value) it returns to window'''
+    def __init__(self, window, poll, interval=0.01):
+        super().__init__(daemon=True)
+        self.window = window
+        self.poll = poll
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                for key, value in self.poll() or ():
+                    post(self.window, key, value)
+            except Exception as e:
+                print('guiloop.Poller: ' + repr(e))
+
+    def stop(self):
+        self.stopped.set()
+
+
+def run_async(window, key, func, *args):
+    '''func(*args) in a thread, its return value is posted as event key'''
+    def target():
+        try:
+            result = func(*args)
+        except Exception as e:
+            print('guiloop.run_async(%s): %r' % (key, e))
+            result = None
+        post(window, key, result)
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    return thread
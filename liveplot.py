@@ -0,0 +1,218 @@
+#Live trial plot of the control GUI, redrawn by blitting
+#
+#The plot owns a fixed pool of Line2D artists for the n2show most recent
+#wheel and eyelid traces and three stimulus markers; new trials only swap
+#data into the pool. The static part of the figure (axes, ticks, grid) is
+#kept as a bitmap, and an update restores it and draws just the animated
+#artists on top. A full redraw is only needed when an axis range changes,
+#which is rare as ranges only grow during a session; the markers span the
+#axes in axes coordinates so they survive a rescale as they are.
+#
+#TrialHeatmap does the same for trials x time images of the whole session.
+import time
+from collections import deque
+import numpy as np
+
+
+class BlitCanvas():
+    '''Redraws the artists from _artists() over a cached background of the rest of the figure'''
+    def __init__(self, fig, canvas):
+        self.fig = fig
+        self.canvas = canvas
+        self.background = None
+        self.latencies = deque(maxlen=1000)#seconds per update
+        self.fullDraws = 0
+        self.blits = 0
+        canvas.mpl_connect('draw_event', self._on_draw)
+
+    def _artists(self):
+        return []
+
+    def _on_draw(self, event):
+        #any full draw (ours, a resize, a toolbar) refreshes the background
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        for artist in self._artists():
+            self.fig.draw_artist(artist)
+
+    def redraw(self):
+        '''Full draw of the figure, the background is recaptured from it'''
+        self.canvas.draw()
+        self.fullDraws += 1
+
+    def _blit(self):
+        if self.background is None:
+            return self.redraw()
+        self.canvas.restore_region(self.background)
+        for artist in self._artists():
+            self.fig.draw_artist(artist)
+        self.canvas.blit(self.fig.bbox)
+        self.blits += 1
+
+    def latency(self):
+        '''Update latency percentiles in ms and the number of full draws and blits'''
+        lat = np.array(self.latencies)*1000
+        if not len(lat):
+            return {'n':0, 'fullDraws':self.fullDraws, 'blits':self.blits}
+        p50, p95, p99 = np.percentile(lat, [50, 95, 99])
+        return {'n':len(lat), 'p50':p50, 'p95':p95, 'p99':p99, 'max':lat.max(),
+                'fullDraws':self.fullDraws, 'blits':self.blits}
+
+
+class LivePlot(BlitCanvas):
+    '''Rotary (ax) and eyelid (twin axis) traces of the last n2show trials on a FigureCanvas'''
+    def __init__(self, fig, canvas, ax, ax2, n2show=4, rotColors=None, eyeColors=None, margin=0.05):
+        super().__init__(fig, canvas)
+        self.ax = ax
+        self.ax2 = ax2
+        self.n2show = n2show
+        self.margin = margin
+        self.rotColors = rotColors if rotColors is not None else ['C%d' % i for i in range(n2show)]
+        self.eyeColors = eyeColors if eyeColors is not None else ['C%d' % i for i in range(n2show)]
+        self.rotLines = [ax.plot([], [], animated=True)[0] for _ in range(n2show)]
+        self.eyeLines = [ax2.plot([], [], animated=True)[0] for _ in range(n2show)]
+        self.markers = [ax.axvline(np.nan, linestyle='--', color='black', animated=True) for _ in range(3)]
+        self.rot = deque(maxlen=n2show)#(time, values) of the shown trials, oldest first
+        self.eye = deque(maxlen=n2show)
+        self.redraw()
+
+    def _artists(self):
+        return self.markers + self.rotLines + self.eyeLines
+
+    def _refresh(self, lines, traces, colors):
+        #oldest trial in the first artist, unused artists are emptied
+        for idx, line in enumerate(lines):
+            if idx < len(traces):
+                line.set_data(*traces[idx])
+                line.set_color(colors[idx])
+            else:
+                line.set_data([], [])
+
+    def _limits(self, traces):
+        values = [v[np.isfinite(v)] for _, v in traces]
+        values = [v for v in values if len(v)]
+        if not values:
+            return None
+        lo, hi = min(v.min() for v in values), max(v.max() for v in values)
+        pad = (hi - lo)*self.margin or 1
+        return lo - pad, hi + pad
+
+    def _grow(self, ax, axis, lim):
+        #ranges only grow until clear(), so most trials leave the background valid
+        if lim is None:
+            return False
+        lo, hi = ax.get_ylim() if axis == 'y' else ax.get_xlim()
+        if lim[0] >= lo and lim[1] <= hi:
+            return False
+        (ax.set_ylim if axis == 'y' else ax.set_xlim)(min(lim[0], lo), max(lim[1], hi))
+        return True
+
+    def _update(self, draw):
+        start = time.perf_counter()
+        self._refresh(self.rotLines, self.rot, self.rotColors)
+        self._refresh(self.eyeLines, self.eye, self.eyeColors)
+        rescale = self._grow(self.ax, 'y', self._limits(self.rot))
+        rescale |= self._grow(self.ax2, 'y', self._limits(self.eye))
+        times = [(None, np.asarray(t, dtype=float)) for t, _ in list(self.rot) + list(self.eye)]
+        rescale |= self._grow(self.ax, 'x', self._limits(times))
+        if rescale or draw:
+            self.redraw()
+        else:
+            self._blit()
+        self.latencies.append(time.perf_counter() - start)
+
+    def set_markers(self, vls):
+        '''Stimulus lines from [preCSdur, CSdur, USdur]: CS onset, US onset and CS end'''
+        for line, x in zip(self.markers, [vls[0], vls[0] + vls[1] - vls[2], vls[0] + vls[1]]):
+            line.set_xdata([x, x])
+        self._update(draw=True)
+
+    def add_rotary(self, rot_time, rot):
+        if np.isnan(rot).all():
+            return
+        self.rot.append((rot_time, rot))
+        self._update(draw=False)
+
+    def add_eyelid(self, eb_time, eb):
+        if np.isnan(eb).all():
+            return
+        self.eye.append((eb_time, eb))
+        self._update(draw=False)
+
+    def clear(self):
+        '''Drop all traces and reset the axes to their initial range for a new session'''
+        self.rot.clear()
+        self.eye.clear()
+        self.ax.set_ylim(0, 1)
+        self.ax2.set_ylim(0, 1)
+        self.ax.set_xlim(0, 1)
+        self._update(draw=True)
+
+
+class TrialHeatmap(BlitCanvas):
+    '''Trials x time images of the session, one row added per trial
+
+    Each panel is backed by an array preallocated for the session and
+    resampled onto a fixed time grid, so adding a trial writes one row and
+    hands the same array to set_data whatever the number of trials so far.
+    '''
+    def __init__(self, fig, canvas, axes, labels, nTrials=110, timeBins=np.arange(0, 1000, 10.), cmap='viridis'):
+        super().__init__(fig, canvas)
+        self.axes = dict(zip(labels, axes))
+        self.images = {}
+        for label, ax in self.axes.items():
+            self.images[label] = ax.imshow(np.full((1, 1), np.nan), aspect='auto', cmap=cmap,
+                                           interpolation='nearest', animated=True)
+            ax.set_title(label, fontsize='small')
+            ax.set_ylabel('trial')
+        self.reset(nTrials, timeBins)
+
+    def _artists(self):
+        return list(self.images.values())
+
+    def _place(self, label):
+        #image extent and axes range for the rows allocated
+        rows = self.rows[label]
+        self.images[label].set_extent([self.timeBins[0], self.timeBins[-1], len(rows), 0])
+        self.axes[label].set_xlim(self.timeBins[0], self.timeBins[-1])
+        self.axes[label].set_ylim(len(rows), 0)
+
+    def reset(self, nTrials, timeBins):
+        '''Empty panels for a session of nTrials on timeBins (ms)'''
+        self.timeBins = np.asarray(timeBins, dtype=float)
+        self.rows = {label:np.full((max(nTrials, 1), len(self.timeBins)), np.nan) for label in self.axes}
+        self.count = dict.fromkeys(self.axes, 0)
+        self.clim = dict.fromkeys(self.axes, None)
+        for label, img in self.images.items():
+            img.set_data(self.rows[label])
+            self._place(label)
+        self.redraw()
+
+    def add(self, label, t, values):
+        '''Resample one trial onto timeBins as the next row of panel label'''
+        start = time.perf_counter()
+        t, values = np.asarray(t, dtype=float), np.asarray(values, dtype=float)
+        keep = np.isfinite(t) & np.isfinite(values)
+        if keep.sum() < 2:
+            return
+        rows = self.rows[label]
+        full = self.count[label] == len(rows)
+        if full:
+            #more trials than the session was set up for, double the rows
+            rows = self.rows[label] = np.concatenate([rows, np.full_like(rows, np.nan)])
+        row = rows[self.count[label]]
+        row[:] = np.interp(self.timeBins, t[keep], values[keep], left=np.nan, right=np.nan)
+        self.count[label] += 1
+        img = self.images[label]
+        img.set_data(rows)
+        #colour range only widens, from the new row alone
+        lo, hi = np.nanmin(row, initial=np.inf), np.nanmax(row, initial=-np.inf)
+        if np.isfinite([lo, hi]).all():
+            old = self.clim[label]
+            self.clim[label] = (lo, hi) if old is None else (min(lo, old[0]), max(hi, old[1]))
+            img.set_clim(*self.clim[label])
+        if full:
+            self._place(label)
+            self.redraw()
+        else:
+            self._blit()
+        self.latencies.append(time.perf_counter() - start)
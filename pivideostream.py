@@ -1,119 +1,156 @@
 # Control of the camera
-import picamera
-from picamera import PiCamera
 import io
 import multiprocessing as mp
-from queue import Empty
-import ctypes
-import RPi.GPIO as GPIO
 import time
-import pickle
+import queue
+import threading
+import numpy as np
+import cv2
+from framestore import FrameWriter
+from framedecode import RoiReducer
+from framering import FrameRing, PreviewSlot
+from camcontrol import CamControl, STATE_NAMES, IDLE, ARMED, RECORDING, FLUSHING, DONE
+#Off the Pi these are missing, piCamHandler then needs camera= and gpio= (rigsim.py has stand-ins)
+try:
+    import picamera
+    from picamera import PiCamera
+except ImportError:
+    picamera = PiCamera = None
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    GPIO = None
+
+def _black():
+    return picamera.Color('black') if picamera is not None else 'black'
 
     
 class ImgOutput(object):
     #Object with write method that informs other threads when a frame is available
-    def __init__(self,frame_buffer,finished,current_frame,triggerTime,saving,kill_flag):
-        self.saving = saving
+    def __init__(self,frame_buffer,finished,preview,ctl,track_buffer=None):
+        self.ctl = ctl
         self.frame_buffer = frame_buffer
-        self.current_frame = current_frame
-        self.triggerTime = triggerTime
-        self.kill_flag = kill_flag
+        self.track_buffer = track_buffer
+        self.preview = preview
         self.buffer = io.BytesIO()
         self.finished = finished
-        self.condition = mp.Condition()
 
     def write(self, buf):
-        if buf.startswith(b'\xff\xd8') and not self.kill_flag.value:
+        if buf.startswith(b'\xff\xd8') and not self.ctl.kill:
             # New frame, copy the existing buffer's content and notify all
             # clients it's available
-            ts = time.perf_counter()-self.triggerTime.value-0.02
-            #self.camTS.value = time.perf_counter()
+            ts = time.perf_counter()-self.ctl.triggerTime-0.02
             size = self.buffer.tell()
             if size:
                 self.buffer.seek(0)
                 frame = self.buffer.read(size)
-                self.current_frame.value = frame
-                if self.saving.value:
-                    self.frame_buffer.put([ts,frame])
+                if self.ctl.stream:
+                    self.preview.put(frame)
+                if self.ctl.state == RECORDING:
+                    #never blocks, a full ring drops the frame and counts it
+                    trial = self.ctl.trial
+                    self.frame_buffer.put(ts,frame,trial)
+                    if self.track_buffer is not None:
+                        self.track_buffer.put(ts,frame,trial)
                 self.buffer.seek(0)
-                time.sleep(0.001)
         self.buffer.write(buf)
         
     def flush(self):
-        self.frame_buffer.close()
-        self.frame_buffer.join_thread()
         self.finished.set()
     
 
 class MovieSaver(mp.Process):
     #Handles the saving of movie data as a separate process called in picamhandler
-    def __init__(self, fname, startSave, saving, frame_buffer, flushing, buffer_size=2000, min_flush=200,piStreamDone=None,kill_flag=None):#,triggerTime=None,camTS=None
+    def __init__(self, frame_buffer, ctl, min_flush=200):
         super(MovieSaver, self).__init__()
         self.daemon = True
             
         #Saving parameters
-        self.fname = fname
-        self.buffer_size = buffer_size
         self.min_flush = min_flush
         
-        ##Inherited flags and containers
-        self.saving = saving
-        self.startSave = startSave
+        ##Inherited control block and frame ring
+        self.ctl = ctl
         self.frame_buffer = frame_buffer
-        self.flushing = flushing
-        self.piStreamDone = piStreamDone
-        #self.triggerTime = triggerTime
-        #self.camTS = camTS
-        self.kill_flag = kill_flag
-
-        #Process-specific
-        self.saving_complete = mp.Value('b',True)
         
         self.start()
         
     def run(self):
-        fi = None
-        while not self.kill_flag.value:
-            if self.startSave.value:
-                self.startSave.value = False
-                self.saving_complete.value = False
-                fi = open(self.fname.value,'wb')
-                datalist = []
-
-            if not self.piStreamDone.value:
-                while not self.frame_buffer.empty():
-                    ts,frame = self.frame_buffer.get(block=False)
-                    datalist.append((ts,frame))
-                    if len(datalist)>self.min_flush:
-                        pickle.dump(datalist,fi)
-                        datalist = []
-                        print('Wrote to file')
+        while not self.ctl.kill:
+            #Sleep until a trigger arms the next trial
+            if self.ctl.wait_for((ARMED,RECORDING)) not in (ARMED,RECORDING):
+                break
+            trial = self.ctl.trial
+            fi = FrameWriter(self.ctl.fname,trial=trial)
+            edgeTime = self.ctl.edgeTime
+            
+            while True:
+                #Blocks on the ring's frame event, flush and kill also set it
+                self.frame_buffer.wait(0.1)
+                for ts,frame in self.frame_buffer.drain(trial):
+                    fi.write(ts,frame)
+                    if len(fi)==1:
+                        self.ctl.add_latency(time.perf_counter()-edgeTime)
+                    if len(fi)%self.min_flush==0:
+                        fi.flush()
+                state = self.ctl.state
+                if state==FLUSHING or self.ctl.kill:
+                    for ts,frame in self.frame_buffer.drain(trial):
+                        fi.write(ts,frame)
+                    fi.close()
+                    break
+            
+            #Still FLUSHING, so no trial can be armed yet: a frame put after the last
+            #drain (ImgOutput saw RECORDING just before the stop) is this trial's, drop it
+            for _ in self.frame_buffer.drain():
+                pass
+            self.ctl.transition(FLUSHING,DONE)
+            stats = self.frame_buffer.stats()
+            lat = self.ctl.latency_stats()
+            print('Finished saving {} frames, {} dropped so far, ring peaked at {}/{} slots'.format(len(fi),stats['dropped'],stats['high_water'],stats['nslots']))
+            print('Trigger to first saved frame {:.1f} ms (mean {:.1f}, max {:.1f})'.format(lat['last'],lat['mean'],lat['max']))
+            
 
-            if self.flushing.value and self.piStreamDone.value:
-                while not self.frame_buffer.empty():
-                    ts,frame = self.frame_buffer.get(block=False)
-                    datalist.append((ts,frame))
-                pickle.dump(datalist,fi)
-                fi.close()
-                self.saving_complete.value = True
-                self.flushing.value = False
-                print('Finished saving')
-            time.sleep(0.001)
+class EyelidTracker(mp.Process):
+    #Applies a saved ROI to each frame while it is captured and publishes the trial's trace
+    #at trial end, off the MovieSaver write path. Fed by its own frame ring so a slow
+    #decode only ever drops tracker frames (counted in track_buffer.stats()), never saved ones.
+    def __init__(self, track_buffer, ctl, roi, scale=2):
+        super(EyelidTracker, self).__init__()
+        self.daemon = True
+        self.track_buffer = track_buffer
+        self.ctl = ctl
+        self.reducer = RoiReducer(roi, scale)
+        self.results = mp.Queue()
         
-        #Saving final frames if kill flag on
-        if fi != None:
-            if not fi.closed:
-                while not self.frame_buffer.empty():
-                    ts,frame = self.frame_buffer.get(block=False)
-                    datalist.append((ts,frame))
-                pickle.dump(datalist,fi)
-                fi.close()
-                self.saving_complete.value = True
+        self.start()
         
+    def run(self):
+        #don't hold up exit on traces nobody collected
+        self.results.cancel_join_thread()
+        while not self.ctl.kill:
+            if self.ctl.wait_for((ARMED,RECORDING)) not in (ARMED,RECORDING):
+                break
+            trial = self.ctl.trial
+            ts = []
+            eb = []
+            while True:
+                self.track_buffer.wait(0.1)
+                done = self.ctl.state not in (ARMED,RECORDING) or self.ctl.trial != trial or self.ctl.kill
+                #checked before reading, so the last read also gets frames put just before the stop.
+                #Frames are tagged with their trial: a late one of the last trial is skipped and the
+                #next trial's first frames stay in the ring for the next trace
+                for t,frame in self.track_buffer.drain(trial):
+                    img = cv2.imdecode(np.frombuffer(frame,dtype=np.uint8),self.reducer.flags)
+                    ts.append(t*1000)#ms, like the offline readers
+                    eb.append(self.reducer(img) if img is not None else np.nan)
+                if done:
+                    break
+            #one small message per trial, the GUI picks it up through piCamHandler.getEyelid()
+            self.results.put((trial,np.array(eb),np.array(ts)))
             
 
 class PiVideoStream(mp.Process):
-    def __init__(self,output=None,resolution=(640, 480),framerate=100,frame_buffer=None,finished=None,stream_flag=None,saving=None,sync_flag=None,startAcq=None,triggerTime=None,piStreamDone=None,kill_flag=None,**kwargs):
+    def __init__(self,output=None,resolution=(640, 480),framerate=100,frame_buffer=None,finished=None,ctl=None,camera=None,**kwargs):
         #Note output could be an instantiation of ImgOutput or any file-type object
         #with a write method that returns each frame capture as the write
         super(PiVideoStream,self).__init__()
@@ -123,7 +160,10 @@ class PiVideoStream(mp.Process):
         self.output = output
         self.frame_buffer = frame_buffer
         self.finished = finished
-        self.camera = PiCamera()
+        self.framerate = framerate
+        if camera is None and PiCamera is None:
+            raise RuntimeError('picamera is not installed, pass a camera object (e.g. rigsim.FakeCamera)')
+        self.camera = camera if camera is not None else PiCamera()
         # set camera parameters
         self.camera.resolution = resolution
         self.camera.framerate = framerate
@@ -139,22 +179,12 @@ class PiVideoStream(mp.Process):
         self.camera.clock_mode = 'raw'
         #Setting up camera clock, outputs, and initial image annotation
         self.camera.start_recording(self.output, format='mjpeg')
-        self.camera.annotate_background = picamera.Color('black')
+        self.camera.annotate_background = _black()
         self.camera.annotate_text_size = 6
         self.camera.annotate_text = 'Not recording'
         
-        ##For interacting with the save and GPIO processes
-        #Shared processes inherited from parent
-        self.stream_flag = stream_flag
-        self.saving = saving
-        self.startAcq = startAcq
-        self.triggerTime = triggerTime
-        self.piStreamDone = piStreamDone
-        self.kill_flag = kill_flag
-        
-        ##Process-specific flags
-        self.thread_complete = mp.Value('b',True)
-        self.getSaveRead = mp.Value('b',False)
+        ##Shared control block for interacting with the save and GPIO processes
+        self.ctl = ctl
         
         # set optional camera parameters (refer to PiCamera docs)
         for (arg, value) in kwargs.items():
@@ -163,128 +193,171 @@ class PiVideoStream(mp.Process):
         self.start()
         
     def run(self):
-        while not self.kill_flag.value:
-            #Looking for GPIO or GUI to flip startAcq flag
-            if self.startAcq.value:
-                #Get time from trigger in ms
-                triggerLatency = time.perf_counter() - self.triggerTime.value
-                #If longer than one frame grab, we entered between grabs-> subtract one frame time off
-                if triggerLatency>1/self.camera.framerate:
-                    self.triggerTime.value = self.triggerTime.value - 1/self.camera.framerate
-                self.startAcq.value = False
-                self.saving.value = True
-                self.piStreamDone.value = False
-                
-            if not self.saving.value and not self.startAcq.value:
-                #reset flags
-                self.piStreamDone.value = True
-            time.sleep(0.001)
-            
-        self.piStreamDone.value = True
+        while not self.ctl.kill:
+            #Sleep until GPIO or GUI arms a trial
+            if self.ctl.wait_for((ARMED,)) != ARMED:
+                break
+            #Get time from trigger
+            triggerLatency = time.perf_counter() - self.ctl.triggerTime
+            #If longer than one frame grab, we entered between grabs-> subtract one frame time off
+            if triggerLatency>1/self.framerate:
+                self.ctl.set(triggerTime=self.ctl.triggerTime - 1/self.framerate)
+            self.ctl.transition(ARMED,RECORDING)
+            #Nothing to do until this trial is over
+            self.ctl.wait_for((FLUSHING,DONE,IDLE))
         
         
 class piCamHandler():
-    def __init__(self,resolution=(640,480),framerate=100): #,sync_flag=None
+    def __init__(self,resolution=(640,480),framerate=100,roi=None,trackScale=2,camera=None,gpio=None): #,sync_flag=None
         #Params for picamera
         self.resolution = resolution
         self.framerate = framerate
+        #roi: saved ROI mask (array or .npy file) to compute eyelid traces during capture
+        if isinstance(roi,str):
+            roi = np.load(roi)
         
-        #Shared variables for acquisition and saving processes
-        self.manager = mp.Manager()
-        self.fname = self.manager.Value(ctypes.c_char_p,"noname.data")
-        self.fStub = self.manager.Value(ctypes.c_char_p,"noStub")
-        self.frame_buffer = mp.Queue()
+        #Shared control block, frame ring and GUI frame for acquisition and saving processes
+        self.ctl = CamControl()
+        self.frame_buffer = FrameRing()
+        self.preview = PreviewSlot()
+        self.previewSeq = 0
         self.finished = mp.Event()
-        self.camTS = mp.Value('d',0)
-        self.current_frame = mp.Array(ctypes.c_char_p,b'a')
-        self.current_frame.value = b'a'
-        self.stream_flag = mp.Value('b',True)
-        self.startSave = mp.Value('b',False)
-        self.startAcq = mp.Value('b',False)
-        self.saving = mp.Value('b',False)
-        self.flushing = mp.Value('b',False)
-        self.triggerTime = mp.Value('d',0)
-        self.piStreamDone = mp.Value('b',True)
-        self.kill_flag = mp.Value('b',False)
         self.trialNum = 0
+        self.armWait = 5.0#s a queued trial start waits for the saver to finish the last trial
         
-        #Initializing GPIO
-        GPIO.setwarnings(False)
-        GPIO.cleanup(25)
-        GPIO.setmode(GPIO.BCM)
+        #Initializing GPIO, gpio stands in for the RPi.GPIO module
+        self.gpio = gpio if gpio is not None else GPIO
+        if self.gpio is None:
+            raise RuntimeError('RPi.GPIO is not installed, pass a gpio object (e.g. rigsim.FakeGPIO)')
+        self.gpio.setwarnings(False)
+        self.gpio.cleanup(25)
+        self.gpio.setmode(self.gpio.BCM)
         self.on_pin = 25
-        GPIO.setup(self.on_pin,GPIO.IN,pull_up_down=GPIO.PUD_DOWN)
-        GPIO.add_event_detect(self.on_pin,GPIO.BOTH,callback=self.interrupt_in)
+        self.gpio.setup(self.on_pin,self.gpio.IN,pull_up_down=self.gpio.PUD_DOWN)
+        self.gpio.add_event_detect(self.on_pin,self.gpio.BOTH,callback=self.interrupt_in)
         
         #Initiate subprocesses to handle image acquisition
-        self.saver = MovieSaver(fname=self.fname,startSave=self.startSave,saving=self.saving,frame_buffer=self.frame_buffer,flushing=self.flushing,piStreamDone=self.piStreamDone,kill_flag=self.kill_flag)
-        self.output = ImgOutput(frame_buffer=self.frame_buffer,finished=self.finished,current_frame=self.current_frame,triggerTime=self.triggerTime,saving=self.saving,kill_flag=self.kill_flag)
-        self.piStream = PiVideoStream(output=self.output,resolution=self.resolution,framerate=self.framerate,frame_buffer=self.frame_buffer,finished=self.finished,stream_flag=self.stream_flag,saving=self.saving,startAcq=self.startAcq,triggerTime=self.triggerTime,piStreamDone=self.piStreamDone,kill_flag=self.kill_flag)
+        self.saver = MovieSaver(frame_buffer=self.frame_buffer,ctl=self.ctl)
+        self.track_buffer = None
+        self.tracker = None
+        if roi is not None:
+            self.track_buffer = FrameRing()
+            self.tracker = EyelidTracker(track_buffer=self.track_buffer,ctl=self.ctl,roi=roi,scale=trackScale)
+        self.output = ImgOutput(frame_buffer=self.frame_buffer,finished=self.finished,preview=self.preview,ctl=self.ctl,track_buffer=self.track_buffer)
+        self.piStream = PiVideoStream(output=self.output,resolution=self.resolution,framerate=self.framerate,frame_buffer=self.frame_buffer,finished=self.finished,ctl=self.ctl,camera=camera)
         
     def interrupt_in(self,channel):
-        if GPIO.input(self.on_pin):
-            self.triggerTime.value = time.perf_counter()
+        if self.gpio.input(self.on_pin):
+            triggerTime = time.perf_counter()
+            #every rising edge is a trial on the Arduino, so cam_trial<N> keeps rig.txt's numbering
+            #even when this trial can't be recorded
             self.trialNum = self.trialNum + 1
-            trial_str = str(self.trialNum)
-            newFname = self.fStub.value+'cam_trial'+trial_str+'.data'
-            self.fname.value = newFname
-            self.startSave.value = True
-            self.startAcq.value = True
-            self.piStream.camera.annotate_text = ''
-            print('Trial start interrupt detected by picam')
-        elif not GPIO.input(self.on_pin):
-            self.saving.value = False
-            self.flushing.value = True
-            self.piStream.camera.annotate_text = 'Not recording'
+            newFname = self.ctl.fStub+'cam_trial'+str(self.trialNum)+'.data'
+            if self.ctl.state in (ARMED,RECORDING):
+                #the last trial's falling edge was missed, finish it before starting this one
+                print('Trial start interrupt while trial {} is still recording, stopping it'.format(self.ctl.trial))
+                self.stopRecording()
+            if self.ctl.arm(newFname,self.trialNum,triggerTime,wait=0):
+                self.started()
+            else:
+                #the saver is still flushing: arm once it is done, off the GPIO callback thread
+                threading.Thread(target=self.armQueued,args=(newFname,self.trialNum,triggerTime),daemon=True).start()
+        elif not self.gpio.input(self.on_pin):
+            self.stopRecording()
             print('Trial end interrupt detected by picam')
     
+    def started(self):
+        self.piStream.camera.annotate_text = ''
+        print('Trial start interrupt detected by picam')
+    
+    def armQueued(self,fname,trial,triggerTime):
+        #frame times stay relative to the trigger edge, the first frames of the trial are lost
+        if self.ctl.wait_for((IDLE,DONE),self.armWait) not in (IDLE,DONE):
+            print('Trial {} not recorded, camera is still {}'.format(trial,STATE_NAMES[self.ctl.state]))
+        elif not self.gpio.input(self.on_pin):
+            print('Trial {} not recorded, it ended before the saver was done'.format(trial))
+        elif self.ctl.arm(fname,trial,triggerTime,wait=0):
+            print('Trial {} armed {:.0f} ms late, the saver was still flushing'.format(trial,(time.perf_counter()-triggerTime)*1000))
+            self.started()
+        else:
+            print('Trial {} not recorded, camera is still {}'.format(trial,STATE_NAMES[self.ctl.state]))
+    
+    def stopRecording(self):
+        if self.ctl.stop():
+            #wake the saver (and tracker) so they flush straight away
+            self.frame_buffer.ready.set()
+            if self.track_buffer is not None:
+                self.track_buffer.ready.set()
+            self.piStream.camera.annotate_text = 'Not recording'
+            return True
+        return False
+    
     def reset_cam(self):
-        self.stream_flag.value = True
-        self.piStream.camera.annotate_background = picamera.Color('black')
+        self.ctl.set(stream=True)
+        self.piStream.camera.annotate_background = _black()
         self.piStream.camera.annotate_text_size = 6
         self.piStream.camera.annotate_text = 'Not recording'
         
     def endStream(self):
-        self.stream_flag.value = False
-        if self.saving.value:
-            self.saving.value = False
+        self.ctl.set(stream=False)
+        self.stopRecording()
         
     def read(self):
-        # return the frame most recently produced to GUI
-        if self.stream_flag.value and not self.current_frame.value==b'a':
-            return self.current_frame.value
+        # return the frame most recently produced to GUI, None if no new frame since the last read
+        if self.ctl.stream:
+            self.previewSeq,frame = self.preview.get(self.previewSeq)
+            return frame
+    
+    def isSaving(self):
+        return self.ctl.state in (ARMED,RECORDING)
     
     def guiStartRecording(self):
-        if not self.startSave.value:
-            self.startSave.value = True
-            self.startAcq.value = True
-            self.piStream.camera.annotate_text = ''
-            self.triggerTime.value = time.perf_counter()
-        else:
+        if not self.ctl.arm(self.ctl.fname,self.ctl.trial,time.perf_counter(),wait=0):
             print('Already saving to file')
+        else:
+            self.piStream.camera.annotate_text = ''
         
     def guiStopRecording(self):
-        if self.saving.value:
-            self.saving.value = False
-            self.flushing.value = True
-            self.piStream.camera.annotate_text = 'Not recording'
-        else:
+        if not self.stopRecording():
             print('Stream is not currently saving')
             
     def passFstub(self,fStub):
         #Get fname when session starts
-        self.fStub.value = fStub
+        self.ctl.set(fStub=fStub)
         self.trialNum = 0
+    
+    def getEyelid(self):
+        #(trial, eyelid trace, time in ms) once per finished trial, None if nothing new or no ROI
+        if self.tracker is None:
+            return None
+        try:
+            return self.tracker.results.get_nowait()
+        except queue.Empty:
+            return None
+    
+    def triggerLatency(self):
+        #trigger edge to first saved frame (ms) over this session
+        return self.ctl.latency_stats()
             
     def end(self):
-        self.stream_flag.value = False
-        self.kill_flag.value = True
-        #print('got kill_flag')
+        self.ctl.set(stream=False,kill=True)
+        self.frame_buffer.ready.set()
+        procs = [self.saver,self.piStream]
+        if self.tracker is not None:
+            self.track_buffer.ready.set()
+            procs.append(self.tracker)
         #Allow stream and saver to finish jobs
-        while (not self.piStream.thread_complete.value) or (not self.saver.saving_complete.value):
-            time.sleep(0.5)
-            print('Waiting for camera threads to end')
-            pass
+        for proc in procs:
+            while proc.is_alive():
+                print('Waiting for camera threads to end')
+                proc.join(0.5)
         #Release resources
         self.piStream.camera.close()
-        GPIO.cleanup()
+        self.frame_buffer.close()
+        self.frame_buffer.unlink()
+        self.preview.close()
+        self.preview.unlink()
+        if self.track_buffer is not None:
+            self.track_buffer.close()
+            self.track_buffer.unlink()
+        self.gpio.cleanup()
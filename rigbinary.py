@@ -0,0 +1,97 @@
+#Host side of the dueAssocLearn binary serial mode (<binary,enable,1>)
+#
+#Each record is 12 bytes, little endian:
+#   0xA5 0x5A | event code u1 | millis u4 | value i4 | CRC-8 (poly 0x07) of bytes 2..10
+#ASCII prints that still happen in binary mode (acknowledgements, 'Motor free')
+#fall between records; the decoder resynchronises on the sync word and CRC.
+import numpy as np
+
+SYNC = b'\xa5\x5a'
+RECORD_SIZE = 12
+RECORD_DTYPE = np.dtype([('sync', '<u2'), ('code', 'u1'), ('millis', '<u4'), ('value', '<i4'), ('crc', 'u1')])
+#index is the event code, keep in sync with eventNames in dueAssocLearn.ino
+EVENT_NAMES = ('unknown', 'rotary', 'startTrial', 'stopTrial', 'startSession',
+               'stopSession', 'CS_US', 'CS', 'US', 'ledCSon', 'ledCSoff', 'USoff', 'CRcountOn', 'CRcount',
+               'bigUSon', 'medUSon', 'smallUSon', 'NotStill', 'Still', 'startITI', 'ITIDuration', '2Pon',
+               '2Poff', 'newFile', 'sessionDur', 'numTrial', 'trialDur', 'motionDetectOn', 'Moved')
+EVENT_CODES = {name: code for code, name in enumerate(EVENT_NAMES)}
+ROTARY = EVENT_CODES['rotary']
+
+
+def _crc_table():
+    table = np.zeros(256, dtype=np.uint8)
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table[i] = crc
+    return table
+
+CRC_TABLE = _crc_table()
+
+
+def crc8(rows):
+    '''CRC-8 of each row of a [n, k] uint8 array, vectorised over rows'''
+    crc = np.zeros(len(rows), dtype=np.uint8)
+    for j in range(rows.shape[1]):
+        crc = CRC_TABLE[crc ^ rows[:, j]]
+    return crc
+
+
+def pack_records(codes, millis, values):
+    '''Bytes the Arduino would send for these records (used by tests and the simulator)'''
+    rec = np.zeros(len(codes), dtype=RECORD_DTYPE)
+    rec['sync'] = 0x5AA5
+    rec['code'] = codes
+    rec['millis'] = millis
+    rec['value'] = values
+    raw = rec.view(np.uint8).reshape(-1, RECORD_SIZE)
+    rec['crc'] = crc8(raw[:, 2:11])
+    return rec.tobytes()
+
+
+class BinaryDecoder():
+    '''Turns raw serial chunks into structured arrays of (code, millis, value)
+
+    Bytes of a record split across chunks are carried over to the next feed().
+    Bytes that are not part of a valid record are counted in nJunk.
+    '''
+    def __init__(self):
+        self.tail = b''
+        self.nRecords = 0
+        self.nJunk = 0
+
+    def feed(self, chunk):
+        buf = np.frombuffer(self.tail + chunk, dtype=np.uint8)
+        n = len(buf)
+        if n < RECORD_SIZE:
+            self.tail = buf.tobytes()
+            return np.zeros(0, dtype=RECORD_DTYPE)
+        last = n - RECORD_SIZE
+        starts = np.flatnonzero((buf[:last+1] == 0xA5) & (buf[1:last+2] == 0x5A))
+        rows = buf[starts[:, None] + np.arange(RECORD_SIZE)]
+        starts = starts[crc8(rows[:, 2:11]) == rows[:, 11]]
+        if len(starts) > 1 and (np.diff(starts) < RECORD_SIZE).any():
+            #a sync word inside a record's payload that also passed the CRC, keep the first
+            keep = [starts[0]]
+            for s in starts[1:]:
+                if s >= keep[-1] + RECORD_SIZE:
+                    keep.append(s)
+            starts = np.array(keep)
+        end = starts[-1] + RECORD_SIZE if len(starts) else 0
+        #anything after the last record that could still be the start of one waits for more bytes
+        keepFrom = max(end, n - RECORD_SIZE + 1)
+        self.nJunk += keepFrom - len(starts)*RECORD_SIZE
+        self.tail = buf[keepFrom:].tobytes()
+        rec = np.zeros(len(starts), dtype=RECORD_DTYPE)
+        if len(starts):
+            rec = buf[starts[:, None] + np.arange(RECORD_SIZE)].copy().view(RECORD_DTYPE).reshape(-1)
+            rec['code'][rec['code'] >= len(EVENT_NAMES)] = 0#newer firmware than this table
+        self.nRecords += len(rec)
+        return rec
+
+
+def records_to_text(rec):
+    '''millis,event,value lines as the ASCII protocol prints them, for rig.txt'''
+    names = np.array(EVENT_NAMES, dtype=object)[rec['code']]
+    return ''.join('%d,%s,%d\r\n' % row for row in zip(rec['millis'].tolist(), names, rec['value'].tolist()))
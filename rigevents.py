@@ -0,0 +1,176 @@
+#Parsing of the dueAssocLearn serial event stream (millis,event,value lines)
+from collections import deque
+import numpy as np
+from rigbinary import EVENT_NAMES, EVENT_CODES, ROTARY
+
+#Wheel information for converting pulse/time to cm/s
+COUNT2CM = 15.24*np.pi / (2000*4)#Aeromat roller circumference over counts per turn of the 2000 PPR encoder
+
+
+class Growable():
+    '''Append-only numeric array that doubles its buffer when full'''
+    def __init__(self, dtype=float, size=1024):
+        self.buf = np.empty(size, dtype=dtype)
+        self.n = 0
+
+    def append(self, val):
+        if self.n == len(self.buf):
+            self.buf = np.concatenate([self.buf, np.empty_like(self.buf)])
+        self.buf[self.n] = val
+        self.n += 1
+
+    def extend(self, vals):
+        need = self.n + len(vals)
+        if need > len(self.buf):
+            size = len(self.buf)
+            while size < need:
+                size *= 2
+            buf = np.empty(size, dtype=self.buf.dtype)
+            buf[:self.n] = self.buf[:self.n]
+            self.buf = buf
+        self.buf[self.n:need] = vals
+        self.n = need
+
+    def clear(self):
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def values(self):
+        return self.buf[:self.n]
+
+
+class SerialParser():
+    '''Incremental parser for the rig's serial text
+
+    feed() takes each chunk as it arrives from the port and only looks at the
+    new bytes: a partial line is kept until its newline shows up, complete
+    lines are split into typed (millis, event, value) records. Rotary samples
+    inside a trial go straight into numeric arrays, so when stopTrial is
+    parsed the trial's wheel data is already there (trial_rotary()). A
+    finished trial's samples are set aside at its stopTrial, so a chunk that
+    also holds the next startTrial doesn't clear them before they are read.
+    Set log to a rigstore.EventWriter to also keep every record in the
+    session's event log.
+    '''
+    def __init__(self):
+        self.tail = ''
+        self.trialRunning = False
+        self.trialDone = False
+        self.finished = deque()#(millis, counts) of trials stopped but not yet read
+        self.rotMillis = Growable(np.int64)
+        self.rotValue = Growable(np.int64)
+        self.nLines = 0
+        self.nBad = 0
+        self.log = None
+
+    def feed(self, string):
+        '''Returns the non-rotary records completed by this chunk, in order'''
+        lines = (self.tail + string).split('\n')
+        self.tail = lines.pop()#empty unless the chunk ended mid-line
+        events = []
+        rows = [] if self.log is not None else None
+        for line in lines:
+            line = line.rstrip('\r')
+            if not line:
+                continue
+            self.nLines += 1
+            fields = line.split(',')
+            if len(fields) != 3:
+                self.nBad += 1#status prints like 'Motor free', or a garbled line
+                continue
+            try:
+                millis = int(fields[0])
+                value = int(fields[2])
+            except ValueError:
+                self.nBad += 1
+                continue
+            event = fields[1]
+            if rows is not None:
+                rows.append((EVENT_CODES.get(event, 0), millis, value))
+            if event == 'rotary':
+                if self.trialRunning:
+                    self.rotMillis.append(millis)
+                    self.rotValue.append(value)
+                continue
+            self._event(millis, event, value)
+            events.append((millis, event, value))
+        if rows:
+            self.log.write(*zip(*rows))
+        return events
+
+    def _event(self, millis, event, value):
+        if event == 'startTrial':
+            self.trialRunning = True
+            self.trialDone = False
+            self.rotMillis.clear()
+            self.rotValue.clear()
+        elif event == 'stopTrial' and self.trialRunning:
+            self.trialRunning = False
+            self.trialDone = True
+            self.finished.append((self.rotMillis.values.copy(), self.rotValue.values.copy()))
+
+    def feed_records(self, rec):
+        '''Same as feed() for records from rigbinary.BinaryDecoder, rotary runs are copied in bulk'''
+        self.nLines += len(rec)
+        if self.log is not None:
+            self.log.write_records(rec)
+        events = []
+        isRot = rec['code'] == ROTARY
+        bounds = np.flatnonzero(~isRot)
+        start = 0
+        for idx in np.append(bounds, len(rec)):
+            if self.trialRunning and idx > start:
+                self.rotMillis.extend(rec['millis'][start:idx])
+                self.rotValue.extend(rec['value'][start:idx])
+            if idx == len(rec):
+                break
+            millis, event, value = int(rec['millis'][idx]), EVENT_NAMES[rec['code'][idx]], int(rec['value'][idx])
+            self._event(millis, event, value)
+            events.append((millis, event, value))
+            start = idx + 1
+        return events
+
+    def trial_rotary(self):
+        '''(millis, counts) of the oldest stopped trial not read yet, else of the current trial'''
+        if self.finished:
+            return self.finished.popleft()
+        return self.rotMillis.values.copy(), self.rotValue.values.copy()
+
+
+def wheel_velocity(time, counts):
+    '''cm/s of one trial's rotary samples (time in ms), returns (velocity, mean poll interval in ms)'''
+    time = np.asarray(time, dtype=float)
+    pollrate = float(np.mean(np.diff(time))) if len(time) > 1 else np.nan
+    wheelVel = np.asarray(counts, dtype=float) * COUNT2CM / (pollrate / 1000)
+    wheelVel[wheelVel > 1000] = np.nan
+    return wheelVel, pollrate
+
+
+def rotary_trials(millis, events, values):
+    '''Wheel velocity and time (ms from startTrial) of every trial of a session at once
+
+    millis, events and values are the session's event table as arrays (events
+    as names). Rows are converted and assigned to trials in one pass; a trial
+    holds the rotary rows after its startTrial up to the next startTrial.
+    Returns a list of (velocity, time) per trial, in the order of parseRotary.
+    '''
+    millis = np.asarray(millis, dtype=float)
+    values = np.asarray(values, dtype=float)
+    events = np.asarray(events, dtype=object)
+    starts = np.flatnonzero(events == 'startTrial')
+    rot = np.flatnonzero((events == 'rotary') & np.isfinite(millis) & np.isfinite(values))
+    #trial of each rotary row, -1 before the first startTrial
+    trial = np.searchsorted(starts, rot, side='right') - 1
+    rot = rot[trial >= 0]
+    trial = trial[trial >= 0]
+    bounds = np.searchsorted(trial, np.arange(len(starts)+1))
+    out = []
+    for idx in range(len(starts)):
+        rows = rot[bounds[idx]:bounds[idx+1]]
+        time = millis[rows] - millis[starts[idx]]
+        wheelVel, _ = wheel_velocity(time, values[rows])
+        out.append((wheelVel, time))
+    return out
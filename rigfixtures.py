@@ -0,0 +1,175 @@
+#Synthetic sessions in the formats the rig writes, for benchmarks and simulation
+#
+#A session is the dueAssocLearn serial stream of a run of trials (the ASCII
+#lines of serialOut, or the same events as binary records) and one camera
+#file per trial with an eye that closes around the US. Everything is drawn
+#from a seeded generator, so the same arguments give the same bytes.
+import os
+import pickle
+import time
+import numpy as np
+import cv2
+from framestore import FrameWriter
+from rigbinary import EVENT_CODES, pack_records
+
+#GetState() keys in the order the sketch prints them, the header of rig.txt
+STATE_KEYS = ('sessionNumber', 'sessionDur', 'numTrial', 'trialDur', 'interTrialInteval', 'preCSdur', 'CSdur',
+              'USdur', 'CS_USinterval', 'percentUS', 'percentCS', 'useMotor', 'motorSpeed', 'rotaryInterval',
+              'binaryOut', 'versionStr')
+
+DEFAULTS = {'numTrial':110, 'trialDur':1000, 'ITIlow':1000, 'ITIhigh':1500, 'preCSdur':200, 'CSdur':250,
+            'USdur':30, 'percentCS':10, 'percentUS':0, 'useMotor':'motorOn', 'motorSpeed':500,
+            'rotaryInterval':20, 'sessionNumber':1}
+
+
+def session_params(**kw):
+    '''DEFAULTS updated with kw, plus the derived CS_USinterval and sessionDur'''
+    p = dict(DEFAULTS, **kw)
+    p['CS_USinterval'] = p['CSdur'] - p['USdur']
+    p['sessionDur'] = p['trialDur'] * p['numTrial']
+    return p
+
+
+def state_lines(p, binary=False):
+    '''What <getState> prints, one "key=value" string per line'''
+    values = dict(p, interTrialInteval='%d%d' % (p['ITIlow'], p['ITIhigh']), binaryOut=int(binary),
+                  versionStr='sim')
+    return ['%s=%s' % (k, values[k]) for k in STATE_KEYS]
+
+
+def session_events(p, seed=0, start=5000):
+    '''(millis, event, value) of a whole session in the order the sketch prints them
+
+    Trial types are drawn from percentCS/percentUS, the ITI from ITIlow..ITIhigh
+    and the wheel counts are drawn around a slow forward walk, printed
+    every rotaryInterval+1 ms like updateEncoder does. Events are generated
+    one trial at a time, so sessions of any length cost the same memory;
+    wrap it in list() to go over the events more than once.
+    '''
+    rng = np.random.default_rng(seed)
+    wheel = np.random.default_rng([seed, 1])
+    ev = [(start, '2Pon', -1), (start, 'sessionDur', p['sessionDur']), (start, 'numTrial', p['numTrial']),
+          (start, 'trialDur', p['trialDur']), (start, 'startSession', p['sessionNumber'])]
+    csOn, usOn = p['preCSdur'], p['preCSdur'] + p['CS_USinterval']
+    step = p['rotaryInterval'] + 1
+    tick = start + step
+    t0 = start
+    for trial in range(p['numTrial']):
+        draw = rng.integers(1, 101)
+        kind = 'US' if draw <= p['percentUS'] else 'CS' if draw <= p['percentUS'] + p['percentCS'] else 'CS_US'
+        ev += [(t0, 'startTrial', trial), (t0, kind, trial), (t0, 'newFile', trial)]
+        if kind in ('CS', 'CS_US'):
+            ev += [(t0 + csOn + 1, 'ledCSon', trial), (t0 + csOn + p['CSdur'], 'ledCSoff', trial)]
+        if kind in ('US', 'CS_US'):
+            ev += [(t0 + usOn - 1, 'CRcountOn', trial), (t0 + usOn, 'CRcount', int(rng.integers(0, 20))),
+                   (t0 + usOn + p['USdur'], 'USoff', trial)]
+        stop = t0 + p['trialDur'] + 1
+        if trial == p['numTrial'] - 1:
+            #stopSession() in the sketch closes the running trial first and turns the 2P off after
+            ev += [(stop, 'stopTrial', trial), (stop, 'stopSession', p['sessionNumber']), (stop, '2Poff', trial)]
+            end = stop
+        else:
+            iti = int(rng.integers(p['ITIlow'], p['ITIhigh']))
+            ev += [(stop, 'startITI', trial), (stop, 'ITIDuration', iti), (stop + iti, 'Still', trial),
+                   (stop + iti + 1, 'stopTrial', trial)]
+            end = t0 = stop + iti + 101#100 ms low gap before the next trigger
+        #wheel samples up to the next trigger
+        ticks = np.arange(tick, end, step)
+        tick += len(ticks)*step
+        counts = np.round(wheel.normal(4, 6, len(ticks))).astype(int)
+        rot = [(int(t), 'rotary', int(c)) for t, c in zip(ticks, counts)]
+        #stable merge, at equal millis the stimulus event came first in the loop
+        allEv = ev + rot
+        for i in sorted(range(len(allEv)), key=lambda i: (allEv[i][0], i >= len(ev))):
+            yield allEv[i]
+        ev = []
+
+
+def serial_text(events, garbled=0.0, seed=0):
+    '''ASCII serial stream of events, with a fraction of lines cut short like a noisy link'''
+    rng = np.random.default_rng(seed)
+    lines = ['%d,%s,%d' % e for e in events]
+    if garbled:
+        for i in np.flatnonzero(rng.random(len(lines)) < garbled):
+            lines[i] = lines[i][:int(rng.integers(1, len(lines[i])))]
+    return '\r\n'.join(lines) + '\r\n'
+
+
+def binary_stream(events):
+    '''The same events as dueAssocLearn binary records'''
+    codes = np.array([EVENT_CODES.get(name, 0) for _, name, _ in events], dtype=np.uint8)
+    millis = np.array([m for m, _, _ in events], dtype=np.uint32)
+    values = np.array([v for _, _, v in events], dtype=np.int32)
+    return pack_records(codes, millis, values)
+
+
+def rig_header(p, session=1, binary=False):
+    '''First two lines of a rig.txt as arduinoRig.newtrialfile writes them'''
+    date, clock = time.strftime('%Y%m%d'), time.strftime('%H%M%S')
+    return ('session=%d;trial=0;date=%s;time=%s;' % (session, date, clock) +
+            ''.join(s + ';' for s in state_lines(p, binary)) + '\n' + 'millis,event,value\n')
+
+
+def eye_images(size=(640, 480), levels=16, quality=90, seed=0):
+    '''JPEGs of an eye from open (0) to closed (levels-1), grey with sensor noise'''
+    w, h = size
+    rng = np.random.default_rng(seed)
+    jpegs = []
+    for level in range(levels):
+        img = np.full((h, w), 150, np.uint8)
+        opening = int(h*0.15*(1 - level/(levels - 1))) + 1
+        cv2.ellipse(img, (w//2, h//2), (w//6, opening), 0, 0, 360, 30, -1)
+        img = np.clip(img + rng.normal(0, 6, img.shape), 0, 255).astype(np.uint8)
+        jpegs.append(cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes())
+    return jpegs
+
+
+def trial_frames(p, fps=100, jpegs=None, kind='CS_US', seed=0):
+    '''(ts in s, jpeg) of one trial's frames, the eye closes after the CS and more at the US'''
+    jpegs = jpegs or eye_images()
+    rng = np.random.default_rng(seed)
+    n = int(p['trialDur']/1000*fps)
+    ts = np.arange(n)/fps - 0.02 + rng.normal(0, 0.0005, n)#ImgOutput stamps 20 ms early
+    ms = ts*1000
+    closure = np.zeros(n)
+    if kind in ('CS', 'CS_US'):
+        closure += 0.4*np.clip((ms - p['preCSdur'] - 100)/100, 0, 1)
+    if kind in ('US', 'CS_US'):
+        usOn = p['preCSdur'] + p['CS_USinterval']
+        closure += 0.6*np.exp(-np.clip(ms - usOn, 0, None)/80)*(ms >= usOn)
+    level = np.clip(np.round(closure*(len(jpegs) - 1)), 0, len(jpegs) - 1).astype(int)
+    return [(t, jpegs[l]) for t, l in zip(ts, level)]
+
+
+def write_frames(filename, frames, trial=0, legacy=False, chunk=200):
+    '''Store frames like MovieSaver does, or as the pickled (ts, bytes) lists it used to write'''
+    if legacy:
+        with open(filename, 'wb') as fo:
+            for i in range(0, len(frames), chunk):
+                pickle.dump(frames[i:i+chunk], fo)
+        return
+    with FrameWriter(filename, trial=trial) as fi:
+        for ts, frame in frames:
+            fi.write(ts, frame)
+
+
+def write_session(path, animalID='sim', p=None, fps=100, size=(640, 480), legacy=False, seed=0):
+    '''A session directory <animalID>_<date> under path with rig.txt and cam_trial<n>.data files
+
+    Returns (session directory, events).
+    '''
+    p = p or session_params()
+    date = time.strftime('%Y%m%d')
+    sessionDir = os.path.join(path, animalID + '_' + date)
+    os.makedirs(sessionDir, exist_ok=True)
+    stub = os.path.join(sessionDir, animalID + '_' + date + '_' + time.strftime('%H%M%S'))
+    events = list(session_events(p, seed))
+    with open(stub + 'rig.txt', 'w', newline='') as fo:
+        fo.write(rig_header(p, p['sessionNumber']))
+        fo.write(serial_text(events))#NewSerialData writes the stream as it comes
+    jpegs = eye_images(size, seed=seed)
+    kinds = [name for _, name, _ in events if name in ('CS', 'US', 'CS_US')]
+    for trial, kind in enumerate(kinds):
+        write_frames(stub + 'cam_trial%d.data' % (trial + 1), trial_frames(p, fps, jpegs, kind, seed + trial),
+                     trial + 1, legacy)
+    return sessionDir, events
@@ -0,0 +1,415 @@
+#Hardware-free rig: a camera, the GPIO trigger and the dueAssocLearn board in software
+#
+#   python rigsim.py /tmp/soak --fps 200 --trials 500 [--hours 2] [--roi roi.npy] [--binary]
+#
+#FakeCamera drives ImgOutput.write with JPEG frames at the frame rate, FakeGPIO
+#delivers the trial pin's edges to piCamHandler like RPi.GPIO does, and
+#DueEmulator answers the sketch's serial commands on a pseudo terminal, so
+#arduinoRig opens it like the board's port. During a session the emulator
+#raises and lowers the trial pin with startTrial/stopTrial, the same wiring as
+#the rig, so the whole acquisition stack runs as it does on the Pi.
+#
+#soak() runs a session through all of it and reports what got lost on the
+#way: frames the ring dropped or the files are missing, ring and serial
+#backlog, and whether the emulator (i.e. the host) kept up with the schedule.
+import argparse
+import json
+import os
+import queue
+import re
+import select
+import threading
+import time
+import tty
+import numpy as np
+import rigfixtures
+from guiloop import LatencyLog
+
+
+class FakeCamera():
+    '''Stands in for picamera.PiCamera, start_recording(output) writes one JPEG per frame period'''
+    def __init__(self, jpegs=None):
+        self.resolution = (640, 480)
+        self.framerate = 100
+        self.exposure_speed = 10000
+        self.awb_gains = (1, 1)
+        self.annotate_text = ''
+        self.jpegs = jpegs
+        self.frames = 0
+        self.late = 0#frame periods the writer thread overran, i.e. the host was too slow
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start_recording(self, output, format='mjpeg'):
+        jpegs = self.jpegs or rigfixtures.eye_images(tuple(self.resolution))
+        self._thread = threading.Thread(target=self._run, args=(output, jpegs), daemon=True)
+        self._thread.start()
+
+    def _run(self, output, jpegs):
+        period = 1/float(self.framerate)
+        due = time.perf_counter()
+        while not self._stop.is_set():
+            output.write(jpegs[(self.frames//10) % len(jpegs)])#slow blinks
+            self.frames += 1
+            due += period
+            wait = due - time.perf_counter()
+            if wait > 0:
+                self._stop.wait(wait)
+            else:
+                self.late += 1
+                if wait < -period:
+                    due = time.perf_counter()#a sensor doesn't catch up, it just moves on
+
+    def stop_recording(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def close(self):
+        self.stop_recording()
+
+
+class _FakePWM():
+    def __init__(self, pin, frequency):
+        self.pin = pin
+        self.duty = 0
+
+    def start(self, duty):
+        self.duty = duty
+
+    def ChangeDutyCycle(self, duty):
+        self.duty = duty
+
+    def stop(self):
+        self.duty = 0
+
+
+class FakeGPIO():
+    '''The part of RPi.GPIO the rig uses; drive() changes an input and runs its edge callbacks
+
+    Callbacks run one after another in their own thread, as RPi.GPIO runs them.
+    '''
+    BCM, BOARD = 11, 10
+    IN, OUT = 1, 0
+    HIGH, LOW = 1, 0
+    PUD_OFF, PUD_DOWN, PUD_UP = 20, 21, 22
+    RISING, FALLING, BOTH = 31, 32, 33
+
+    def __init__(self):
+        self.levels = {}
+        self.callbacks = {}
+        self.edges = 0
+        self._queue = queue.Queue()
+        threading.Thread(target=self._dispatch, daemon=True).start()
+
+    def _dispatch(self):
+        while True:
+            callback, pin = self._queue.get()
+            try:
+                callback(pin)
+            except Exception as e:
+                print('FakeGPIO callback on pin %d: %r' % (pin, e))
+
+    def setwarnings(self, on):
+        pass
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, mode, pull_up_down=None, initial=0):
+        self.levels.setdefault(pin, initial)
+
+    def input(self, pin):
+        return self.levels.get(pin, 0)
+
+    def output(self, pin, level):
+        self.levels[pin] = int(bool(level))
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self.callbacks[pin] = [(edge, callback)] if callback else []
+
+    def add_event_callback(self, pin, callback):
+        self.callbacks.setdefault(pin, []).append((self.BOTH, callback))
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def cleanup(self, pin=None):
+        if pin is None:
+            self.callbacks.clear()
+        else:
+            self.callbacks.pop(pin, None)
+
+    def PWM(self, pin, frequency):
+        return _FakePWM(pin, frequency)
+
+    def drive(self, pin, level):
+        '''Set an input pin from outside, e.g. the board's trial pin'''
+        level = int(bool(level))
+        if self.levels.get(pin, 0) == level:
+            return
+        self.levels[pin] = level
+        self.edges += 1
+        for edge, callback in self.callbacks.get(pin, []):
+            if edge == self.BOTH or edge == (self.RISING if level else self.FALLING):
+                self._queue.put((callback, pin))
+
+
+class DueEmulator():
+    '''dueAssocLearn's serial protocol on a pseudo terminal, open self.port like the board
+
+    Handles <version>, <getState>, <settrial,key,value>, <binary,enable,N>,
+    <startSession> and <stopSession>. A session plays rigfixtures.session_events
+    in real time (faster with speed > 1), in ASCII or binary records, and drives
+    the trial pin on gpio. lag holds how late each event went out.
+    '''
+    def __init__(self, gpio=None, pin=25, speed=1.0, seed=0, **params):
+        self.gpio = gpio
+        self.pin = pin
+        self.speed = speed
+        self.seed = seed
+        self.p = rigfixtures.session_params(**params)
+        self.binary = False
+        self.master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self.t0 = time.perf_counter()
+        self.lag = LatencyLog(maxlen=1<<20)
+        self.sent = 0
+        self.trials = 0
+        self.running = False
+        self._stopSession = threading.Event()
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def millis(self):
+        return int((time.perf_counter() - self.t0)*1000*self.speed)
+
+    def _send(self, data):
+        #blocks while the pty is full, i.e. while the host isn't reading
+        with self._lock:
+            while data:
+                data = data[os.write(self.master, data):]
+
+    def _println(self, line):
+        self._send((line + '\r\n').encode())
+
+    def _serve(self):
+        pending = ''
+        while not self._closed.is_set():
+            if not select.select([self.master], [], [], 0.1)[0]:
+                continue
+            try:
+                pending += os.read(self.master, 4096).decode('ascii', 'replace')
+            except OSError:
+                break
+            for cmd in re.findall(r'<([^>]*)>', pending):
+                self._command(cmd)
+            pending = pending[pending.rfind('>')+1:] if '>' in pending else pending
+
+    def _command(self, cmd):
+        fields = cmd.split(',')
+        name = fields[0]
+        if name == 'version':
+            self._println('version=sim')
+        elif name == 'getState':
+            for line in rigfixtures.state_lines(self.p, self.binary):
+                self._println(line)
+        elif name == 'settrial' and len(fields) == 3:
+            key, val = fields[1], fields[2]
+            if key in self.p or key == 'isDTSC':
+                self.p[key] = int(val) if val.lstrip('-').isdigit() else val
+                self.p = rigfixtures.session_params(**{k:v for k, v in self.p.items()
+                                                       if k not in ('CS_USinterval', 'sessionDur')})
+                self._println(('rotaryencoder.printInterval=%s' if key == 'rotaryInterval' else
+                               'trial.' + key + '=%s') % val)
+            else:
+                self._println("SetTrial() did not handle '%s'" % key)
+        elif name == 'binary' and len(fields) == 3:
+            self._println('binaryOut=' + fields[2])
+            self.binary = bool(int(fields[2]))
+        elif name == 'startSession':
+            if not self.running:
+                self.running = True
+                self._stopSession.clear()
+                threading.Thread(target=self._session, daemon=True).start()
+        elif name == 'stopSession':
+            self._stopSession.set()
+        else:
+            self._println("SerialIn() did not handle: '%s'" % name)
+
+    def _emit(self, events):
+        if self.binary:
+            self._send(rigfixtures.binary_stream(events))
+        else:
+            self._send(rigfixtures.serial_text(events).encode())
+        self.sent += len(events)
+
+    def _session(self):
+        start = self.millis()
+        #a generator, events are drawn as they go out so --hours sessions start straight away
+        events = rigfixtures.session_events(self.p, self.seed, start)
+        ended = inTrial = False
+        trial = 0
+        for millis, name, value in events:
+            due = self.t0 + millis/1000/self.speed
+            wait = due - time.perf_counter()
+            if wait > 0 and self._stopSession.wait(wait):
+                break
+            if self._stopSession.is_set():
+                break
+            self.lag.add(max(time.perf_counter() - due, 0))
+            self._emit([(millis, name, value)])
+            if name == 'startTrial':
+                self.trials += 1
+                trial, inTrial = value, True
+                if self.gpio is not None:
+                    self.gpio.drive(self.pin, 1)
+            elif name in ('stopTrial', 'stopSession'):
+                inTrial = False
+                if self.gpio is not None:
+                    self.gpio.drive(self.pin, 0)
+            ended = ended or name == 'stopSession'
+        events.close()
+        if not ended:
+            #<stopSession> mid session, what the sketch's stopSession() prints
+            now = self.millis()
+            if self.gpio is not None:
+                self.gpio.drive(self.pin, 0)
+            stop = [(now, 'stopSession', self.p['sessionNumber']), (now, '2Poff', trial)]
+            self._emit(([(now, 'stopTrial', trial)] if inTrial else []) + stop)
+        self.p['sessionNumber'] += 1
+        self.running = False
+
+    def close(self):
+        self._closed.set()
+        self._stopSession.set()
+        for fd in (self.master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def _rss_mb():
+    try:
+        with open('/proc/self/status') as fi:
+            for line in fi:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])/1024
+    except OSError:
+        pass
+    return np.nan
+
+
+def frame_gaps(filename, fps):
+    '''(frames, missing) of a saved trial, missing counts the frame periods skipped between frames'''
+    from framestore import open_frames
+    with open_frames(filename) as frames:
+        dt = np.diff(frames.ts)/1000*fps
+        return len(frames), int(np.sum(np.maximum(np.round(dt) - 1, 0)))
+
+
+def soak(path, fps=100, trials=110, resolution=(640, 480), hours=None, roi=None, binary=False,
+         trialDur=1000, ITIlow=1000, ITIhigh=1500, interval=1.0, seed=0):
+    '''Run a simulated session through piCamHandler and arduinoRig, returns the report dict
+
+    With hours the session is stopped after that long instead of after trials.
+    '''
+    from arduinoRig import arduinoRig
+    from pivideostream import piCamHandler
+    from camcontrol import DONE, IDLE
+    os.makedirs(path, exist_ok=True)
+    gpio = FakeGPIO()
+    emu = DueEmulator(gpio, seed=seed)
+    rig = arduinoRig(port=emu.port)
+    rig.setsavepath(os.path.join(path, ''))
+    rig.animalID = 'sim'
+    for key, val in [('numTrial', 10**6 if hours else trials), ('trialDur', trialDur), ('ITIlow', ITIlow),
+                     ('ITIhigh', ITIhigh)]:
+        rig.settrial(key, val)
+    if binary:
+        rig.setBinary(True)
+    camera = FakeCamera()
+    cam = piCamHandler(resolution, fps, roi=roi, camera=camera, gpio=gpio)
+
+    t0 = time.perf_counter()
+    rig.startSession()
+    if not rig.fnameEvent.wait(10):
+        print('rigsim.soak(): no session file after 10 s')
+    cam.passFstub(rig.getFstub())
+    samples = []
+    eyelids = 0
+    rotaries = 0
+    while True:
+        time.sleep(interval)
+        while cam.getEyelid() is not None:
+            eyelids += 1
+        if rig.data_handler.rotary_ready:
+            rig.data_handler.rotary_ready = False
+            rotaries += 1
+        ring = cam.frame_buffer.stats()
+        samples.append({'t':time.perf_counter() - t0, 'trial':emu.trials, 'ringPending':ring['pending'],
+                        'ringDropped':ring['dropped'], 'serialBacklog':rig.ser.in_waiting,
+                        'cameraLate':camera.late, 'rssMB':_rss_mb()})
+        if hours and samples[-1]['t'] > hours*3600 and emu.running:
+            rig.stopSession()
+        if not emu.running and not rig.sessionRunning:
+            break
+    elapsed = time.perf_counter() - t0
+    cam.stopRecording()
+    cam.ctl.wait_for((DONE, IDLE), 5)
+    time.sleep(0.5)
+    ring = cam.frame_buffer.stats()
+    lat = cam.triggerLatency()
+    cam.end()
+    rig.end()
+    emu.close()
+
+    files = sorted(f for f in os.listdir(os.path.dirname(rig.getFstub())) if f.endswith('.data'))
+    saved = missing = 0
+    worst = (0, '')
+    for f in files:
+        n, m = frame_gaps(os.path.join(os.path.dirname(rig.getFstub()), f), fps)
+        saved += n
+        missing += m
+        worst = max(worst, (m, f))
+    rss = [s['rssMB'] for s in samples]
+    report = {'fps':fps, 'resolution':list(resolution), 'binary':binary, 'seconds':elapsed,
+              'trials':emu.trials, 'trialFiles':len(files), 'rotaryTrials':rotaries, 'eyelidTrials':eyelids,
+              'cameraFrames':camera.frames, 'cameraLate':camera.late, 'ringFrames':ring['frames'],
+              'ringDropped':ring['dropped'], 'ringOversize':ring['oversize'], 'ringHighWater':ring['high_water'],
+              'ringSlots':ring['nslots'], 'savedFrames':saved, 'missingFrames':missing, 'worstTrial':worst[1],
+              'worstTrialMissing':worst[0], 'serialBacklogMax':max(s['serialBacklog'] for s in samples),
+              'serialLagMs':emu.lag.percentiles(), 'triggerLatencyMs':lat,
+              'rssMB':{'start':rss[0], 'end':rss[-1], 'max':max(rss)}, 'samples':samples}
+    with open(os.path.join(path, 'soak.json'), 'w') as fo:
+        json.dump(report, fo, indent=1, default=float)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Soak test the acquisition stack without rig hardware')
+    parser.add_argument('path', help='directory for the session files and soak.json')
+    parser.add_argument('--fps', type=float, default=100)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--trials', type=int, default=110)
+    parser.add_argument('--hours', type=float, help='run this long instead of a number of trials')
+    parser.add_argument('--trialDur', type=int, default=1000)
+    parser.add_argument('--ITIlow', type=int, default=1000)
+    parser.add_argument('--ITIhigh', type=int, default=1500)
+    parser.add_argument('--roi', help='.npy ROI mask, also runs the eyelid tracker')
+    parser.add_argument('--binary', action='store_true', help='binary serial records instead of ASCII')
+    args = parser.parse_args()
+    r = soak(args.path, args.fps, args.trials, (args.width, args.height), args.hours,
+             np.load(args.roi) if args.roi else None, args.binary, args.trialDur, args.ITIlow, args.ITIhigh)
+    print('{trials} trials in {seconds:.0f} s at {fps:g} fps, {trialFiles} trial files'.format(**r))
+    print('camera: {cameraFrames} frames, {cameraLate} late periods'.format(**r))
+    print('ring: {ringFrames} frames, {ringDropped} dropped, {ringOversize} oversize, peak {ringHighWater}/{ringSlots} slots'.format(**r))
+    print('files: {savedFrames} frames saved, {missingFrames} missing (worst {worstTrialMissing} in {worstTrial})'.format(**r))
+    fmt = lambda d: ', '.join('%s=%.3g' % kv for kv in d.items())
+    print('serial: backlog peak {} bytes, emulator lag (ms) {}'.format(r['serialBacklogMax'], fmt(r['serialLagMs'])))
+    print('trigger to first frame (ms): ' + fmt(r['triggerLatencyMs']))
+    print('rss (MB): ' + fmt(r['rssMB']))
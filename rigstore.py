@@ -0,0 +1,227 @@
+#Typed, column-oriented log of a session's serial events, kept next to rig.txt
+#
+#File layout (all little endian):
+#   MAGIC                                               8 bytes
+#   metadata length (u4), then that many bytes of JSON  session/date/time, Arduino
+#                                                       state as typed values, event names
+#   per chunk: count n (u4), millis n*u4, code n*u1, value n*i4   (written as serial data arrives)
+#   columns: millis N*u4, value N*i4, code N*u1                   (written by close())
+#   trials: one TRIAL_DTYPE record per trial                       (written by close())
+#   tail: column offset, event count, trial offset, trial count (u8 each), TAIL_MAGIC
+#
+#rig.txt stays the source of truth, this is what analysis loads quickly: the
+#columns are mapped straight from the file and a trial's events are a slice
+#between two entries of the trial index. As with framestore, a session that
+#never closed the log is recovered by walking the chunks.
+import json
+import mmap
+import struct
+import numpy as np
+from rigbinary import EVENT_NAMES, EVENT_CODES, ROTARY
+
+MAGIC = b'EBCEVT01'
+TAIL_MAGIC = b'EBCTRL01'
+COUNT = struct.Struct('<I')
+TAIL = struct.Struct('<QQQQ8s')
+#event index of startTrial and of its stopTrial (event count if the trial never stopped)
+TRIAL_DTYPE = np.dtype([('start','<u8'),('stop','<u8'),('startMillis','<u4'),('stopMillis','<u4')])
+START, STOP = EVENT_CODES['startTrial'], EVENT_CODES['stopTrial']
+
+
+def parse_state(stateList):
+    '''Arduino getState lines (key=value) as a dict of ints, floats and strings'''
+    state = {}
+    for line in stateList or []:
+        if '=' not in line:
+            continue
+        key, val = line.split('=', 1)
+        for kind in (int, float):
+            try:
+                val = kind(val)
+                break
+            except ValueError:
+                pass
+        state[key.strip()] = val
+    return state
+
+
+class EventWriter():
+    '''Append-only event log for one session, fed by rigevents.SerialParser'''
+    def __init__(self, filename, meta=None, stateList=None, buffering=1<<16):
+        self.filename = filename
+        self.fi = open(filename, 'wb', buffering=buffering)
+        meta = dict(meta or {})
+        meta['state'] = parse_state(stateList)
+        meta['events'] = list(EVENT_NAMES)
+        head = json.dumps(meta).encode()
+        self.fi.write(MAGIC + COUNT.pack(len(head)) + head)
+        self.millis = []
+        self.code = []
+        self.value = []
+        self.n = 0
+
+    def write(self, code, millis, value):
+        '''Append a chunk of records, any sequences of event code, millis and value'''
+        code = np.asarray(code, dtype='u1')
+        millis = np.asarray(millis, dtype='<u4')
+        value = np.asarray(value, dtype='<i4')
+        if len(code) == 0:
+            return
+        self.fi.write(COUNT.pack(len(code)) + millis.tobytes() + code.tobytes() + value.tobytes())
+        self.millis.append(millis)
+        self.code.append(code)
+        self.value.append(value)
+        self.n += len(code)
+        if (code == STOP).any():
+            self.fi.flush()#a crash loses at most the trial in progress
+
+    def write_records(self, rec):
+        '''Append a structured array from rigbinary.BinaryDecoder'''
+        self.write(rec['code'], rec['millis'], rec['value'])
+
+    def close(self):
+        if self.fi.closed:
+            return
+        millis = np.concatenate(self.millis) if self.millis else np.zeros(0, '<u4')
+        code = np.concatenate(self.code) if self.code else np.zeros(0, 'u1')
+        value = np.concatenate(self.value) if self.value else np.zeros(0, '<i4')
+        colPos = self.fi.tell()
+        self.fi.write(millis.tobytes() + value.tobytes() + code.tobytes())
+        trials = trial_index(code, millis)
+        trialPos = self.fi.tell()
+        self.fi.write(trials.tobytes())
+        self.fi.write(TAIL.pack(colPos, len(code), trialPos, len(trials), TAIL_MAGIC))
+        self.fi.close()
+
+    @property
+    def closed(self):
+        return self.fi.closed
+
+    def __len__(self):
+        return self.n
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def trial_index(code, millis):
+    '''TRIAL_DTYPE records for each startTrial, ending at the next stopTrial'''
+    starts = np.flatnonzero(code == START)
+    stops = np.flatnonzero(code == STOP)
+    #first stopTrial after each start, a trial cut off by the end of the log stops at len(code)
+    after = np.searchsorted(stops, starts)
+    stop = np.append(stops, len(code))[after]
+    if len(starts) > 1:
+        stop = np.minimum(stop, np.append(starts[1:], len(code)))
+    trials = np.zeros(len(starts), dtype=TRIAL_DTYPE)
+    trials['start'] = starts
+    trials['stop'] = stop
+    trials['startMillis'] = millis[starts]
+    trials['stopMillis'] = np.append(millis, millis[-1:] if len(millis) else 0)[stop]
+    return trials
+
+
+class EventReader():
+    '''Columns and trial index of a log written by EventWriter'''
+    def __init__(self, filename):
+        self.filename = filename
+        self._fi = open(filename, 'rb')
+        self._mm = mmap.mmap(self._fi.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(filename + ' is not a session event log')
+        n, = COUNT.unpack_from(self._mm, len(MAGIC))
+        self.dataPos = len(MAGIC) + COUNT.size + n
+        self.meta = json.loads(self._mm[len(MAGIC)+COUNT.size:self.dataPos].decode())
+        self.state = self.meta.get('state', {})
+        self.names = self.meta.get('events', list(EVENT_NAMES))
+        self._read_columns()
+
+    def _read_columns(self):
+        size = len(self._mm)
+        if size >= self.dataPos + TAIL.size:
+            colPos, n, trialPos, nTrials, tail = TAIL.unpack_from(self._mm, size - TAIL.size)
+            if tail == TAIL_MAGIC and trialPos + nTrials*TRIAL_DTYPE.itemsize == size - TAIL.size:
+                self.millis = np.frombuffer(self._mm, dtype='<u4', count=n, offset=colPos)
+                self.value = np.frombuffer(self._mm, dtype='<i4', count=n, offset=colPos + 4*n)
+                self.code = np.frombuffer(self._mm, dtype='u1', count=n, offset=colPos + 8*n)
+                self.trials = np.frombuffer(self._mm, dtype=TRIAL_DTYPE, count=nTrials, offset=trialPos)
+                return
+        #No tail, the writer never closed: join the chunks
+        millis, code, value = [], [], []
+        pos = self.dataPos
+        while pos + COUNT.size <= size:
+            n, = COUNT.unpack_from(self._mm, pos)
+            pos += COUNT.size
+            if pos + 9*n > size:
+                break#truncated last chunk
+            millis.append(np.frombuffer(self._mm, dtype='<u4', count=n, offset=pos))
+            code.append(np.frombuffer(self._mm, dtype='u1', count=n, offset=pos + 4*n))
+            value.append(np.frombuffer(self._mm, dtype='<i4', count=n, offset=pos + 5*n))
+            pos += 9*n
+        self.millis = np.concatenate(millis) if millis else np.zeros(0, '<u4')
+        self.code = np.concatenate(code) if code else np.zeros(0, 'u1')
+        self.value = np.concatenate(value) if value else np.zeros(0, '<i4')
+        self.trials = trial_index(self.code, self.millis)
+
+    def __len__(self):
+        return len(self.code)
+
+    @property
+    def events(self):
+        '''Event names of every record, as strings'''
+        return np.array(self.names, dtype=object)[self.code]
+
+    def trial_slice(self, idx):
+        t = self.trials[idx]
+        return slice(int(t['start']), int(t['stop']))
+
+    def trial_rotary(self, idx):
+        '''(ms from startTrial, counts) of the rotary samples in trial idx'''
+        sl = self.trial_slice(idx)
+        rot = self.code[sl] == ROTARY
+        return self.millis[sl][rot].astype(np.int64) - int(self.trials['startMillis'][idx]), self.value[sl][rot]
+
+    def trial_types(self, kinds=('CS', 'US', 'CS_US')):
+        '''Event name of the first trial-type event in each trial, '' if there was none'''
+        codes = [self.names.index(k) for k in kinds if k in self.names]
+        types = []
+        for idx in range(len(self.trials)):
+            sl = self.trial_slice(idx)
+            hit = np.flatnonzero(np.isin(self.code[sl], codes))
+            types.append(self.names[self.code[sl][hit[0]]] if len(hit) else '')
+        return np.array(types)
+
+    def close(self):
+        self.millis = self.code = self.value = self.trials = None
+        try:
+            self._mm.close()
+        except BufferError:
+            pass#views of the map are still alive, the map is released with them
+        self._fi.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def events_from_text(txtFile, evtFile=None):
+    '''Build the event log of a session recorded before the rig wrote one, returns its name'''
+    from rigevents import SerialParser
+    evtFile = evtFile or txtFile[:-4] + '.evt'
+    with open(txtFile) as fi:
+        header = fi.readline().rstrip('\n').split(';')
+        fi.readline()#millis,event,value
+        text = fi.read()
+    meta = parse_state(header[:4])
+    writer = EventWriter(evtFile, meta, header[4:])
+    parser = SerialParser()
+    parser.log = writer
+    parser.feed(text + '\n')
+    writer.close()
+    return evtFile
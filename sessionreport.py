@@ -0,0 +1,169 @@
+#Off-screen rendering of the session summary figures
+#
+#Figures are drawn with the Agg canvas directly, no pyplot and no GUI
+#backend, so reports can be made in worker processes while the analysis
+#goes on. Each process keeps one set of figures and their artists and only
+#swaps the data in for the next session; nothing is torn down between
+#sessions apart from the legends.
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection, PolyCollection
+from matplotlib import cm
+
+KIND_COLORS = {'CS_US':'blue', 'CS':'red', 'US':'green'}
+XLABEL = 'time from CS onset (ms)'
+
+
+def _figure():
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    return fig, fig.add_subplot(111)
+
+
+def _fit(ax, x, lo, hi):
+    #collections don't update the data limits when their data is swapped, set them from the arrays
+    if not np.isfinite([lo, hi]).all():
+        lo, hi = 0, 1
+    ax.dataLim.set_points(np.array([[x[0], lo], [x[-1], hi]], dtype=float))
+    ax.autoscale_view()
+
+
+def _band(x, lo, hi):
+    #polygons of fill_between(x, lo, hi), one per run of finite samples so nan stretches are gaps
+    ok = np.isfinite(lo) & np.isfinite(hi)
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], ok.astype(np.int8), [0]])))
+    return [np.concatenate([np.column_stack([x[a:b], lo[a:b]]), np.column_stack([x[a:b][::-1], hi[a:b][::-1]])])
+            for a, b in zip(edges[::2], edges[1::2])]
+
+
+class SessionReport():
+    '''Draws and saves the five summary figures of a session, reusing one set of figures'''
+    def __init__(self):
+        self.trialFigs = {}
+        self.avgFigs = {}
+        self.heat = None
+
+    def _markers(self, ax, lines, csusInt, color):
+        #CS onset and US lines across the current y range
+        n, x = ax.get_ylim()
+        lines.set_segments([[(csusInt, n), (csusInt, x)], [(0, n), (0, x)]])
+        lines.set_color(color)
+
+    def _trials(self, key, x, rows, ylabel, title, filename, csusInt):
+        if key not in self.trialFigs:
+            fig, ax = _figure()
+            traces = LineCollection([], linewidths=0.3)
+            marks = LineCollection([], linestyles='--')
+            ax.add_collection(traces)
+            ax.add_collection(marks)
+            ax.set_xlabel(XLABEL)
+            ax.set_ylabel(ylabel)
+            self.trialFigs[key] = (fig, ax, traces, marks)
+        fig, ax, traces, marks = self.trialFigs[key]
+        traces.set_segments([np.column_stack([x, r]) for r in rows])
+        traces.set_color(cm.jet(np.linspace(0, 1, len(rows))))
+        finite = rows[np.isfinite(rows)]
+        _fit(ax, x, finite.min() if len(finite) else np.nan, finite.max() if len(finite) else np.nan)
+        self._markers(ax, marks, csusInt, 'black')
+        ax.set_title(title)
+        fig.tight_layout()
+        fig.savefig(filename)
+
+    def _averages(self, key, x, kinds, mean, sd, present, ylabel, title, filename, csusInt):
+        if key not in self.avgFigs:
+            fig, ax = _figure()
+            lines = {k:ax.plot([], [], color=KIND_COLORS.get(k))[0] for k in kinds}
+            bands = {k:ax.add_collection(PolyCollection([], alpha=.1, facecolors=KIND_COLORS.get(k), lw=0)) for k in kinds}
+            marks = ax.add_collection(LineCollection([], linestyles='--'))
+            ax.set_xlabel(XLABEL)
+            ax.set_ylabel(ylabel)
+            self.avgFigs[key] = (fig, ax, lines, bands, marks)
+        fig, ax, lines, bands, marks = self.avgFigs[key]
+        handles, labels = [], []
+        lo, hi = [], []
+        for i, kind in enumerate(kinds):
+            show = kind in present
+            lines[kind].set_data(x, mean[i])
+            lines[kind].set_visible(show)
+            bands[kind].set_verts(_band(x, mean[i]-sd[i], mean[i]+sd[i]) if show else [])
+            if show:
+                handles.append(lines[kind])
+                labels.append(kind)
+                lo.append(np.nanmin(mean[i]-sd[i], initial=np.inf))
+                hi.append(np.nanmax(mean[i]+sd[i], initial=-np.inf))
+        _fit(ax, x, min(lo, default=np.nan), max(hi, default=np.nan))
+        self._markers(ax, marks, csusInt, 'black')
+        if ax.get_legend() is not None:
+            ax.get_legend().remove()
+        ax.legend(handles, labels)
+        ax.set_title(title)
+        fig.tight_layout()
+        fig.savefig(filename)
+
+    def _heatmap(self, x, rows, title, filename, csusInt):
+        if self.heat is None:
+            fig, ax = _figure()
+            img = ax.imshow(np.zeros((1, 1)), cmap='Greys_r', aspect='auto')
+            bar = fig.colorbar(img)
+            marks = ax.add_collection(LineCollection([], linestyles='--'))
+            ax.set_xlabel(XLABEL)
+            ax.set_ylabel('trial number')
+            self.heat = (fig, ax, img, bar, marks)
+        fig, ax, img, bar, marks = self.heat
+        img.set_data(rows)
+        img.set_extent([x[0], x[-1], len(rows), 0])
+        finite = rows[np.isfinite(rows)]
+        img.set_clim(*(finite.min(), finite.max()) if len(finite) else (0, 1))
+        bar.update_normal(img)
+        ax.set_xlim(x[0], x[-1])
+        ax.set_ylim(len(rows), 0)
+        self._markers(ax, marks, csusInt, 'red')
+        ax.set_title(title)
+        fig.tight_layout()
+        fig.savefig(filename)
+
+    def render(self, summary, name, outDir, csusInt):
+        '''Save <name>traces.jpg, rotarytraces.jpg, avgTraces.pdf, avgTracesRotary.pdf and tracesImg.jpg'''
+        x = summary.timeBins - summary.csTime
+        title = name
+        out = lambda suffix: os.path.join(outDir, name + suffix)
+        present = set(summary.trialTypes.tolist())
+        self._trials('eye', x, summary.eye, 'Eyelid (a.u.)', title, out('traces.jpg'), csusInt)
+        self._trials('rotary', x, summary.rotary, 'Wheel speed (cm/s)', title, out('rotarytraces.jpg'), csusInt)
+        self._averages('eye', x, summary.kinds, summary.eyeMean, summary.eyeSD, present,
+                       'Average eyelid position (a.u.)', title, out('avgTraces.pdf'), csusInt)
+        self._averages('rotary', x, summary.kinds, summary.rotMean, summary.rotSD, present,
+                       'Average speed (cm/s)', title, out('avgTracesRotary.pdf'), csusInt)
+        self._heatmap(x, summary.eye, title, out('tracesImg.jpg'), csusInt)
+        return name
+
+
+_report = None
+
+def _render(*args):
+    #runs in a ReportPool worker, the SessionReport lives as long as the process
+    global _report
+    if _report is None:
+        _report = SessionReport()
+    return _report.render(*args)
+
+
+class ReportPool():
+    '''Renders SessionReports in worker processes, submit() returns a future'''
+    def __init__(self, workers=1):
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+
+    def submit(self, summary, name, outDir, csusInt):
+        return self.pool.submit(_render, summary, name, outDir, csusInt)
+
+    def close(self):
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,52 @@
+#Eyelid traces of all trials of a session, for summarizeSessions
+#
+#Trials are appended into flat arrays sized for the whole session up front,
+#with an offset index per trial, so adding a trial copies only that trial
+#and getting one back is a slice. The per-sample DataFrame saved as data.h5
+#is built once at the end by to_dataframe().
+import numpy as np
+from rigevents import Growable
+from trialalign import align_trials
+
+
+class SessionTraces():
+    def __init__(self, nTrials, framesPerTrial=1024, animalID='', date=''):
+        self.animalID = animalID
+        self.date = date
+        self.time = Growable(float, max(nTrials*framesPerTrial, 1))
+        self.eyetrace = Growable(float, max(nTrials*framesPerTrial, 1))
+        self.trials = []
+        self.trialTypes = []
+        self.offsets = [0]
+
+    def append(self, trial, time, eyetrace, trialType=''):
+        self.time.extend(time)
+        self.eyetrace.extend(eyetrace)
+        self.trials.append(trial)
+        self.trialTypes.append(trialType)
+        self.offsets.append(len(self.time))
+
+    def __len__(self):
+        return len(self.trials)
+
+    def trial(self, idx):
+        '''(time, eyetrace) of the idx-th appended trial, views onto the session arrays'''
+        sl = slice(self.offsets[idx], self.offsets[idx+1])
+        return self.time.values[sl], self.eyetrace.values[sl]
+
+    def align(self, timeBins):
+        '''Eyelid trace of every trial on timeBins, [nTrials, nBins] (see trialalign.align_trials)'''
+        return align_trials(self.time.values, self.eyetrace.values, self.offsets, timeBins)
+
+    def to_dataframe(self):
+        '''Same columns and index as the concatenated per-trial frames summarizeSessions used to build'''
+        import pandas as pd
+        counts = np.diff(self.offsets)
+        n = len(self.time)
+        return pd.DataFrame({'animalID': np.full(n, self.animalID, dtype=object),
+                             'date': np.full(n, self.date, dtype=object),
+                             'time': self.time.values.copy(),
+                             'eyetrace': self.eyetrace.values.copy(),
+                             'trial': np.repeat(np.asarray(self.trials, dtype=np.int64), counts),
+                             'trialType': np.repeat(np.asarray(self.trialTypes, dtype=object), counts)},
+                            index=np.arange(n) - np.repeat(self.offsets[:-1], counts))
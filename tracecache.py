@@ -0,0 +1,158 @@
+#Content-addressed cache of per-trial traces extracted from trial files
+#
+#An entry is keyed by the content hash of the source file plus everything
+#that went into the extraction (ROI, decode scale, extractor version), so a
+#re-run with new plotting parameters loads the traces instead of decoding the
+#movie again, and a changed ROI or extractor simply misses. The hash of each
+#source file is remembered together with its size and mtime, so a file is
+#only read in full again when either of those changes.
+#
+#Layout of the cache directory:
+#   <file hash[:16]>_<entry hash>.npz   one entry, arrays of the cached result
+#   files/<path hash>.json               size, mtime and content hash of a source file
+#Every file is written to a temporary name and renamed into place, so several
+#processes (summarizeSessions batch mode) can share a cache directory.
+import hashlib
+import json
+import os
+import numpy as np
+
+
+def file_hash(filename, block=1<<20):
+    '''blake2b of a file's contents, hex'''
+    h = hashlib.blake2b(digest_size=20)
+    with open(filename, 'rb') as fi:
+        for chunk in iter(lambda: fi.read(block), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _replace(path, write):
+    #write through a temporary file so readers never see half an entry
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    write(tmp)
+    os.replace(tmp, path)
+
+
+class TraceCache():
+    '''Directory of cached results, bounded to maxBytes by evicting the least recently used'''
+    def __init__(self, path, maxBytes=2<<30):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.join(path, 'files'), exist_ok=True)
+
+    def _memo(self, filename):
+        name = hashlib.blake2b(os.path.abspath(filename).encode(), digest_size=10).hexdigest()
+        return os.path.join(self.path, 'files', name + '.json')
+
+    def file_key(self, filename):
+        '''Content hash of filename, recomputed only if its size or mtime changed'''
+        st = os.stat(filename)
+        memo = self._memo(filename)
+        try:
+            with open(memo) as fi:
+                known = json.load(fi)
+            if known['size'] == st.st_size and known['mtime'] == st.st_mtime_ns:
+                return known['hash']
+        except (OSError, ValueError, KeyError):
+            pass
+        digest = file_hash(filename)
+        def write(tmp):
+            with open(tmp, 'w') as fo:
+                json.dump({'file':os.path.abspath(filename), 'size':st.st_size, 'mtime':st.st_mtime_ns, 'hash':digest}, fo)
+        _replace(memo, write)
+        return digest
+
+    def key(self, filename, kind, params=()):
+        '''Entry name for `kind` extracted from filename with params (arrays, numbers, strings)'''
+        h = hashlib.blake2b(kind.encode(), digest_size=20)
+        for p in params:
+            if isinstance(p, np.ndarray):
+                h.update(('%s%s' % (p.dtype.str, p.shape)).encode())
+                h.update(np.ascontiguousarray(p).tobytes())
+            else:
+                h.update(repr(p).encode())
+        return self.file_key(filename)[:16] + '_' + h.hexdigest()
+
+    def get(self, key):
+        '''Tuple of cached arrays, None on a miss'''
+        path = os.path.join(self.path, key + '.npz')
+        try:
+            with np.load(path) as npz:
+                result = tuple(npz['arr_%d' % i] for i in range(len(npz.files)))
+        except (OSError, ValueError, KeyError):
+            return None
+        os.utime(path)#mtime is the last use for eviction
+        return result
+
+    def put(self, key, arrays):
+        path = os.path.join(self.path, key + '.npz')
+        def write(tmp):
+            with open(tmp, 'wb') as fo:
+                np.savez(fo, *arrays)
+        _replace(path, write)
+        self.evict()
+
+    def cached(self, filename, kind, params, compute):
+        '''compute() through the cache, compute must return a tuple of arrays'''
+        key = self.key(filename, kind, params)
+        result = self.get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+        self.misses += 1
+        result = compute()
+        self.put(key, result)
+        return result
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.npz'):
+                try:
+                    st = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    continue#evicted by another process meanwhile
+                entries.append((st.st_mtime, st.st_size, name))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        '''Remove least recently used entries until the cache fits in maxBytes'''
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+
+    def invalidate(self, filename=None):
+        '''Drop the entries extracted from filename, or everything when filename is None'''
+        if filename is None:
+            prefix = ''
+            memos = [os.path.join(self.path, 'files', f) for f in os.listdir(os.path.join(self.path, 'files'))]
+        else:
+            memo = self._memo(filename)
+            try:
+                with open(memo) as fi:
+                    prefix = json.load(fi)['hash'][:16] + '_'
+            except (OSError, ValueError, KeyError):
+                prefix = self.file_key(filename)[:16] + '_'
+            memos = [memo]
+        for name in os.listdir(self.path):
+            if name.endswith('.npz') and name.startswith(prefix):
+                os.remove(os.path.join(self.path, name))
+        for memo in memos:
+            if os.path.exists(memo):
+                os.remove(memo)
+
+    def stats(self):
+        return {'hits':self.hits, 'misses':self.misses, 'entries':len(self._entries()), 'bytes':self.size()}
@@ -0,0 +1,116 @@
+#Alignment of trial traces onto a common time grid and per-trial-type statistics
+#
+#Trials are handed over as flat sample arrays plus a trial offset index (the
+#SessionTraces layout), so resampling every trial is one np.interp call over
+#the whole session and the statistics are one grouped reduction, whatever
+#the number of trials or sessions.
+from collections import namedtuple
+import numpy as np
+
+TRIAL_KINDS = ('CS_US', 'CS', 'US')
+
+#eye/rotary: [nTrials, nBins] resampled traces; eyeMean/eyeSD/rotMean/rotSD and
+#counts: [nKinds, nBins] statistics of the trials of each kind, in `kinds` order
+SessionSummary = namedtuple('SessionSummary', ['timeBins', 'csTime', 'trialTypes', 'kinds', 'eye', 'rotary',
+                                               'eyeMean', 'eyeSD', 'rotMean', 'rotSD', 'counts'])
+
+
+def flatten(trials):
+    '''(time, values, offsets) from a list of per-trial (values, time) pairs'''
+    offsets = np.concatenate([[0], np.cumsum([len(t) for _, t in trials])]).astype(np.int64)
+    if not len(trials):
+        return np.zeros(0), np.zeros(0), offsets
+    time = np.concatenate([np.asarray(t, dtype=float) for _, t in trials])
+    values = np.concatenate([np.asarray(v, dtype=float) for v, _ in trials])
+    return time, values, offsets
+
+
+def align_trials(time, values, offsets, timeBins):
+    '''Every trial resampled onto timeBins, [nTrials, nBins]
+
+    Same as np.interp(timeBins, t[t>0], v[t>0]) for each trial (times must
+    increase within a trial, ends are held), done for all trials at once.
+    A trial without samples after time 0 gives a row of nan.
+    '''
+    time = np.asarray(time, dtype=float)
+    values = np.asarray(values, dtype=float)
+    timeBins = np.asarray(timeBins, dtype=float)
+    nTrials = len(offsets) - 1
+    trial = np.repeat(np.arange(nTrials), np.diff(offsets))
+    keep = time > 0
+    t, v, trial = time[keep], values[keep], trial[keep]
+    n = np.bincount(trial, minlength=nTrials)
+    first = np.concatenate([[0], np.cumsum(n)])
+    out = np.full((nTrials, len(timeBins)), np.nan)
+    has = np.flatnonzero(n > 0)
+    if len(has) == 0:
+        return out
+    #Lay the trials end to end on one time axis, each in its own stretch of length span and
+    #fenced by copies of its first and last sample, then it is a single np.interp call
+    loEdge = min(timeBins.min(), 0) - 1
+    hiEdge = max(timeBins.max(), t.max()) + 1
+    span = hiEdge - loEdge + 1
+    rank = np.cumsum(n > 0) - 1
+    shift = np.arange(len(has)) * span
+    T = np.concatenate([t + rank[trial]*span, shift + loEdge, shift + hiEdge])
+    V = np.concatenate([v, v[first[has]], v[first[has+1] - 1]])
+    order = np.argsort(T, kind='stable')
+    query = (timeBins[None, :] + shift[:, None]).ravel()
+    out[has] = np.interp(query, T[order], V[order]).reshape(len(has), -1)
+    return out
+
+
+def group_stats(slices, labels, kinds=TRIAL_KINDS):
+    '''nan-ignoring mean, SD (ddof 0, as np.nanstd) and sample count over the rows of each kind
+
+    One matrix product per statistic instead of a masked reduction per kind;
+    rows whose label is not in kinds are left out.
+    '''
+    labels = np.asarray(labels)
+    member = (labels[None, :] == np.asarray(kinds)[:, None]).astype(float)#[nKinds, nTrials]
+    valid = ~np.isnan(slices)
+    filled = np.where(valid, slices, 0)
+    counts = member @ valid
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (member @ filled) / counts
+        #deviations from each row's own kind mean, rows of no kind contribute nothing
+        kindMean = member.T @ np.nan_to_num(mean)
+        dev = np.where(valid, slices - kindMean, 0)
+        sd = np.sqrt((member @ dev**2) / counts)
+    return mean, sd, counts
+
+
+def summarize(timeBins, csTime, trialTypes, eye, rotary, kinds=TRIAL_KINDS):
+    '''SessionSummary of already aligned eye and rotary rows'''
+    trialTypes = np.asarray(trialTypes)
+    eyeMean, eyeSD, counts = group_stats(eye, trialTypes, kinds)
+    rotMean, rotSD, _ = group_stats(rotary, trialTypes, kinds)
+    return SessionSummary(np.asarray(timeBins), csTime, trialTypes, np.asarray(kinds), eye, rotary,
+                          eyeMean, eyeSD, rotMean, rotSD, counts)
+
+
+def combine(summaries):
+    '''Pool the trials of several sessions on the same timeBins, e.g. a cohort, into one summary'''
+    first = summaries[0]
+    return summarize(first.timeBins, first.csTime,
+                     np.concatenate([s.trialTypes for s in summaries]),
+                     np.concatenate([s.eye for s in summaries]),
+                     np.concatenate([s.rotary for s in summaries]), first.kinds)
+
+
+def save_mat(summary, filename, **extra):
+    '''Write a summary as a .mat file, eyetime/eyetraces are the names unpackRotaryData.m loads'''
+    try:
+        from scipy.io import savemat
+    except ImportError:
+        print('trialalign.save_mat() needs scipy, ' + filename + ' not written')
+        return False
+    out = {'eyetime': summary.timeBins, 'eyetraces': summary.eye,
+           'rotarytime': summary.timeBins, 'rotarytraces': summary.rotary,
+           'csTime': summary.csTime, 'trialTypes': summary.trialTypes.astype(object),
+           'kinds': summary.kinds.astype(object), 'counts': summary.counts,
+           'eyeMean': summary.eyeMean, 'eyeSD': summary.eyeSD,
+           'rotMean': summary.rotMean, 'rotSD': summary.rotSD}
+    out.update(extra)
+    savemat(filename, out)
+    return True